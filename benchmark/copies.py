@@ -0,0 +1,208 @@
+"""
+Compares the CPU time and memory of the image send and receive paths
+against the original implementation, which copied each part several times.
+
+The sockets are replaced with in-memory ones, so only the work done
+in our code is measured and not the work of the kernel.
+The bytes of the image copied by our code are counted as well: each slice,
+join and write of the original implementation, and on the current paths,
+parts handed to the socket which are not views of the image, and the parts
+copied into the image being assembled. Copies the kernel does (into and out
+of its buffers) are left out for both.
+
+Run with: python -m benchmark.copies [image size in MB] [repeats]
+"""
+from collections import deque
+from contextlib import contextmanager
+from typing import Tuple
+
+import io
+import os
+import struct
+import sys
+import time
+import tracemalloc
+
+from common import udp
+from common.image import Image
+
+LEGACY_HEADER_FORMAT = 'iiii'  # client_id, image_id, index, has next
+
+
+class CopyCounter(object):
+
+    def __init__(self):
+        self.bytes = 0
+
+    def add(self, size: int):
+        self.bytes += size
+
+
+def legacy_send_image(socket, sender_id: int, dest_address: Tuple[str, int], image: Image, copies: CopyCounter):
+    # The original send path: each part is sliced out of the image,
+    # and then joined with the header.
+    image_size = len(image)
+    max_part_size = udp.MAX_UDP_SIZE - struct.calcsize(LEGACY_HEADER_FORMAT)
+    image_data = image.data
+
+    last_index = 0
+    part_index = 0
+    while image_size > 0:
+        current_size = min(image_size, max_part_size)
+        image_size -= current_size
+        has_next = 0 if image_size <= 0 else 1
+
+        header = struct.pack(LEGACY_HEADER_FORMAT, sender_id, image.id, part_index, has_next)
+        data = image_data[last_index:(last_index + current_size)]
+        copies.add(len(data))
+        datagram = header + data
+        copies.add(len(datagram))
+        socket.sendto(datagram, dest_address)
+
+        last_index = last_index + current_size
+        part_index += 1
+
+
+def legacy_receive_image(socket, copies: CopyCounter) -> Image:
+    # The original receive path: each datagram is split into header and data,
+    # kept in a list, and joined through a BytesIO.
+    image_parts = []
+    header_size = struct.calcsize(LEGACY_HEADER_FORMAT)
+    while True:
+        data, addr = socket.recvfrom(udp.MAX_UDP_SIZE)
+        header, data = data[:header_size], data[header_size:]
+        copies.add(len(header) + len(data))
+        sender_id, image_id, index, has_next = struct.unpack(LEGACY_HEADER_FORMAT, header)
+
+        if len(image_parts) <= index:
+            image_parts.insert(index, data)
+        else:
+            image_parts[index] = data
+
+        if has_next == 0:
+            break
+
+    image = io.BytesIO()
+    for part in image_parts:
+        image.write(part)
+        copies.add(len(part))
+
+    image_data = image.getvalue()
+    copies.add(len(image_data))
+    return Image(image_id, image_data)
+
+
+class RecordingSocket(object):
+    """
+    Keeps the datagrams sent through it, so they may be replayed.
+    """
+
+    def __init__(self):
+        self.datagrams = []
+
+    def sendto(self, data, address):
+        self.datagrams.append(bytes(data))
+
+    def sendmsg(self, buffers, ancdata=(), flags=0, address=None):
+        # The kernel gathers the buffers into the datagram.
+        self.datagrams.append(b''.join(buffers))
+
+
+class DiscardingSocket(object):
+    """
+    Counts the parts handed to it which were copied out of the image, rather than
+    given as views of it.
+    """
+
+    def __init__(self, copies: CopyCounter):
+        self._copies = copies
+
+    def sendto(self, data, address):
+        # The datagram was joined by whoever sends it, and counted there.
+        pass
+
+    def sendmsg(self, buffers, ancdata=(), flags=0, address=None):
+        # The header is packed, not copied.
+        for data in buffers[1:]:
+            if not isinstance(data, memoryview):
+                self._copies.add(len(data))
+
+
+class ReplaySocket(object):
+    """
+    Gives back recorded datagrams, the same way the kernel would.
+    """
+
+    def __init__(self, datagrams):
+        self._datagrams = deque(datagrams)
+
+    def recvfrom(self, size):
+        # The kernel creates a new object for each datagram.
+        return bytes(self._datagrams.popleft()), None
+
+    def recvfrom_into(self, buffer):
+        # The kernel copies the datagram into the buffer given.
+        data = self._datagrams.popleft()
+        buffer[:len(data)] = data
+        return len(data), None
+
+
+@contextmanager
+def counting_assembled_parts(copies: CopyCounter):
+    # Parts are copied into the image being assembled in one place, which we count through.
+    add_part = udp._PartialImage.add_part
+
+    def counting_add_part(partial, index: int, part):
+        copies.add(len(part))
+        add_part(partial, index, part)
+
+    udp._PartialImage.add_part = counting_add_part
+    try:
+        yield
+    finally:
+        udp._PartialImage.add_part = add_part
+
+
+def _measure(func, repeats: int) -> Tuple[float, int]:
+    # Returns the CPU time and the peak memory used by func.
+    tracemalloc.start()
+    start = time.process_time()
+    for _ in range(repeats):
+        func()
+    cpu = time.process_time() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return cpu, peak
+
+
+def main():
+    image_size_mb = float(sys.argv[1]) if len(sys.argv) > 1 else 8
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    image = Image(1, os.urandom(int(image_size_mb * 1024 * 1024)))
+    total_mb = image_size_mb * repeats
+
+    legacy_socket = RecordingSocket()
+    legacy_send_image(legacy_socket, 1, None, image, CopyCounter())
+    current_socket = RecordingSocket()
+    udp.send_image(current_socket, 1, None, image)
+
+    copies = CopyCounter()
+    cases = [
+        ('send legacy', lambda: legacy_send_image(DiscardingSocket(copies), 1, None, image, copies)),
+        ('send current', lambda: udp.send_image(DiscardingSocket(copies), 1, None, image)),
+        ('receive legacy', lambda: legacy_receive_image(ReplaySocket(legacy_socket.datagrams), copies)),
+        ('receive current', lambda: udp.receive_image(ReplaySocket(current_socket.datagrams))),
+    ]
+
+    print('image size: {} MB, repeats: {}'.format(image_size_mb, repeats))
+    for name, func in cases:
+        copies.bytes = 0
+        with counting_assembled_parts(copies):
+            cpu, peak = _measure(func, repeats)
+        print('{:<16} cpu: {:8.3f} ms/MB  peak memory: {:6.2f}  copied: {:5.2f}  (MB per MB of image)'.format(
+            name, cpu * 1000 / total_mb, peak / (1024 * 1024) / image_size_mb, copies.bytes / len(image) / repeats))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,661 @@
+"""
+Load test of the whole system over the loopback interface.
+Starts a Master and several simulated workers (as threads or processes), has each
+worker take pictures with synthetic payloads and collects them.
+
+Reports discovery time, throughput, per-image latency percentiles (from when each
+picture was taken until it was stored) and loss.
+Each run is also appended as a JSON line to the output file, along with the
+current commit, so results may be compared between commits. A run which collected
+no images is not recorded.
+
+Run with: python -m benchmark.loopback --help
+"""
+from pathlib import Path
+from typing import List, Tuple, Optional, Callable
+
+import argparse
+import asyncio
+import contextlib
+import functools
+import hashlib
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from client.aio import AsyncConnection as AsyncWorkerConnection, AsyncClient as AsyncWorker
+from client.camera import Camera
+from client.client import Client as Worker
+from client.connection import UdpConnection as WorkerConnection, TcpConnection as WorkerTcpConnection
+from client import storage as worker_storage
+from common.compression import Codec, CompressionSettings
+from common.image import Image, ReferenceImage
+from common.metrics import Metrics, set_metrics, get_metrics
+from common.pacing import Pacer, AdaptivePacer
+from common import udp
+from master import storage as master_storage
+from master.aio import AsyncConnection as AsyncMasterConnection, AsyncMaster
+from master.catalogue import Catalogue, CataloguedStorage
+from master.client import UdpConnection as MasterConnection, TcpConnection as MasterTcpConnection, Client
+from master.master import Master
+from master.sharded import ShardedMaster
+
+LOOPBACK = '127.0.0.1'
+DEFAULT_RECEIVE_BUFFER_SIZE = 8 * 1024 * 1024
+CATALOGUE_RUN = 'loopback'
+DIGEST_SIZE = hashlib.sha256().digest_size
+
+
+class SyntheticCamera(Camera):
+    """
+    Takes pictures of random data. Each picture starts with the digest of the rest
+    of it, so the receiver can check it arrived intact.
+    """
+
+    def __init__(self, size: int, distinct: int = 0, compressible: bool = False):
+        self._size = max(size, DIGEST_SIZE)
+        # Compressible pictures are mostly zeros.
+        self._compressible = compressible
+        # If not 0, the camera cycles between this many pictures, like a static scene.
+        self._pictures = [self._create_picture() for _ in range(distinct)]
+        self._taken = 0
+
+    def take_picture(self) -> bytes:
+        self._taken += 1
+        if len(self._pictures) > 0:
+            return self._pictures[self._taken % len(self._pictures)]
+        return self._create_picture()
+
+    def _create_picture(self) -> bytes:
+        size = self._size - DIGEST_SIZE
+        if self._compressible:
+            data = os.urandom(size // 4) + bytes(size - size // 4)
+        else:
+            data = os.urandom(size)
+        return hashlib.sha256(data).digest() + data
+
+
+class LossySocket(socket.socket):
+    """
+    A socket which drops some of the parts of images it sends (and nothing else),
+    as on a lossy link.
+    """
+
+    def __init__(self, loss_rate: float, fileno: int):
+        super().__init__(fileno=fileno)
+        self._loss_rate = loss_rate
+
+    def sendmsg(self, buffers, *args):
+        size = sum(len(buffer) for buffer in buffers)
+        if self._is_lost(size):
+            return size
+        return super().sendmsg(buffers, *args)
+
+    def sendto(self, data, *args):
+        if self._is_lost(len(data)):
+            return len(data)
+        return super().sendto(data, *args)
+
+    def _is_lost(self, size: int) -> bool:
+        # End markers are as long as a header, parts are longer.
+        return size > udp.IMAGE_HEADER.size and random.random() < self._loss_rate
+
+
+def is_intact(data) -> bool:
+    data = bytes(data)
+    return hashlib.sha256(data[DIGEST_SIZE:]).digest() == data[:DIGEST_SIZE]
+
+
+class MemoryWorkerStorage(worker_storage.QueuedStorage):
+
+    def _store(self, image: Image, sequence: int) -> Tuple:
+        return image.id, sequence, image
+
+    def _load(self, record: Tuple) -> Image:
+        return record[2]
+
+
+class MemoryMasterStorage(master_storage.Storage):
+
+    def store_image(self, client: Client, image: Image):
+        pass
+
+
+class RecordingStorage(master_storage.Storage):
+    """
+    Records when each image was stored and whether it arrived intact,
+    and passes it on to another storage.
+    """
+
+    def __init__(self, storage: master_storage.Storage):
+        self._storage = storage
+        self.records = []
+
+    def store_image(self, client: Client, image: Image):
+        # References to images we already have were checked when first received.
+        intact = isinstance(image, ReferenceImage) or is_intact(image.data)
+        # How long since the picture was taken, if we know when it was.
+        age = time.time() - image.timestamp if image.timestamp > 0 else None
+        self.records.append((client.id, image.id, len(image), time.perf_counter(), intact, age))
+        if age is not None:
+            # For the latencies of shards.
+            get_metrics().histogram('loopback.latency_sec').record(age)
+        if intact:
+            # Shards report their metrics back, but not their storage.
+            get_metrics().counter('loopback.intact_images').add()
+        self._storage.store_image(client, image)
+
+    def contains_digest(self, digest: bytes) -> bool:
+        return self._storage.contains_digest(digest)
+
+    def flush(self):
+        self._storage.flush()
+
+    def close(self):
+        self._storage.close()
+
+
+def _create_worker_storage(args: argparse.Namespace, path: Path) -> worker_storage.Storage:
+    if args.worker_storage == 'file':
+        return worker_storage.BasicFileSystemStorage(path)
+    if args.worker_storage == 'pack':
+        return worker_storage.PackFileStorage(path)
+    if args.worker_storage == 'journal':
+        return worker_storage.JournaledStorage(path, args.worker_quota, worker_storage.EvictionPolicy(args.eviction))
+    return MemoryWorkerStorage()
+
+
+def _create_master_storage(kind: str, path: Path, catalogue_path: Optional[Path] = None) -> master_storage.Storage:
+    storage = _create_uncatalogued_storage(kind, path)
+    if catalogue_path is not None:
+        # Every run of the benchmark has its own catalogue, with a single run.
+        storage = CataloguedStorage(storage, Catalogue(catalogue_path), CATALOGUE_RUN)
+    return storage
+
+
+def _create_uncatalogued_storage(kind: str, path: Path) -> master_storage.Storage:
+    if kind == 'file':
+        return master_storage.BasicFileSystemStorage(path)
+    if kind == 'write-behind':
+        return master_storage.WriteBehindStorage(master_storage.BasicFileSystemStorage(path))
+    if kind == 'pack':
+        return master_storage.PackFileStorage(path)
+    if kind == 'content':
+        return master_storage.ContentAddressedStorage(path)
+    return MemoryMasterStorage()
+
+
+def _create_shard_storage(kind: str, path: Path, catalogue_path: Optional[Path], index: int) \
+        -> master_storage.Storage:
+    return RecordingStorage(_create_master_storage(kind, path / 'shard-{}'.format(index), catalogue_path))
+
+
+def run_worker(port: int, master_address: Tuple[str, int], args: argparse.Namespace, path: Path,
+               connections: List = None):
+    if connections is None:
+        # Running in our own process, silence the per-command and per-part output.
+        sys.stdout = open(os.devnull, 'w')
+
+    storage = _create_worker_storage(args, path)
+    if args.tcp:
+        connection = WorkerTcpConnection.create(port, master_address, dedup=args.dedup,
+                                                send_buffer_size=args.sndbuf)
+    else:
+        skt = WorkerConnection._create_socket(port, args.sndbuf)
+        if args.loss > 0:
+            skt = LossySocket(args.loss, skt.detach())
+        connection = WorkerConnection(skt, master_address, reliable=args.reliable, dedup=args.dedup,
+                                      pacer=_create_pacer(args), fec_group_size=args.fec)
+    if connections is not None:
+        connections.append(connection)
+
+    worker = Worker(connection, storage, SyntheticCamera(args.size, args.distinct, args.compressible))
+    while True:
+        try:
+            worker.handle_next_command()
+        except OSError:
+            # The connection was closed, we are done.
+            break
+
+
+class _AsyncWorkers(object):
+    """
+    All the workers, as asyncio workers in a single event loop in a thread of its own.
+    """
+
+    def __init__(self, args: argparse.Namespace, path: Path):
+        self._loop = asyncio.new_event_loop()
+        self._connections = []
+        self._task = self._loop.create_task(self._run(args, path))
+        self._thread = threading.Thread(target=self._loop.run_until_complete, args=(self._task,), daemon=True)
+        self._thread.start()
+
+    def kill(self, count: int):
+        # The first count workers go away without a word, as if they went offline.
+        for connection in self._connections[:count]:
+            self._loop.call_soon_threadsafe(connection.close)
+
+    def close(self):
+        self._loop.call_soon_threadsafe(self._task.cancel)
+        self._thread.join()
+
+    async def _run(self, args: argparse.Namespace, path: Path):
+        master_address = (LOOPBACK, args.port)
+        connections = self._connections
+        workers = []
+        for i in range(args.workers):
+            connection = await AsyncWorkerConnection.create(args.port + 1 + i, master_address, reliable=args.reliable,
+                                                            pacer=_create_pacer(args), send_buffer_size=args.sndbuf,
+                                                            fec_group_size=args.fec)
+            connections.append(connection)
+            storage = _create_worker_storage(args, path / 'worker-{}'.format(i))
+            camera = SyntheticCamera(args.size, args.distinct, args.compressible)
+            workers.append(AsyncWorker(connection, storage, camera).run())
+
+        try:
+            await asyncio.gather(*workers)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            for connection in connections:
+                connection.close()
+
+
+def _create_pacer(args: argparse.Namespace) -> Optional[Pacer]:
+    rate = args.send_rate * 1024 * 1024 if args.send_rate > 0 else None
+    if args.adaptive_pacing:
+        return AdaptivePacer() if rate is None else AdaptivePacer(rate)
+    if rate is not None:
+        return Pacer(rate)
+    return None
+
+
+def _start_workers(args: argparse.Namespace, path: Path) -> Tuple[List, List[Tuple[str, int]], List]:
+    processes = []
+    connections = []
+    addresses = []
+    master_address = (LOOPBACK, args.port)
+    for i in range(args.workers):
+        port = args.port + 1 + i
+        addresses.append((LOOPBACK, port))
+        worker_path = path / 'worker-{}'.format(i)
+
+        if args.aio:
+            continue
+        if args.processes:
+            process = multiprocessing.Process(target=run_worker, args=(port, master_address, args, worker_path),
+                                              daemon=True)
+            process.start()
+            processes.append(process)
+        else:
+            threading.Thread(target=run_worker, args=(port, master_address, args, worker_path, connections),
+                             daemon=True).start()
+
+    if args.aio:
+        connections.append(_AsyncWorkers(args, path))
+
+    return processes, addresses, connections
+
+
+def _stop_workers(processes: List, connections: List):
+    # Worker threads are left blocked on their closed sockets, they are daemons.
+    for connection in connections:
+        connection.close()
+    for process in processes:
+        process.terminate()
+        process.join()
+
+
+def _kill_workers(count: int, processes: List, connections: List):
+    # The workers go away without a word, as if they went offline.
+    for connection in connections[:count]:
+        connection.close()
+    for process in processes[:count]:
+        process.terminate()
+
+
+def _percentile(values: List[float], percent: float) -> float:
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def _current_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def _run_master(args: argparse.Namespace, storage: master_storage.Storage, addresses: List[Tuple[str, int]],
+                path: Path, catalogue_path: Optional[Path], kill_workers: Callable[[], None]) -> Tuple:
+    connection_class = MasterTcpConnection if args.tcp else MasterConnection
+    create_connection = functools.partial(connection_class.create, clients_port=args.port + 1,
+                                          timeout=args.timeout, client_addresses=addresses,
+                                          compression=_compression_settings(args),
+                                          receive_buffer_size=args.rcvbuf)
+    shard_results = None
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), \
+            create_connection(args.port) as connection:
+        if args.shards > 0:
+            # The shards use the ports after the workers.
+            master = ShardedMaster(connection, create_connection,
+                                   functools.partial(_create_shard_storage, args.master_storage, path / 'master',
+                                                     catalogue_path),
+                                   args.shards, args.port + args.workers + 1)
+        else:
+            master = Master(connection, storage)
+
+        start = time.perf_counter()
+        master.discover_clients()
+        discovery_time = time.perf_counter() - start
+        # All the workers are known now, so this only pings them.
+        start = time.perf_counter()
+        master.discover_clients()
+        rediscovery_time = time.perf_counter() - start
+        if args.sync_clocks:
+            master.synchronize_clocks()
+        if args.dead_workers > 0:
+            kill_workers()
+
+        if args.stream_fps == 0:
+            for i in range(args.images):
+                master.take_picture(i, args.capture_delay)
+
+        start = time.perf_counter()
+        try:
+            if args.stream_fps > 0:
+                master.stream_pictures(args.stream_fps, args.stream_duration, args.stream_credits)
+            elif args.shards > 0:
+                shard_results = master.collect_pictures(concurrent=args.concurrent, stream=args.stream,
+                                                        pipeline_depth=args.pipeline)
+            else:
+                master.collect_pictures(concurrent=args.concurrent, stream=args.stream, pipeline_depth=args.pipeline)
+        except OSError as e:
+            print('Collection failed', e, file=sys.__stdout__)
+        collect_time = time.perf_counter() - start
+
+        if args.shards > 0:
+            master.close()
+
+    return master, discovery_time, rediscovery_time, start, collect_time, shard_results
+
+
+async def _run_async_master(args: argparse.Namespace, storage: master_storage.Storage,
+                            addresses: List[Tuple[str, int]], kill_workers: Callable[[], None]) -> Tuple:
+    connection = await AsyncMasterConnection.create(args.port, args.port + 1, timeout=args.timeout,
+                                                    client_addresses=addresses,
+                                                    compression=_compression_settings(args),
+                                                    receive_buffer_size=args.rcvbuf)
+    async with connection:
+        master = AsyncMaster(connection, storage)
+        start = time.perf_counter()
+        await master.discover_clients()
+        discovery_time = time.perf_counter() - start
+        start = time.perf_counter()
+        await master.discover_clients()
+        rediscovery_time = time.perf_counter() - start
+        if args.sync_clocks:
+            await master.synchronize_clocks()
+        if args.dead_workers > 0:
+            kill_workers()
+
+        for i in range(args.images):
+            master.take_picture(i, args.capture_delay)
+
+        start = time.perf_counter()
+        failed = await master.collect_pictures(stream=args.stream, pipeline_depth=args.pipeline)
+        collect_time = time.perf_counter() - start
+        if len(failed) > 0:
+            print('Collection failed for workers', failed, file=sys.__stdout__)
+
+    return master, discovery_time, rediscovery_time, start, collect_time
+
+
+def _compression_settings(args: argparse.Namespace) -> CompressionSettings:
+    return CompressionSettings(Codec[args.compression.upper()], args.level, not args.no_adaptive)
+
+
+def run(args: argparse.Namespace) -> dict:
+    if args.metrics:
+        # Workers in their own processes report to their own metrics, which we don't see.
+        set_metrics(Metrics())
+
+    path = Path(tempfile.mkdtemp(prefix='loopback-'))
+    try:
+        return _run(args, path)
+    finally:
+        shutil.rmtree(str(path), ignore_errors=True)
+
+
+def _run(args: argparse.Namespace, path: Path) -> dict:
+    processes, addresses, connections = _start_workers(args, path)
+    # Give the workers a moment to bind their sockets.
+    time.sleep(0.5)
+
+    catalogue_path = path / 'catalogue.sqlite' if args.catalogue else None
+    storage = RecordingStorage(_create_master_storage(args.master_storage, path / 'master', catalogue_path))
+    shard_results = None
+    if args.aio:
+        kill_workers = functools.partial(connections[0].kill, args.dead_workers)
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            master, discovery_time, rediscovery_time, start, collect_time = \
+                asyncio.run(_run_async_master(args, storage, addresses, kill_workers))
+    else:
+        kill_workers = functools.partial(_kill_workers, args.dead_workers, processes, connections)
+        master, discovery_time, rediscovery_time, start, collect_time, shard_results = \
+            _run_master(args, storage, addresses, path, catalogue_path, kill_workers)
+    discovered = len(master.clients)
+
+    storage.close()
+    _stop_workers(processes, connections)
+
+    if shard_results is None:
+        # Latency of each image is its age when stored, so for pictures collected after
+        # they were all taken, it includes waiting for the collection to get to them.
+        latencies = [age for client_id, image_id, size, stored_time, intact, age in storage.records
+                     if age is not None]
+        latency_percentiles = {percent: _percentile(latencies, percent) for percent in (50, 90, 99, 100)}
+        received_count = len(storage.records)
+        received_bytes = sum(record[2] for record in storage.records)
+        intact_count = sum(1 for record in storage.records if record[4])
+    else:
+        # Shards only send back their metrics, so the latencies are of the slowest shard.
+        shard_latencies = [result['metrics'].get('loopback.latency_sec') for result in shard_results]
+        shard_latencies = [snapshot for snapshot in shard_latencies if snapshot is not None]
+        latency_percentiles = {}
+        for percent, name in ((50, 'p50'), (90, 'p90'), (99, 'p99'), (100, 'max')):
+            latency_percentiles[percent] = max((snapshot[name] or 0.0 for snapshot in shard_latencies), default=0.0)
+        received_count = sum(result['images'] for result in shard_results)
+        received_bytes = sum(result['bytes'] for result in shard_results)
+        intact_count = sum(result['metrics'].get('loopback.intact_images', 0) for result in shard_results)
+
+    catalogued_count = None
+    if catalogue_path is not None:
+        with Catalogue(catalogue_path) as catalogue:
+            catalogued_count = catalogue.summarize_run(CATALOGUE_RUN).image_count
+
+    expected = (args.workers - args.dead_workers) * args.images
+    if args.stream_fps > 0:
+        expected = int(args.workers * args.stream_fps * args.stream_duration)
+    # How far apart the workers took each picture.
+    skews = list(master.capture_skew().values())
+
+    result = {
+        'commit': _current_commit(),
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'workers': args.workers,
+        'images': args.images,
+        'size': args.size,
+        'reliable': args.reliable,
+        'tcp': args.tcp,
+        'concurrent': args.concurrent,
+        'stream': args.stream,
+        'pipeline': args.pipeline,
+        'dedup': args.dedup,
+        'distinct': args.distinct,
+        'compressible': args.compressible,
+        'compression': args.compression,
+        'level': args.level,
+        'adaptive': not args.no_adaptive,
+        'processes': args.processes,
+        'worker_storage': args.worker_storage,
+        'worker_quota': args.worker_quota,
+        'eviction': args.eviction,
+        'master_storage': args.master_storage,
+        'shards': args.shards,
+        'send_rate': args.send_rate,
+        'adaptive_pacing': args.adaptive_pacing,
+        'rcvbuf': args.rcvbuf,
+        'sndbuf': args.sndbuf,
+        'aio': args.aio,
+        'dead_workers': args.dead_workers,
+        'fec': args.fec,
+        'loss': args.loss,
+        'discovered': discovered,
+        'discovery_sec': discovery_time,
+        'rediscovery_sec': rediscovery_time,
+        'collect_sec': collect_time,
+        'throughput_mb_sec': received_bytes / (1024 * 1024) / collect_time if collect_time > 0 else 0.0,
+        'latency_p50_ms': latency_percentiles[50] * 1000,
+        'latency_p90_ms': latency_percentiles[90] * 1000,
+        'latency_p99_ms': latency_percentiles[99] * 1000,
+        'latency_max_ms': latency_percentiles[100] * 1000,
+        'stream_fps': args.stream_fps,
+        'stream_duration': args.stream_duration,
+        'stream_credits': args.stream_credits,
+        'sync_clocks': args.sync_clocks,
+        'capture_delay': args.capture_delay,
+        'skew_p50_ms': _percentile(skews, 50) * 1000,
+        'skew_p99_ms': _percentile(skews, 99) * 1000,
+        'skew_max_ms': max(skews, default=0.0) * 1000,
+        'expected_images': expected,
+        'received_images': received_count,
+        'intact_images': intact_count,
+        'catalogued_images': catalogued_count,
+        'loss_rate': 1 - intact_count / expected if expected > 0 else 0.0,
+    }
+    if args.metrics:
+        result['metrics'] = get_metrics().snapshot()
+    if shard_results is not None:
+        result['shard_results'] = [{name: value for name, value in shard_result.items() if name != 'metrics'}
+                                   for shard_result in shard_results]
+
+    return result
+
+
+def _parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Loopback load test of the master and workers')
+    parser.add_argument('--workers', type=int, default=4, help='amount of simulated workers')
+    parser.add_argument('--images', type=int, default=5, help='pictures taken by each worker')
+    parser.add_argument('--size', type=int, default=1024 * 1024, help='size of each picture in bytes')
+    parser.add_argument('--distinct', type=int, default=0,
+                        help='if not 0, each worker cycles between this many distinct pictures')
+    parser.add_argument('--compressible', action='store_true', help='take pictures which compress well')
+    parser.add_argument('--compression', choices=[codec.name.lower() for codec in Codec], default='none',
+                        help='codec workers should compress pictures with')
+    parser.add_argument('--level', type=int, default=6, help='compression level')
+    parser.add_argument('--no-adaptive', action='store_true',
+                        help='compress every picture, even if it does not pay off')
+    parser.add_argument('--port', type=int, default=30000,
+                        help='master port, workers use the ports following it')
+    parser.add_argument('--timeout', type=float, default=1.0, help='master socket timeout in seconds')
+    parser.add_argument('--reliable', action='store_true', help='use reliable transfers')
+    parser.add_argument('--tcp', action='store_true', help='send pictures over TCP connections')
+    parser.add_argument('--dedup', action='store_true', help='offer image digests before sending images')
+    parser.add_argument('--concurrent', action='store_true', help='collect from all workers at once')
+    parser.add_argument('--stream', action='store_true', help='ask each worker for all its images at once')
+    parser.add_argument('--pipeline', type=int, default=1,
+                        help='requests for the next image in flight to each worker, when collecting concurrently')
+    parser.add_argument('--processes', action='store_true', help='run each worker in its own process')
+    parser.add_argument('--worker-storage', choices=['memory', 'file', 'pack', 'journal'], default='memory')
+    parser.add_argument('--worker-quota', type=int, default=None,
+                        help='bytes of images each worker keeps, with the journal worker storage')
+    parser.add_argument('--eviction', choices=[policy.value for policy in worker_storage.EvictionPolicy],
+                        default=worker_storage.EvictionPolicy.OLDEST_FIRST.value,
+                        help='which images a worker over its quota evicts')
+    parser.add_argument('--master-storage', choices=['memory', 'file', 'write-behind', 'pack', 'content'],
+                        default='memory')
+    parser.add_argument('--stream-fps', type=float, default=0.0,
+                        help='if not 0, workers stream pictures at this frame rate instead of being collected')
+    parser.add_argument('--stream-duration', type=float, default=2.0, help='how long to stream in seconds')
+    parser.add_argument('--stream-credits', type=int, default=8,
+                        help='frames each worker may stream ahead of what was stored')
+    parser.add_argument('--sync-clocks', action='store_true', help='synchronize the clocks of the workers')
+    parser.add_argument('--capture-delay', type=float, default=0.0,
+                        help='if not 0, workers take each picture this many seconds after asked to')
+    parser.add_argument('--shards', type=int, default=0,
+                        help='if not 0, collect with a sharded master of this many processes')
+    parser.add_argument('--send-rate', type=float, default=0.0,
+                        help='if not 0, each worker sends at up to this many MB/s (UDP only)')
+    parser.add_argument('--adaptive-pacing', action='store_true',
+                        help='adapt the send rate of each worker to the loss reported (with --reliable)')
+    # Without reliable transfers, a part which doesn't fit in the receive buffer is lost for good,
+    # and the kernel's default buffer can't even hold a single picture of a few MB.
+    parser.add_argument('--rcvbuf', type=int, default=DEFAULT_RECEIVE_BUFFER_SIZE,
+                        help='receive buffer size of the master sockets, it should hold at least a picture '
+                             '(capped by net.core.rmem_max on Linux)')
+    parser.add_argument('--sndbuf', type=int, default=None, help='send buffer size of the worker sockets')
+    parser.add_argument('--catalogue', action='store_true', help='record the collected images in a catalogue')
+    parser.add_argument('--aio', action='store_true',
+                        help='run the master and the workers (all in one thread) on asyncio, collecting concurrently')
+    parser.add_argument('--dead-workers', type=int, default=0,
+                        help='workers which go offline after discovery, before the pictures are taken')
+    parser.add_argument('--fec', type=int, default=0,
+                        help='send a parity after each group of this many parts (0 for none)')
+    parser.add_argument('--loss', type=float, default=0.0,
+                        help='fraction of the parts of images the workers lose, as on a lossy link')
+    parser.add_argument('--metrics', action='store_true', help='collect metrics and add them to the results')
+    parser.add_argument('--output', type=Path, default=Path('bench_output.txt'),
+                        help='file to append the results to, as JSON lines')
+    args = parser.parse_args(argv)
+    if args.stream_fps > 0 and args.shards > 0:
+        parser.error('streaming is not supported by the sharded master')
+    if args.aio and (args.tcp or args.dedup or args.processes or args.shards > 0 or args.stream_fps > 0):
+        parser.error('the asyncio master and workers only support collecting over UDP, without dedup')
+    if args.dead_workers > 0 and (args.stream_fps > 0 or args.dead_workers > args.workers):
+        parser.error('only some of the workers may go offline, and not while streaming')
+    if args.loss > 0 and (args.aio or args.tcp):
+        parser.error('losing parts is only simulated for UDP workers which are not on asyncio')
+    return args
+
+
+def main(argv=None):
+    args = _parse_args(argv)
+    result = run(args)
+    if result['expected_images'] > 0 and result['received_images'] == 0:
+        # Nothing to measure, most likely every picture overflowed the receive buffer.
+        sys.exit('no images were collected, try --reliable or a bigger --rcvbuf')
+
+    print('discovered {discovered}/{workers} workers in {discovery_sec:.3f} s, '
+          'again in {rediscovery_sec:.3f} s'.format(**result))
+    print('collected {received_images}/{expected_images} images ({intact_images} intact) '
+          'in {collect_sec:.3f} s, {throughput_mb_sec:.2f} MB/s'.format(**result))
+    print('latency ms: p50 {latency_p50_ms:.2f} p90 {latency_p90_ms:.2f} p99 {latency_p99_ms:.2f} '
+          'max {latency_max_ms:.2f}'.format(**result))
+    print('loss rate: {loss_rate:.2%}'.format(**result))
+    if result['catalogued_images'] is not None:
+        print('catalogued {catalogued_images} images'.format(**result))
+    print('capture skew ms: p50 {skew_p50_ms:.3f} p99 {skew_p99_ms:.3f} max {skew_max_ms:.3f}'.format(**result))
+    for shard_result in result.get('shard_results', []):
+        print('shard {shard}: {clients} workers, {images} images in {collect_sec:.3f} s'.format(**shard_result))
+    for name, value in sorted(result.get('metrics', {}).items()):
+        print(name, value)
+
+    with args.output.open(mode='a') as f:
+        f.write(json.dumps(result) + '\n')
+
+
+if __name__ == '__main__':
+    main()
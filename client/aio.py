@@ -0,0 +1,464 @@
+"""
+asyncio versions of the client's connection and of the Client, so commands are
+handled while pictures are taken and sent, and many clients may share a single
+thread (e.g. simulated workers).
+
+The protocol is the same as with client.connection.UdpConnection, so the server
+can't tell the difference.
+"""
+from concurrent.futures import Executor
+from typing import Optional, Tuple, List, Set
+
+import asyncio
+import time
+
+from client.camera import Camera
+from client.capture import capture_image
+from client.client import COMMAND_HANDLERS, FrameSchedule, record_command, requeue_unacknowledged, \
+    requeue_unsent, next_image_to_send, record_image_sent
+from client.connection import UdpConnection, pack_register, unpack_register_reply
+from client.storage import Storage
+from common.clock import Clock
+from common.command import CommandType, CommandParams, MAX_COMMAND_SIZE, TakePictureParams, AssignShardParams, \
+    SyncClockParams, ClockOffsetParams, StreamParams, CreditParams, AcknowledgeParams, ResumeParams, NO_REQUEST_ID, \
+    unpack_request
+from common.compression import Codec, CompressionSettings, Compressor
+from common.data import REGISTER_ID, PING_RESPONSE, CLOCK_RESPONSE, CLOCK_TIMES, SHARD_RESPONSE, SHARD_PORT, \
+    pack_reply
+from common.image import Image
+from common.metrics import get_metrics
+from common.pacing import Pacer
+from common import udp
+
+
+class AsyncConnection(asyncio.DatagramProtocol):
+    """
+    The client's UDP socket, as an asyncio protocol. Commands wait in a queue until
+    asked for, and replies to transfers go to the transfer in progress.
+    Images are not deduplicated (see UdpConnection), so are always sent whole.
+    """
+
+    def __init__(self, address: Tuple[str, int], reliable: bool = False, pacer: Optional[Pacer] = None,
+                 fec_group_size: int = 0):
+        self._transport: Optional[asyncio.DatagramTransport] = None
+        self._address = address
+        # Where images are sent (the server may move it elsewhere), and where the last command came from.
+        self._image_address = address
+        self._command_address = address
+        self._command_time = 0.0
+        self._reliable = reliable
+        self._pacer = pacer
+        self._fec_group_size = fec_group_size
+        self._compressor = Compressor(CompressionSettings(Codec.NONE))
+
+        self._commands = asyncio.Queue()
+        self._transfer_replies = asyncio.Queue()
+        # While registering, the reply of the server.
+        self._register_reply: Optional[asyncio.Future] = None
+        # Cleared while the transport's buffer is full, see pause_writing.
+        self._can_send = asyncio.Event()
+        self._can_send.set()
+        # Only one transfer at a time gets the transfer replies.
+        self._transfer_lock = asyncio.Lock()
+
+    def connection_made(self, transport: asyncio.DatagramTransport):
+        self._transport = transport
+
+    def datagram_received(self, data: bytes, address: Tuple):
+        if udp.is_transfer_reply(data):
+            if self._reliable:
+                self._transfer_replies.put_nowait(data)
+        elif self._register_reply is not None and not self._register_reply.done():
+            self._register_reply.set_result(data)
+        elif len(data) <= MAX_COMMAND_SIZE:
+            # Stamped as it arrives, as it may wait in the queue (e.g. for a clock sync).
+            self._commands.put_nowait((data, address, time.time()))
+
+    def error_received(self, exc: Exception):
+        # E.g. the server is not up yet, the transfer will time out.
+        get_metrics().counter('worker.socket_errors').add()
+
+    def pause_writing(self):
+        self._can_send.clear()
+
+    def resume_writing(self):
+        self._can_send.set()
+
+    async def wait_for_command(self, timeout: Optional[float] = None) \
+            -> Optional[Tuple[CommandType, Optional[CommandParams], int]]:
+        # With a timeout, returns None if no command arrived in time.
+        try:
+            data, self._command_address, self._command_time = await asyncio.wait_for(self._commands.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        return unpack_request(data)
+
+    @property
+    def command_time(self) -> float:
+        # When the last command arrived.
+        return self._command_time
+
+    async def send_register(self, request_id: int = NO_REQUEST_ID) -> int:
+        self._undo_redirect()
+        self._register_reply = asyncio.get_running_loop().create_future()
+        try:
+            self._transport.sendto(pack_register(request_id), self._address)
+            data = await self._register_reply
+        finally:
+            self._register_reply = None
+
+        client_id, compressor = unpack_register_reply(data)
+        if compressor is not None:
+            self._compressor = compressor
+        return client_id
+
+    def send_ping_response(self, client_id: int, request_id: int = NO_REQUEST_ID):
+        self._undo_redirect()
+        data = pack_reply(PING_RESPONSE + REGISTER_ID.pack(client_id), request_id)
+        self._transport.sendto(data, self._command_address)
+
+    def send_clock_reply(self, server_time: float, received_time: float, request_id: int = NO_REQUEST_ID):
+        data = CLOCK_RESPONSE + CLOCK_TIMES.pack(server_time, received_time, time.time())
+        self._transport.sendto(pack_reply(data, request_id), self._address)
+
+    def redirect_images(self, port: int, request_id: int = NO_REQUEST_ID):
+        self._image_address = (self._address[0], port)
+        data = pack_reply(SHARD_RESPONSE + SHARD_PORT.pack(port), request_id)
+        self._transport.sendto(data, self._command_address)
+
+    async def send_image(self, sender_id: int, image: Image):
+        codec, image = self._compressor.compress_image(image)
+        if self._reliable:
+            await self._send_reliable(udp.ReliableTransfer(sender_id, image, codec=codec,
+                                                           fec_group_size=self._fec_group_size))
+        else:
+            for datagram in udp.pack_parts(sender_id, image, codec, fec_group_size=self._fec_group_size):
+                await self._send_datagram(datagram)
+
+    async def resend_parts(self, sender_id: int, image: Image, indexes: List[int]):
+        # The parts must be of the image as it was sent, so it is compressed again the same way.
+        codec, image = self._compressor.compress_image(image)
+        for datagram in udp.pack_parts(sender_id, image, codec, indexes):
+            await self._send_datagram(datagram)
+        get_metrics().counter('udp.resumed_parts').add(len(indexes))
+
+    async def send_no_image(self, sender_id: int, request_id: int = NO_REQUEST_ID):
+        if self._reliable:
+            await self._send_reliable(udp.ReliableTransfer(sender_id, None, request_id=request_id))
+        else:
+            await self._send_datagram([udp.pack_no_image(sender_id, request_id)])
+
+    def close(self):
+        if self._transport is not None:
+            self._transport.close()
+
+    async def _send_reliable(self, transfer: udp.ReliableTransfer,
+                             ack_timeout: float = udp.DEFAULT_ACK_TIMEOUT,
+                             max_retries: int = udp.DEFAULT_MAX_RETRIES):
+        # Sends bursts of the transfer, as the reports of the server allow, probing it when
+        # the reports stop. Raises asyncio.TimeoutError if the server stops answering.
+        async with self._transfer_lock:
+            retries = 0
+            while not transfer.is_complete:
+                for datagram in transfer.next_burst():
+                    await self._send_datagram(datagram)
+
+                while True:
+                    try:
+                        data = await asyncio.wait_for(self._transfer_replies.get(), ack_timeout)
+                    except asyncio.TimeoutError:
+                        retries += 1
+                        if retries > max_retries:
+                            get_metrics().counter('udp.transfer_failures').add()
+                            raise
+
+                        get_metrics().counter('udp.probes').add()
+                        if self._pacer is not None:
+                            self._pacer.on_feedback(1, 1)
+                        await self._send_datagram(transfer.probe())
+                        continue
+
+                    if udp.is_status(data) and transfer.handle_status(data):
+                        if self._pacer is not None:
+                            self._pacer.on_feedback(*transfer.last_report)
+                        retries = 0
+                        break
+
+    def _undo_redirect(self):
+        # The server itself discovering us means it isn't sharded (anymore), while the
+        # heartbeats of its shards come from their own ports.
+        if self._command_address[1] == self._address[1]:
+            self._image_address = self._address
+
+    async def _send_datagram(self, buffers: List):
+        size = sum(len(buffer) for buffer in buffers)
+        if self._pacer is not None:
+            delay = self._pacer.delay(size)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        # Don't pile datagrams up in the transport while the kernel can't take them.
+        await self._can_send.wait()
+        self._transport.sendto(b''.join(buffers), self._image_address)
+
+        metrics = get_metrics()
+        if metrics.enabled:
+            metrics.counter('udp.datagrams_sent').add()
+            metrics.counter('udp.bytes_sent').add(size)
+
+    @staticmethod
+    async def create(local_port: int, server_address: Tuple[str, int], reliable: bool = False,
+                     pacer: Optional[Pacer] = None, send_buffer_size: Optional[int] = None,
+                     receive_buffer_size: Optional[int] = None, fec_group_size: int = 0) -> 'AsyncConnection':
+        skt = UdpConnection._create_socket(local_port, send_buffer_size, receive_buffer_size)
+        connection = AsyncConnection(server_address, reliable, pacer, fec_group_size)
+        await asyncio.get_running_loop().create_datagram_endpoint(lambda: connection, sock=skt)
+        return connection
+
+
+class AsyncClient(object):
+    """
+    Like client.client.Client, over an AsyncConnection. Pictures are taken, sent and streamed
+    by tasks of their own, so commands are handled meanwhile (e.g. acknowledgements and
+    credit while sending all the pictures). Requests for pictures are sent one after the
+    other, in the order they arrived, so the end marker answering one comes after the
+    pictures sent for those before it.
+    The camera and the storage are used on the executor (the loop's default if not given),
+    so they don't hold up the event loop. The storage must be safe to use from several threads.
+    """
+
+    def __init__(self, connection: AsyncConnection, storage: Storage, camera: Camera,
+                 clock: Optional[Clock] = None, executor: Optional[Executor] = None):
+        self._connection = connection
+        self._storage = storage
+        self._camera = camera
+        self._clock = clock if clock is not None else Clock()
+        self._executor = executor
+        self._command_handlers = {command: getattr(self, name) for command, name in COMMAND_HANDLERS.items()}
+
+        self._id = -1
+        self._received_time = 0.0
+        # The id of the request being handled. Commands are handled one at a time,
+        # tasks started for a request are given its id.
+        self._request_id = NO_REQUEST_ID
+        self._stop_request_id = NO_REQUEST_ID
+
+        # The camera is used by one picture at a time, and pictures are sent one request at a time.
+        self._camera_lock = asyncio.Lock()
+        self._send_lock = asyncio.Lock()
+        # Pictures being taken and sent, and the stream (if any), run as tasks.
+        self._tasks: Set[asyncio.Task] = set()
+        self._captures: Set[asyncio.Task] = set()
+        self._streaming = False
+        self._frame_schedule = FrameSchedule()
+
+    async def run(self):
+        # Handles commands until cancelled.
+        try:
+            while True:
+                await self.handle_next_command()
+        finally:
+            for task in self._tasks:
+                task.cancel()
+
+    async def handle_next_command(self, timeout: Optional[float] = None):
+        """
+        Waits for the next command and handles it. Handling only starts the tasks of
+        commands which take a while (taking, sending and streaming pictures), so this
+        returns without waiting for them.
+        With a timeout, returns without handling anything if no command arrived in time.
+        """
+        command_and_params = await self._connection.wait_for_command(timeout)
+        if command_and_params is None:
+            return
+
+        command, params, self._request_id = command_and_params
+        # For clock syncs, when the command arrived (not when we got to it).
+        self._received_time = self._connection.command_time
+        record_command(command, params)
+
+        handler = self._command_handlers[command]
+        if params is None:
+            await handler()
+        else:
+            # noinspection PyArgumentList
+            await handler(params)
+
+    async def _register_to_server(self):
+        print('Register request')
+        self._id = await self._connection.send_register(self._request_id)
+        print('New ID:', self._id)
+
+    async def _answer_ping(self):
+        if self._id == -1:
+            # We aren't registered yet, so we register instead.
+            await self._register_to_server()
+        else:
+            self._connection.send_ping_response(self._id, self._request_id)
+
+    async def _assign_shard(self, params: AssignShardParams):
+        print('Sending images to port', params.port)
+        self._connection.redirect_images(params.port, self._request_id)
+
+    async def _sync_clock(self, params: SyncClockParams):
+        self._connection.send_clock_reply(params.server_time, self._received_time, self._request_id)
+
+    async def _set_clock_offset(self, params: ClockOffsetParams):
+        print('Clock offset:', params.offset)
+        self._clock.set_offset(params.offset)
+
+    async def _start_stream(self, params: StreamParams):
+        if not self._frame_schedule.set_rate(params):
+            if not self._streaming:
+                # The marker tells the server there is no stream.
+                self._start_send(self._connection.send_no_image(self._id, self._request_id))
+            return
+
+        if not self._streaming:
+            self._streaming = True
+            self._start_task(self._stream(params.first_id))
+
+    async def _add_credit(self, params: CreditParams):
+        self._frame_schedule.add_credit(params.limit)
+
+    async def _stop_stream(self):
+        self._streaming = False
+        self._stop_request_id = self._request_id
+
+    async def _stream(self, first_id: int):
+        # Frames are taken on time and sent as they are taken, until we are told to stop.
+        frame_id = first_id
+        next_frame_time = time.time()
+        while self._streaming:
+            now = time.time()
+            if now < next_frame_time:
+                await asyncio.sleep(next_frame_time - now)
+                continue
+
+            if self._frame_schedule.may_take(frame_id):
+                image = await self._capture(frame_id)
+                await self._send_picture(image)
+                frame_id += 1
+            next_frame_time = self._frame_schedule.next_frame_time(next_frame_time)
+
+        # The marker answers the request to stop.
+        await self._connection.send_no_image(self._id, self._stop_request_id)
+        get_metrics().trace('worker.stream_stopped', frames=frame_id - first_id, first_id=first_id)
+
+    async def _take_picture(self, params: TakePictureParams):
+        # The picture is taken and stored in the background, like with a capture pipeline.
+        task = self._start_task(self._capture_and_store(params.picture_id, params.capture_time))
+        self._captures.add(task)
+        task.add_done_callback(self._captures.discard)
+
+    async def _capture_and_store(self, image_id: int, capture_time: float):
+        if capture_time > 0:
+            # Sleep until just before the time, and leave the last moment to capture_image.
+            await asyncio.sleep(max(0.0, self._clock.to_local(capture_time) - time.time() - 0.01))
+        image = await self._capture(image_id, capture_time)
+        await self._run_blocking(self._storage.store_image, image)
+
+    async def _send_next_picture(self):
+        self._start_send(self._send_next(self._request_id))
+
+    async def _send_all_pictures(self):
+        self._start_send(self._send_all(self._request_id))
+
+    async def _acknowledge_picture(self, params: AcknowledgeParams):
+        # The server has the picture, we may forget it.
+        self._storage.acknowledge(params.picture_id)
+
+    async def _resume_picture(self, params: ResumeParams):
+        self._start_send(self._resume(params))
+
+    async def _send_next(self, request_id: int):
+        await self._wait_for_captures()
+        next_picture = await self._run_blocking(next_image_to_send, self._storage)
+        if next_picture is None:
+            get_metrics().trace('worker.no_more_images')
+            await self._connection.send_no_image(self._id, request_id)
+        elif not await self._send_picture(next_picture):
+            await self._give_up_sending(next_picture, request_id)
+
+    async def _send_all(self, request_id: int):
+        # The images are sent one after the other, and then no-image so the server knows we're done.
+        # Images the server didn't acknowledge the last time are sent again.
+        await self._wait_for_captures()
+        await self._run_blocking(requeue_unacknowledged, self._storage)
+        sent_count = 0
+        while True:
+            next_picture = await self._run_blocking(self._storage.retrieve_next_image)
+            if next_picture is None:
+                break
+
+            if not await self._send_picture(next_picture):
+                # The rest would time out as well.
+                await self._give_up_sending(next_picture, request_id)
+                return
+            sent_count += 1
+
+        await self._connection.send_no_image(self._id, request_id)
+        get_metrics().trace('worker.sent_all_images', count=sent_count)
+
+    async def _resume(self, params: ResumeParams):
+        image = await self._run_blocking(self._storage.retrieve_unacknowledged, params.picture_id)
+        if image is None:
+            print('Cannot resume picture', params.picture_id)
+            return
+
+        await self._connection.resend_parts(self._id, image, params.missing)
+        get_metrics().counter('worker.resumed_images').add()
+
+    async def _send_picture(self, image: Image) -> bool:
+        # Returns False if the server stopped answering.
+        started = time.perf_counter()
+        try:
+            await self._connection.send_image(self._id, image)
+        except asyncio.TimeoutError:
+            print('Timed out sending picture', image.id)
+            get_metrics().counter('worker.send_timeouts').add()
+            return False
+
+        record_image_sent(image, started)
+        return True
+
+    async def _give_up_sending(self, image: Image, request_id: int):
+        # The image is not acknowledged, so it is put back to be sent first the next time,
+        # and the end marker answers the request, so the server doesn't wait for the rest.
+        await self._run_blocking(requeue_unsent, self._storage, image)
+        try:
+            await self._connection.send_no_image(self._id, request_id)
+        except asyncio.TimeoutError:
+            # The server is not there, it times the request out by itself.
+            get_metrics().counter('worker.send_timeouts').add()
+
+    async def _wait_for_captures(self):
+        # Pictures asked for before the images are sent are sent with them, as if taken
+        # before handling the next command (like Client does).
+        if len(self._captures) > 0:
+            await asyncio.wait(list(self._captures))
+
+    async def _capture(self, image_id: int, capture_time: float = 0.0) -> Image:
+        async with self._camera_lock:
+            return await self._run_blocking(capture_image, self._camera, self._clock, image_id, capture_time)
+
+    def _start_send(self, coroutine):
+        # Sends for the requests are done in the order the requests arrived.
+        async def send():
+            try:
+                async with self._send_lock:
+                    await coroutine
+            finally:
+                # Not awaited if cancelled while waiting for the others.
+                coroutine.close()
+
+        self._start_task(send())
+
+    def _start_task(self, coroutine) -> asyncio.Task:
+        # Tasks are kept until done, so they aren't collected while running.
+        task = asyncio.get_running_loop().create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _run_blocking(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
@@ -1,4 +1,5 @@
 from abc import ABC, abstractmethod
+from pathlib import Path
 
 import random
 
@@ -17,17 +18,20 @@ class Camera(ABC):
 
 
 class StubCamera(Camera):
+    DEFAULT_PARENT = Path('/home/tomtzook/Pictures/')
+    DEFAULT_IMAGES = [
+        'menu-1.png',
+        'menu3.1.png',
+        'menu22.3.png'
+    ]
+
+    def __init__(self, parent: Path = DEFAULT_PARENT, images=None):
+        self._parent = parent
+        self._images = images if images is not None else self.DEFAULT_IMAGES
 
     def take_picture(self) -> bytes:
-        images = [
-            'menu-1.png',
-            'menu3.1.png',
-            'menu22.3.png'
-        ]
-        parent = '/home/tomtzook/Pictures/'
-
-        image = random.choice(images)
-        with open(parent + image, mode='rb') as f:
+        image = random.choice(self._images)
+        with (self._parent / image).open(mode='rb') as f:
             return f.read()
 
     def __enter__(self):
@@ -0,0 +1,183 @@
+from typing import Optional
+
+import enum
+import queue
+import threading
+import time
+
+from client.camera import Camera
+from client.storage import Storage
+from common.clock import Clock, wait_until
+from common.image import Image
+from common.metrics import get_metrics
+
+
+class QueuePolicy(enum.Enum):
+    # Wait until there is room in the queue, slowing down whoever puts into it.
+    BLOCK = 'block'
+    # Drop the new item.
+    DROP_NEWEST = 'drop-newest'
+    # Drop the oldest item in the queue to make room for the new one.
+    DROP_OLDEST = 'drop-oldest'
+
+
+def capture_image(camera: Camera, clock: Clock, image_id: int, capture_time: float = 0.0) -> Image:
+    """
+    Takes a picture at capture_time by the server's clock (or right away if 0).
+    The image is stamped with when it was actually taken, by the server's clock.
+    """
+    if capture_time > 0:
+        wait_until(clock.to_local(capture_time))
+
+    taken_time = time.time()
+    data = camera.take_picture()
+
+    metrics = get_metrics()
+    metrics.histogram('worker.capture_sec').record(time.time() - taken_time)
+    if capture_time > 0:
+        metrics.histogram('worker.capture_lateness_sec').record(clock.to_server(taken_time) - capture_time)
+    return Image(image_id, data, clock.to_server(taken_time))
+
+
+class CapturePipeline(object):
+    """
+    Takes and stores pictures in the background, so handling of commands
+    does not wait for the camera or the disk.
+
+    Capture requests go through a bounded queue to a single capture thread (the
+    camera is used by one thread only). Captured images go through another bounded
+    queue to a pool of threads which store them.
+    What happens when a queue is full is decided by the queue policy. By default
+    new pictures are dropped, as blocking would hold up the handling of commands
+    (and BLOCK is only for callers which would rather wait than lose pictures).
+    """
+
+    # Put in the queues to stop the threads
+    _STOP = object()
+
+    def __init__(self, camera: Camera, storage: Storage,
+                 queue_size: int = 8, store_workers: int = 2,
+                 policy: QueuePolicy = QueuePolicy.DROP_NEWEST, clock: Optional[Clock] = None):
+        self._camera = camera
+        # Scheduled captures are by the server's clock.
+        self._clock = clock if clock is not None else Clock()
+        self._storage = storage
+        self._policy = policy
+        self._store_workers_count = store_workers
+
+        self._capture_requests = queue.Queue(maxsize=queue_size)
+        self._captured_images = queue.Queue(maxsize=queue_size)
+
+        self._capture_thread = None
+        self._store_threads = []
+
+        self._dropped_lock = threading.Lock()
+        self._dropped_count = 0
+
+    @property
+    def dropped_count(self) -> int:
+        with self._dropped_lock:
+            return self._dropped_count
+
+    @property
+    def pending_count(self) -> int:
+        return self._capture_requests.qsize() + self._captured_images.qsize()
+
+    def start(self):
+        self._capture_thread = threading.Thread(target=self._capture_loop, name='capture', daemon=True)
+        self._capture_thread.start()
+
+        for i in range(self._store_workers_count):
+            thread = threading.Thread(target=self._store_loop, name='store-{}'.format(i), daemon=True)
+            thread.start()
+            self._store_threads.append(thread)
+
+    def request_capture(self, image_id: int, capture_time: float = 0.0) -> bool:
+        """
+        Asks for a picture to be taken, at capture_time by the server's clock
+        (or right away if 0). Returns False if the request was dropped.
+        """
+        return self._put(self._capture_requests, (image_id, capture_time))
+
+    def close(self):
+        # Let everything already queued finish, and stop the threads.
+        if self._capture_thread is not None:
+            self._capture_requests.put(self._STOP)
+            self._capture_thread.join()
+            self._capture_thread = None
+
+        for _ in self._store_threads:
+            self._captured_images.put(self._STOP)
+        for thread in self._store_threads:
+            thread.join()
+        self._store_threads = []
+
+    def _capture_loop(self):
+        while True:
+            request = self._capture_requests.get()
+            if request is self._STOP:
+                break
+
+            image_id, capture_time = request
+            try:
+                image = capture_image(self._camera, self._clock, image_id, capture_time)
+            except Exception as e:
+                print('Failed taking picture', image_id, e)
+                continue
+
+            self._put(self._captured_images, image)
+
+    def _store_loop(self):
+        while True:
+            image = self._captured_images.get()
+            if image is self._STOP:
+                break
+
+            started = time.perf_counter()
+            try:
+                self._storage.store_image(image)
+            except Exception as e:
+                print('Failed storing picture', image.id, e)
+                continue
+
+            get_metrics().histogram('worker.storage.write_sec').record(time.perf_counter() - started)
+
+    def _put(self, target: queue.Queue, item) -> bool:
+        metrics = get_metrics()
+        metrics.gauge('worker.capture_queue').set(self._capture_requests.qsize())
+        metrics.gauge('worker.store_queue').set(self._captured_images.qsize())
+
+        if self._policy == QueuePolicy.BLOCK:
+            target.put(item)
+            return True
+
+        while True:
+            try:
+                target.put_nowait(item)
+                return True
+            except queue.Full:
+                pass
+
+            if self._policy == QueuePolicy.DROP_NEWEST:
+                self._on_dropped()
+                return False
+
+            # Drop the oldest to make room, and try again.
+            try:
+                target.get_nowait()
+                self._on_dropped()
+            except queue.Empty:
+                pass
+
+    def _on_dropped(self):
+        with self._dropped_lock:
+            self._dropped_count += 1
+        get_metrics().counter('worker.capture_dropped').add()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return self
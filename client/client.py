@@ -1,26 +1,152 @@
+from typing import Optional, Dict
+
+import queue
+import socket
+import threading
+import time
+
 from client.camera import Camera
+from client.capture import CapturePipeline, capture_image
 from client.connection import Connection
 from client.storage import Storage
-from common.command import CommandType, TakePictureParams
+from common.clock import Clock
+from common.command import CommandType, TakePictureParams, AssignShardParams, SyncClockParams, ClockOffsetParams, \
+    StreamParams, CreditParams, AcknowledgeParams, ResumeParams, NO_REQUEST_ID
 from common.image import Image
+from common.metrics import get_metrics
+
+# The method handling each command, of Client and of client.aio.AsyncClient alike.
+COMMAND_HANDLERS: Dict[CommandType, str] = {
+    CommandType.REGISTER: '_register_to_server',
+    CommandType.TAKE_PICTURE: '_take_picture',
+    CommandType.SEND_NEXT_PICTURE: '_send_next_picture',
+    CommandType.SEND_ALL_PICTURES: '_send_all_pictures',
+    CommandType.PING: '_answer_ping',
+    CommandType.ASSIGN_SHARD: '_assign_shard',
+    CommandType.SYNC_CLOCK: '_sync_clock',
+    CommandType.SET_CLOCK_OFFSET: '_set_clock_offset',
+    CommandType.START_STREAM: '_start_stream',
+    CommandType.CREDIT: '_add_credit',
+    CommandType.STOP_STREAM: '_stop_stream',
+    CommandType.ACKNOWLEDGE_PICTURE: '_acknowledge_picture',
+    CommandType.RESUME_PICTURE: '_resume_picture'
+}
+
+
+def record_command(command: CommandType, params):
+    metrics = get_metrics()
+    metrics.counter('worker.commands').add()
+    metrics.trace('worker.command', command=command.name, params=params)
+
+
+def requeue_unacknowledged(storage: Storage) -> int:
+    # Images the server didn't acknowledge are sent again.
+    count = storage.requeue_unacknowledged()
+    if count > 0:
+        get_metrics().counter('worker.requeued_images').add(count)
+    return count
+
+
+def requeue_unsent(storage: Storage, image: Image):
+    # The image is sent first the next time we are asked, instead of after all the others.
+    if storage.requeue(image.id):
+        get_metrics().counter('worker.requeued_images').add()
+
+
+def next_image_to_send(storage: Storage) -> Optional[Image]:
+    # Once all the images were sent, those the server didn't acknowledge are sent again.
+    image = storage.retrieve_next_image()
+    if image is None and requeue_unacknowledged(storage) > 0:
+        image = storage.retrieve_next_image()
+    return image
+
+
+def record_image_sent(image: Image, started: float):
+    # started is when we started sending the image, by time.perf_counter.
+    metrics = get_metrics()
+    metrics.histogram('worker.send_sec').record(time.perf_counter() - started)
+    metrics.counter('worker.images_sent').add()
+    metrics.trace('worker.image_sent', image_id=image.id, size=len(image))
+
+
+class FrameSchedule(object):
+    """
+    When the frames of a stream are taken, and up to which frame the server gave us credit.
+    Not safe to use from several threads by itself.
+    """
+
+    def __init__(self):
+        self.interval = 0.0
+        # The id of the first frame we may not send until we get more credit.
+        self.limit = 0
+
+    def set_rate(self, params: StreamParams) -> bool:
+        # Returns False, leaving the schedule as it was, if we can't stream at the rate asked for.
+        interval = params.frame_interval
+        if interval is None:
+            print('Cannot stream at', params.fps, 'frames per second')
+            get_metrics().counter('worker.stream.rejected').add()
+            return False
+
+        print('Streaming at', params.fps, 'frames per second')
+        self.interval = interval
+        self.add_credit(params.limit)
+        return True
+
+    def add_credit(self, limit: int):
+        # Credits may arrive out of order, the limit only grows.
+        self.limit = max(self.limit, limit)
+
+    def may_take(self, frame_id: int) -> bool:
+        if frame_id < self.limit:
+            return True
+        # The server is behind, so we don't take frames it can't take.
+        get_metrics().counter('worker.stream.throttled_frames').add()
+        return False
+
+    def next_frame_time(self, frame_time: float) -> float:
+        # If we fell behind, frames we had no time for are skipped.
+        return max(frame_time + self.interval, time.time())
 
 
 class Client(object):
 
-    def __init__(self, connection: Connection, storage: Storage, camera: Camera):
+    def __init__(self, connection: Connection, storage: Storage, camera: Camera,
+                 capture_pipeline: Optional[CapturePipeline] = None, clock: Optional[Clock] = None):
         self._connection = connection
         self._storage = storage
         self._camera = camera
-        self._command_handlers = {
-            CommandType.REGISTER: self._register_to_server,
-            CommandType.TAKE_PICTURE: self._take_picture,
-            CommandType.SEND_NEXT_PICTURE: self._send_next_picture
-        }
+        # If given, pictures are taken and stored in the background.
+        self._capture_pipeline = capture_pipeline
+        # Our clock and its offset from the server's, shared with the capture pipeline.
+        self._clock = clock if clock is not None else Clock()
+        self._command_handlers = {command: getattr(self, name) for command, name in COMMAND_HANDLERS.items()}
 
         self._id = -1
+        self._received_time = 0.0
+        # The id of the request being handled, echoed in the replies to it.
+        self._request_id = NO_REQUEST_ID
+
+        # While streaming, frames are taken by one thread and sent by another over a
+        # connection of its own (see _start_stream). The schedule is used under the condition.
+        self._stream_condition = threading.Condition()
+        self._streaming = False
+        self._frame_schedule = FrameSchedule()
+        self._stream_threads = []
+        # The request to stop the stream, answered by the end marker once all the frames are sent.
+        self._stop_request_id = NO_REQUEST_ID
+
+    def handle_next_command(self, timeout: Optional[float] = None):
+        # With a timeout, returns without handling anything if no command arrived in time.
+        command_and_params = self._connection.wait_for_command(timeout)
+        if command_and_params is None:
+            return
+
+        command, params, self._request_id = command_and_params
+        # For clock syncs, when the command arrived (not when we got to it).
+        self._received_time = self._connection.command_time
+        record_command(command, params)
 
-    def handle_next_command(self):
-        command, params = self._connection.wait_for_command()
         handler = self._command_handlers[command]
         if params is None:
             handler()
@@ -33,33 +159,205 @@ class Client(object):
         print('Register request')
 
         # send the server a response
-        new_id = self._connection.send_register()
+        new_id = self._connection.send_register(self._request_id)
         print('New ID:', new_id)
         self._id = new_id
 
+    def _answer_ping(self):
+        # If the command is a ping:
+        if self._id == -1:
+            # We aren't registered yet, so we register instead.
+            self._register_to_server()
+        else:
+            self._connection.send_ping_response(self._id, self._request_id)
+
+    def _assign_shard(self, params: AssignShardParams):
+        # If the command is to send images elsewhere:
+        print('Sending images to port', params.port)
+        self._connection.redirect_images(params.port, self._request_id)
+
+    def _sync_clock(self, params: SyncClockParams):
+        # If the command is a clock sync, we reply right away.
+        self._connection.send_clock_reply(params.server_time, self._received_time, self._request_id)
+
+    def _set_clock_offset(self, params: ClockOffsetParams):
+        print('Clock offset:', params.offset)
+        self._clock.set_offset(params.offset)
+
+    def _start_stream(self, params: StreamParams):
+        # If the command is to stream:
+        with self._stream_condition:
+            if not self._frame_schedule.set_rate(params):
+                if not self._streaming:
+                    # The marker tells the server there is no stream.
+                    self._connection.send_no_image(self._id, self._request_id)
+                return
+
+            if self._streaming:
+                # Only the rate changed, the frames are taken by the stream already running.
+                return
+            self._streaming = True
+
+        # A stream which was stopped may still be sending its last frames.
+        self._join_stream()
+        # Frames are taken on time and sent without holding up the handling of commands,
+        # which goes on as usual until we are told to stop.
+        frames = queue.Queue()
+        self._stream_threads = [
+            threading.Thread(target=self._take_frames, args=(params.first_id, frames), name='stream', daemon=True),
+            threading.Thread(target=self._send_frames, args=(params.first_id, frames), name='stream-sender',
+                             daemon=True)]
+        for thread in self._stream_threads:
+            thread.start()
+
+    def _add_credit(self, params: CreditParams):
+        with self._stream_condition:
+            self._frame_schedule.add_credit(params.limit)
+
+    def _stop_stream(self):
+        with self._stream_condition:
+            if self._streaming:
+                self._streaming = False
+                self._stop_request_id = self._request_id
+                self._stream_condition.notify_all()
+                return
+
+        # We are not streaming (maybe the marker answering an earlier request was lost),
+        # unless the stream is still sending its last frames, and the marker after them.
+        if not any(thread.is_alive() for thread in self._stream_threads):
+            self._connection.send_no_image(self._id, self._request_id)
+
+    def _take_frames(self, frame_id: int, frames: queue.Queue):
+        next_frame_time = time.time()
+        while self._wait_for_frame(next_frame_time):
+            with self._stream_condition:
+                may_take = self._frame_schedule.may_take(frame_id)
+            if may_take:
+                frames.put(capture_image(self._camera, self._clock, frame_id))
+                frame_id += 1
+
+            with self._stream_condition:
+                next_frame_time = self._frame_schedule.next_frame_time(next_frame_time)
+
+        # The frames taken are sent before the end marker.
+        frames.put(None)
+
+    def _wait_for_frame(self, frame_time: float) -> bool:
+        # Waits until frame_time, and returns whether we are still streaming by then.
+        with self._stream_condition:
+            while self._streaming:
+                remaining = frame_time - time.time()
+                if remaining <= 0:
+                    return True
+                self._stream_condition.wait(remaining)
+        return False
+
+    def _send_frames(self, first_id: int, frames: queue.Queue):
+        sender = self._connection.open_sender()
+        sent_count = 0
+        try:
+            while True:
+                image = frames.get()
+                if image is None:
+                    break
+                # Frames which time out are lost, they were never stored.
+                if self._send_picture(image, sender):
+                    sent_count += 1
+
+            # The marker answers the request to stop.
+            sender.send_no_image(self._id, self._stop_request_id)
+        except OSError as e:
+            # Sending failed (or we were closed), so the server times out the stream.
+            print('Stream stopped sending', e)
+        finally:
+            sender.close()
+        get_metrics().trace('worker.stream_stopped', frames=sent_count, first_id=first_id)
+
+    def _join_stream(self):
+        for thread in self._stream_threads:
+            thread.join()
+        self._stream_threads = []
+
     def _take_picture(self, params: TakePictureParams):
         # If the command is to take a picture:
-        print('Take picture request')
-
         # The picture id
         image_id = params.picture_id
-        print('Picture id', image_id)
 
-        # Take picture
-        data = self._camera.take_picture()
-        image = Image(image_id, data)
+        if self._capture_pipeline is not None:
+            # The picture will be taken and stored in the background.
+            if not self._capture_pipeline.request_capture(image_id, params.capture_time):
+                print('Picture request dropped', image_id)
+            return
+
+        # Take picture, when the server asked for it.
+        image = capture_image(self._camera, self._clock, image_id, params.capture_time)
 
         # We will save the image.
         self._storage.store_image(image)
 
     def _send_next_picture(self):
         # If the command is to send an image:
-        print('Send image request')
-
-        next_picture = self._storage.retrieve_next_image()
+        next_picture = next_image_to_send(self._storage)
         if next_picture is None:
-            print('No more images')
-            self._connection.send_no_image(self._id)
-        else:
-            self._connection.send_image(self._id, next_picture)
-            print('Image sent')
+            get_metrics().trace('worker.no_more_images')
+            self._connection.send_no_image(self._id, self._request_id)
+        elif not self._send_picture(next_picture):
+            self._give_up_sending(next_picture)
+
+    def _send_all_pictures(self):
+        # If the command is to send all the images:
+        # We send the images one after the other without waiting for
+        # a request for each, and finish with no-image so the server knows we're done.
+        # Images the server didn't acknowledge the last time are sent again.
+        requeue_unacknowledged(self._storage)
+        sent_count = 0
+        while True:
+            next_picture = self._storage.retrieve_next_image()
+            if next_picture is None:
+                break
+
+            if not self._send_picture(next_picture):
+                # The rest would time out as well.
+                self._give_up_sending(next_picture)
+                return
+            sent_count += 1
+
+        self._connection.send_no_image(self._id, self._request_id)
+        get_metrics().trace('worker.sent_all_images', count=sent_count)
+
+    def _acknowledge_picture(self, params: AcknowledgeParams):
+        # The server has the picture, we may forget it.
+        self._storage.acknowledge(params.picture_id)
+
+    def _resume_picture(self, params: ResumeParams):
+        # If the command is to resume sending a picture:
+        image = self._storage.retrieve_unacknowledged(params.picture_id)
+        if image is None:
+            print('Cannot resume picture', params.picture_id)
+            return
+
+        self._connection.resend_parts(self._id, image, params.missing)
+        get_metrics().counter('worker.resumed_images').add()
+
+    def _send_picture(self, image: Image, connection: Optional[Connection] = None) -> bool:
+        # Returns False if the server stopped answering.
+        started = time.perf_counter()
+        try:
+            (connection if connection is not None else self._connection).send_image(self._id, image)
+        except socket.timeout:
+            print('Timed out sending picture', image.id)
+            get_metrics().counter('worker.send_timeouts').add()
+            return False
+
+        record_image_sent(image, started)
+        return True
+
+    def _give_up_sending(self, image: Image):
+        # The image is not acknowledged, so it is put back to be sent first the next time,
+        # and the end marker answers the request, so the server doesn't wait for the rest.
+        requeue_unsent(self._storage, image)
+        try:
+            self._connection.send_no_image(self._id, self._request_id)
+        except socket.timeout:
+            # The server is not there, it times the request out by itself.
+            get_metrics().counter('worker.send_timeouts').add()
@@ -1,23 +1,77 @@
-import struct
 from abc import ABC, abstractmethod
-from typing import Tuple, Optional
+from collections import deque
+from typing import Tuple, Optional, Callable, List
 
 import socket
+import time
 
-from common.command import CommandType, MAX_COMMAND_SIZE, CommandParams, unpack_command
-from common.data import REGISTER_RESPONSE
-from common.image import Image
-from common import udp
+from common.command import CommandType, MAX_COMMAND_SIZE, NO_REQUEST_ID, CommandParams, unpack_request
+from common.compression import Codec, CompressionSettings, Compressor, SUPPORTED_CODECS
+from common.data import REGISTER_RESPONSE, REGISTER_CODECS, REGISTER_ID, PING_RESPONSE, CLOCK_RESPONSE, \
+    CLOCK_TIMES, SHARD_RESPONSE, SHARD_PORT, pack_reply
+from common.image import Image, compute_digest
+from common.pacing import Pacer
+from common import tcp, udp
+
+
+def pack_register(request_id: int = NO_REQUEST_ID) -> bytes:
+    # Our registration, with the codecs we support.
+    return pack_reply(REGISTER_RESPONSE + REGISTER_CODECS.pack(SUPPORTED_CODECS), request_id)
+
+
+def unpack_register_reply(data: bytes) -> Tuple[int, Optional[Compressor]]:
+    # Our new id, and how the server tells us to compress images, unless it doesn't know how.
+    client_id, = REGISTER_ID.unpack_from(data)
+    settings_data = data[REGISTER_ID.size:]
+    if len(settings_data) < CompressionSettings.STRUCT.size:
+        return client_id, None
+    return client_id, Compressor(CompressionSettings.unpack(settings_data))
 
 
 class Connection(ABC):
 
     @abstractmethod
-    def wait_for_command(self) -> Tuple[CommandType, Optional[CommandParams]]:
+    def wait_for_command(self, timeout: Optional[float] = None) \
+            -> Optional[Tuple[CommandType, Optional[CommandParams], int]]:
+        """
+        Waits for the next command from the server. If timeout is given and no command
+        arrived by then, returns None.
+        Returns the command, its parameters and the id of the request, which is echoed
+        in the replies to it (NO_REQUEST_ID if the server didn't give one).
+        """
+        pass
+
+    @property
+    @abstractmethod
+    def command_time(self) -> float:
+        """
+        When the last command returned by wait_for_command arrived, by time.time(). Commands
+        which arrived during a transfer were held until it was done, so this is earlier.
+        """
+        pass
+
+    @abstractmethod
+    def send_register(self, request_id: int = NO_REQUEST_ID) -> int:
+        pass
+
+    @abstractmethod
+    def send_ping_response(self, client_id: int, request_id: int = NO_REQUEST_ID):
+        pass
+
+    @abstractmethod
+    def send_clock_reply(self, server_time: float, received_time: float, request_id: int = NO_REQUEST_ID):
+        """
+        Replies to a clock sync, see common.clock.
+        """
         pass
 
     @abstractmethod
-    def send_register(self) -> int:
+    def redirect_images(self, port: int, request_id: int = NO_REQUEST_ID):
+        """
+        Sends images from now on to another port of the server, and confirms it to
+        whoever asked. Images go back to the server itself when it registers us or pings
+        us again (e.g. restarted without shards).
+        """
         pass
 
     @abstractmethod
@@ -25,7 +79,23 @@ class Connection(ABC):
         pass
 
     @abstractmethod
-    def send_no_image(self, sender_id: int):
+    def resend_parts(self, sender_id: int, image: Image, indexes: List[int]):
+        """
+        Sends again the parts of an image the server is missing, to resume its transfer.
+        """
+        pass
+
+    @abstractmethod
+    def send_no_image(self, sender_id: int, request_id: int = NO_REQUEST_ID):
+        pass
+
+    @abstractmethod
+    def open_sender(self) -> 'Connection':
+        """
+        Another connection, sending images to the same place and in the same way over
+        sockets of its own, so images may be sent from another thread while commands
+        keep arriving on this one. Only its sending methods should be used.
+        """
         pass
 
     @abstractmethod
@@ -35,33 +105,133 @@ class Connection(ABC):
 
 class UdpConnection(Connection):
 
-    def __init__(self, skt: socket.socket, address: Tuple[str, int]):
+    def __init__(self, skt: socket.socket, address: Tuple[str, int], reliable: bool = False,
+                 dedup: bool = False, pacer: Optional[Pacer] = None, fec_group_size: int = 0):
         self._socket = skt
         self._address = address
+        # Where images are sent, the server may move it elsewhere (see redirect_images).
+        self._image_address = address
+        self._reliable = reliable
+        # Offer the digest of each image first, and only send images the server doesn't have.
+        self._dedup = dedup
+        # Limits the rate images are sent at, kept between images so an adaptive pacer
+        # keeps the rate it found.
+        self._pacer = pacer
+        # Each group of this many parts is followed by its parity, so the server rebuilds
+        # a part lost of the group instead of getting it again (see udp.pack_parts).
+        self._fec_group_size = fec_group_size
+        # Chosen by the server when we register.
+        self._compressor = Compressor(CompressionSettings(Codec.NONE))
+        # Commands received while we were waiting for something else, with where they came from and when.
+        self._pending_commands = deque()
+        # Where the last command came from, which isn't the server when it is sharded (see master.sharded).
+        self._command_address = address
+        self._command_time = 0.0
 
-    def wait_for_command(self) -> Tuple[CommandType, Optional[CommandParams]]:
-        data, address = self._socket.recvfrom(MAX_COMMAND_SIZE)
-        return unpack_command(data)
+    def wait_for_command(self, timeout: Optional[float] = None) \
+            -> Optional[Tuple[CommandType, Optional[CommandParams], int]]:
+        if len(self._pending_commands) > 0:
+            data, self._command_address, self._command_time = self._pending_commands.popleft()
+            return unpack_request(data)
 
-    def send_register(self) -> int:
-        # send the server a response:
-        self._socket.sendto(REGISTER_RESPONSE, self._address)
+        old_timeout = self._socket.gettimeout()
+        self._socket.settimeout(timeout)
+        try:
+            while True:
+                data, address = self._socket.recvfrom(MAX_COMMAND_SIZE)
+                # Replies to transfers which arrive late are not commands.
+                if not udp.is_transfer_reply(data):
+                    break
+        except socket.timeout:
+            return None
+        finally:
+            self._socket.settimeout(old_timeout)
+        self._command_time = time.time()
+        self._command_address = address
+        return unpack_request(data)
 
-        # Receive ID and save it.
-        data, address = self._socket.recvfrom(struct.calcsize('i'))
-        client_id, = struct.unpack('i', data)
+    @property
+    def command_time(self) -> float:
+        return self._command_time
+
+    def send_register(self, request_id: int = NO_REQUEST_ID) -> int:
+        self._undo_redirect()
+        # send the server a response, with the codecs we support:
+        self._socket.sendto(pack_register(request_id), self._address)
 
+        # Receive ID and save it.
+        data, address = self._socket.recvfrom(MAX_COMMAND_SIZE)
+        client_id, compressor = unpack_register_reply(data)
+        if compressor is not None:
+            self._compressor = compressor
         return client_id
 
+    def send_ping_response(self, client_id: int, request_id: int = NO_REQUEST_ID):
+        # Heartbeats are answered to whoever sent them (e.g. a shard of the server).
+        self._undo_redirect()
+        data = pack_reply(PING_RESPONSE + REGISTER_ID.pack(client_id), request_id)
+        self._socket.sendto(data, self._command_address)
+
+    def send_clock_reply(self, server_time: float, received_time: float, request_id: int = NO_REQUEST_ID):
+        # The time we send the reply is taken as late as we can.
+        data = CLOCK_RESPONSE + CLOCK_TIMES.pack(server_time, received_time, time.time())
+        self._socket.sendto(pack_reply(data, request_id), self._address)
+
+    def redirect_images(self, port: int, request_id: int = NO_REQUEST_ID):
+        self._image_address = (self._address[0], port)
+        data = pack_reply(SHARD_RESPONSE + SHARD_PORT.pack(port), request_id)
+        self._socket.sendto(data, self._command_address)
+
     def send_image(self, sender_id: int, image: Image):
-        udp.send_image(self._socket, sender_id, self._address, image)
+        if self._dedup:
+            digest = compute_digest(image)
+            if not udp.offer_digest(self._socket, sender_id, self._image_address, image, digest,
+                                    on_other_data=self._on_other_data):
+                # The server already has this image.
+                return
+
+        codec, image = self._compressor.compress_image(image)
+        if self._reliable:
+            udp.send_image_reliable(self._socket, sender_id, self._image_address, image,
+                                    on_other_data=self._on_other_data, codec=codec, pacer=self._pacer,
+                                    fec_group_size=self._fec_group_size)
+        else:
+            udp.send_image(self._socket, sender_id, self._image_address, image, codec, self._pacer,
+                           self._fec_group_size)
+
+    def resend_parts(self, sender_id: int, image: Image, indexes: List[int]):
+        # The parts must be of the image as it was sent, so it is compressed again the same way.
+        codec, image = self._compressor.compress_image(image)
+        udp.send_parts(self._socket, sender_id, self._image_address, image, indexes, codec, self._pacer)
 
-    def send_no_image(self, sender_id: int):
-        udp.send_no_image(self._socket, sender_id, self._address)
+    def send_no_image(self, sender_id: int, request_id: int = NO_REQUEST_ID):
+        if self._reliable:
+            udp.send_image_reliable(self._socket, sender_id, self._image_address, None,
+                                    on_other_data=self._on_other_data, request_id=request_id)
+        else:
+            udp.send_no_image(self._socket, sender_id, self._image_address, request_id)
+
+    def open_sender(self) -> Connection:
+        sender = UdpConnection(self._create_socket(0), self._address, self._reliable, self._dedup, self._pacer,
+                               self._fec_group_size)
+        sender._image_address = self._image_address
+        sender._compressor = self._compressor
+        return sender
 
     def close(self):
         self._socket.close()
 
+    def _undo_redirect(self):
+        # The server itself discovering us means it isn't sharded (anymore), while the
+        # heartbeats of its shards come from their own ports.
+        if self._command_address[1] == self._address[1]:
+            self._image_address = self._address
+
+    def _on_other_data(self, data: bytes, address: Tuple):
+        # Keep commands which arrived during a transfer, so we don't lose them.
+        if len(data) <= MAX_COMMAND_SIZE and not udp.is_transfer_reply(data):
+            self._pending_commands.append((data, address, time.time()))
+
     def __enter__(self):
         return self
 
@@ -70,11 +240,107 @@ class UdpConnection(Connection):
         return self
 
     @staticmethod
-    def create(local_port: int, server_address: Tuple[str, int]) -> Connection:
+    def create(local_port: int, server_address: Tuple[str, int], reliable: bool = False,
+               dedup: bool = False, pacer: Optional[Pacer] = None, send_buffer_size: Optional[int] = None,
+               receive_buffer_size: Optional[int] = None, fec_group_size: int = 0) -> Connection:
+        # Buffer sizes not given are left to the kernel's defaults.
+        skt = UdpConnection._create_socket(local_port, send_buffer_size, receive_buffer_size)
+        return UdpConnection(skt, server_address, reliable, dedup, pacer, fec_group_size)
+
+    @staticmethod
+    def _create_socket(local_port: int, send_buffer_size: Optional[int] = None,
+                       receive_buffer_size: Optional[int] = None) -> socket.socket:
         skt = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         # Make client blocking so we wait to receive information
         skt.setblocking(True)
+        udp.set_buffer_sizes(skt, send_buffer_size, receive_buffer_size)
         # Bind the socket to the address and port.
         skt.bind(('', local_port))
+        return skt
+
+
+class TcpConnection(UdpConnection):
+    """
+    Commands are received over UDP, like in UdpConnection, but images are sent
+    over a TCP connection to the server, which is kept open between images.
+    Images stored in files are sent straight from the file.
+    """
+
+    def __init__(self, skt: socket.socket, address: Tuple[str, int], dedup: bool = False,
+                 send_buffer_size: Optional[int] = None):
+        super().__init__(skt, address, reliable=False, dedup=dedup)
+        # Connected when the first image is sent.
+        self._stream_socket = None
+        # TCP paces itself, only the send buffer of the stream can be set.
+        self._send_buffer_size = send_buffer_size
+
+    def redirect_images(self, port: int, request_id: int = NO_REQUEST_ID):
+        super().redirect_images(port, request_id)
+        # The next image connects to the new port.
+        self._close_stream()
+
+    def _undo_redirect(self):
+        image_address = self._image_address
+        super()._undo_redirect()
+        if self._image_address != image_address:
+            self._close_stream()
 
-        return UdpConnection(skt, server_address)
+    def send_image(self, sender_id: int, image: Image):
+        self._send(lambda stream_socket: self._send_image_over(stream_socket, sender_id, image))
+
+    def resend_parts(self, sender_id: int, image: Image, indexes: List[int]):
+        # The server drops what it got of an image if the connection is cut off,
+        # so the image is sent again whole.
+        self.send_image(sender_id, image)
+
+    def send_no_image(self, sender_id: int, request_id: int = NO_REQUEST_ID):
+        # Nothing arrives late over the connection, so the marker needs no request id.
+        self._send(lambda stream_socket: tcp.send_no_image(stream_socket, sender_id))
+
+    def open_sender(self) -> Connection:
+        sender = TcpConnection(self._create_socket(0), self._address, self._dedup, self._send_buffer_size)
+        sender._image_address = self._image_address
+        sender._compressor = self._compressor
+        return sender
+
+    def close(self):
+        self._close_stream()
+        super().close()
+
+    def _send_image_over(self, stream_socket: socket.socket, sender_id: int, image: Image):
+        if self._dedup:
+            digest = compute_digest(image)
+            if not tcp.offer_digest(stream_socket, sender_id, image, digest):
+                # The server already has this image.
+                return
+
+        codec, image = self._compressor.compress_image(image)
+        tcp.send_image(stream_socket, sender_id, image, codec)
+
+    def _send(self, send: Callable[[socket.socket], None]):
+        # If the server dropped the connection (e.g. it was restarted), connect
+        # again and send once more. Whatever it got of the first try is dropped.
+        try:
+            send(self._connect())
+        except ConnectionError:
+            self._close_stream()
+            send(self._connect())
+
+    def _connect(self) -> socket.socket:
+        if self._stream_socket is None:
+            stream_socket = socket.create_connection(self._image_address)
+            stream_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            udp.set_buffer_sizes(stream_socket, self._send_buffer_size)
+            self._stream_socket = stream_socket
+        return self._stream_socket
+
+    def _close_stream(self):
+        if self._stream_socket is not None:
+            self._stream_socket.close()
+            self._stream_socket = None
+
+    @staticmethod
+    def create(local_port: int, server_address: Tuple[str, int], dedup: bool = False,
+               send_buffer_size: Optional[int] = None) -> Connection:
+        skt = UdpConnection._create_socket(local_port)
+        return TcpConnection(skt, server_address, dedup, send_buffer_size)
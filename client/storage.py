@@ -1,12 +1,40 @@
 from abc import ABC, abstractmethod
+from collections import deque
 from pathlib import Path
-from typing import Optional
+from typing import Optional, Dict, Tuple, List
 
+import enum
+import os
+import struct
+import threading
+
+from common.metrics import get_metrics
+from common.pack import PackFile, DEFAULT_MAX_SEGMENT_SIZE
 from common.times import create_datetime_path
-from common.image import Image
+from common.image import Image, FileImage, MappedFileImage
+
+JOURNAL_FILE_NAME = 'journal'
+# Images are kept in files named by their sequence number (images are JPEGs, see Image.extension).
+JOURNALED_IMAGE_FILE_FORMAT = '{}.jpg'
+JOURNAL_RECORD = struct.Struct('=Bqiqd')  # operation, sequence number, image_id, size, timestamp
+# The operations recorded in the journal, on the image with the sequence number.
+_JOURNAL_STORED = 1
+_JOURNAL_ACKNOWLEDGED = 2
+_JOURNAL_REMOVED = 3
+# The journal is compacted once it has more than this many records, and more than
+# this many times as many records as images kept.
+_COMPACT_MIN_RECORDS = 1024
+_COMPACT_RATIO = 2
+# With EvictionPolicy.KEEP_EVERY_NTH, by default every other image is kept.
+DEFAULT_KEEP_EVERY = 2
 
 
 class Storage(ABC):
+    """
+    Images are kept after they are retrieved for sending, until the server acknowledges
+    it received them. Until then they may be retrieved again by id (to resume a transfer
+    which was cut off), or put back to be sent again (see requeue_unacknowledged).
+    """
 
     @abstractmethod
     def store_image(self, image: Image):
@@ -16,10 +44,129 @@ class Storage(ABC):
     def retrieve_next_image(self) -> Optional[Image]:
         pass
 
+    @abstractmethod
+    def retrieve_unacknowledged(self, image_id: int) -> Optional[Image]:
+        pass
+
+    @abstractmethod
+    def acknowledge(self, image_id: int):
+        pass
+
+    @abstractmethod
+    def requeue_unacknowledged(self) -> int:
+        """
+        Puts the images which were retrieved and not acknowledged back, so they are
+        retrieved next. Returns how many there were.
+        """
+        pass
+
+    @abstractmethod
+    def requeue(self, image_id: int) -> bool:
+        """
+        Puts an image which was retrieved and not acknowledged back, so it is retrieved next
+        (e.g. as sending it failed). Returns whether there was such an image.
+        """
+        pass
+
+
+class QueuedStorage(Storage):
+    """
+    Keeps a record of each stored image in memory, from which the image is loaded
+    when it is retrieved. Subclasses store the images and load them from their records.
+    Images are numbered in the order they are stored, as image ids may repeat (e.g. when
+    the server restarts).
+    """
+
+    def __init__(self):
+        self._stored_images = []
+        # Sequence number -> record, of images retrieved and not acknowledged, by the order retrieved.
+        self._unacknowledged: Dict[int, Tuple] = {}
+        self._next_sequence = 1
+        # Images may be stored from several threads.
+        self._lock = threading.Lock()
+
+    def store_image(self, image: Image):
+        with self._lock:
+            sequence = self._next_sequence
+            self._next_sequence += 1
+        record = self._store(image, sequence)
+        # Save the record of the image to a list so we may recall it later.
+        # Easier than querying the file system
+        with self._lock:
+            self._stored_images.append(record)
+            self._stored(record)
+
+    def retrieve_next_image(self) -> Optional[Image]:
+        with self._lock:
+            # If we don't have anymore images
+            if len(self._stored_images) == 0:
+                return None
+
+            # We take one record from the list of images and keep it aside
+            # until the server acknowledges the image.
+            record = self._stored_images.pop()
+            self._unacknowledged[record[1]] = record
+
+        return self._load(record)
+
+    def retrieve_unacknowledged(self, image_id: int) -> Optional[Image]:
+        with self._lock:
+            record = self._find_unacknowledged(image_id)
+        return None if record is None else self._load(record)
+
+    def acknowledge(self, image_id: int):
+        with self._lock:
+            record = self._find_unacknowledged(image_id)
+            if record is not None:
+                del self._unacknowledged[record[1]]
+                self._acknowledged(record)
+
+    def requeue_unacknowledged(self) -> int:
+        with self._lock:
+            records = list(self._unacknowledged.values())
+            self._unacknowledged.clear()
+            # Images are retrieved from the end, so these are next, oldest first.
+            self._stored_images.extend(reversed(records))
+        return len(records)
+
+    def requeue(self, image_id: int) -> bool:
+        with self._lock:
+            record = self._find_unacknowledged(image_id)
+            if record is None:
+                return False
+            del self._unacknowledged[record[1]]
+            self._stored_images.append(record)
+        return True
+
+    def _find_unacknowledged(self, image_id: int) -> Optional[Tuple]:
+        # Called with the lock held. Of images with the same id, the one retrieved first.
+        for record in self._unacknowledged.values():
+            if record[0] == image_id:
+                return record
+        return None
+
+    def _stored(self, record: Tuple):
+        # Called with the lock held, once the record of a new image is kept.
+        pass
+
+    def _acknowledged(self, record: Tuple):
+        # Called with the lock held, once the image of the record is acknowledged.
+        pass
+
+    @abstractmethod
+    def _store(self, image: Image, sequence: int) -> Tuple:
+        # Stores the image, and returns its record, which starts with the image id and the sequence number.
+        pass
+
+    @abstractmethod
+    def _load(self, record: Tuple) -> Image:
+        pass
+
 
-class BasicFileSystemStorage(Storage):
+class BasicFileSystemStorage(QueuedStorage):
 
     def __init__(self, parent_path: Path, use_datetime: bool = False):
+        super().__init__()
         if use_datetime:
             self._parent = create_datetime_path(parent_path)
         else:
@@ -28,28 +175,307 @@ class BasicFileSystemStorage(Storage):
         if not self._parent.exists():
             self._parent.mkdir(parents=True)
 
-        self._stored_images = []
-
-    def store_image(self, image: Image):
+    def _store(self, image: Image, sequence: int) -> Tuple:
         # We will save the image in a local path
         image_path = self._parent / '{}.{}'.format(str(image.id), image.extension)
         with image_path.open(mode='wb') as f:
             f.write(image.data)
 
-        # Save the path of the image to a list so we may recall it later.
-        # Easier than querying the file system
-        self._stored_images.append((image.id, image_path))
+        return image.id, sequence, image_path, image.timestamp
 
-    def retrieve_next_image(self) -> Optional[Image]:
-        # If we don't have anymore images
+    def _load(self, record: Tuple) -> Image:
+        image_id, sequence, image_path, timestamp = record
+        # The image is read from the file only as it is sent.
+        return FileImage(image_id, image_path, timestamp=timestamp)
+
+
+class PackFileStorage(QueuedStorage):
+    """
+    Stores the images appended to a few large segment files, see PackFile.
+    Retrieved images are served straight from a memory map of the segment.
+    Images are removed from the pack once acknowledged, and on restart the images
+    left in the pack are sent again.
+    """
+
+    def __init__(self, parent_path: Path, use_datetime: bool = False,
+                 max_segment_size: int = DEFAULT_MAX_SEGMENT_SIZE):
+        super().__init__()
+        if use_datetime:
+            parent_path = create_datetime_path(parent_path)
+
+        self._pack = PackFile(parent_path, max_segment_size)
+        self._load_pack()
+
+    def close(self):
+        self._pack.close()
+
+    def _store(self, image: Image, sequence: int) -> Tuple:
+        # All the images in the pack are ours, so they are keyed by the sequence number
+        # (in place of the client id) and the image id, as image ids may repeat.
+        self._pack.append(sequence, image.id, image.data, image.timestamp)
+        return image.id, sequence, image.timestamp
+
+    def _load(self, record: Tuple) -> Image:
+        image_id, sequence, timestamp = record
+        return Image(image_id, self._pack.read(sequence, image_id), timestamp)
+
+    def _acknowledged(self, record: Tuple):
+        image_id, sequence, timestamp = record
+        self._pack.remove(sequence, image_id)
+
+    def _load_pack(self):
+        for sequence, image_id in sorted(self._pack.keys()):
+            self._stored_images.append((image_id, sequence, self._pack.timestamp_of(sequence, image_id)))
+            self._next_sequence = sequence + 1
+
+        print('Recovered', len(self._stored_images), 'images to send from the pack')
+        get_metrics().counter('worker.storage.recovered_images').add(len(self._stored_images))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return self
+
+
+class EvictionPolicy(enum.Enum):
+    # The oldest images waiting to be sent make room for new ones.
+    OLDEST_FIRST = 'oldest-first'
+    # The backlog is thinned out, keeping every Nth image (and then every N*Nth, and so on),
+    # so a long backlog loses its rate rather than its oldest span.
+    KEEP_EVERY_NTH = 'keep-every-nth'
+
+
+class JournaledStorage(QueuedStorage):
+    """
+    Stores each image in a file of its own, and records what happens to the images
+    (stored, acknowledged, removed) in a journal. On restart, the journal is read back
+    to know which images are still to be sent, in time proportional to the journal and
+    not to the files (the journal is compacted as it fills up with images long gone).
+    Images retrieved and not acknowledged before a restart are sent again.
+
+    With max_bytes, the images never take more than that: acknowledged images are kept
+    until room is needed, and then images waiting to be sent are evicted by the policy.
+    An image which doesn't fit even then is dropped.
+    With sync, the journal is synced to disk on each write, so it survives losing power
+    and not only the worker crashing, at the cost of a sync per image.
+    """
+
+    def __init__(self, path: Path, max_bytes: Optional[int] = None,
+                 eviction: EvictionPolicy = EvictionPolicy.OLDEST_FIRST, keep_every: int = DEFAULT_KEEP_EVERY,
+                 sync: bool = False):
+        super().__init__()
+        if keep_every < 2:
+            raise ValueError('Keeping every {}th image evicts nothing'.format(keep_every))
+        self._path = path
+        self._max_bytes = max_bytes
+        self._eviction = eviction
+        self._keep_every = keep_every
+        self._sync = sync
+        # Acknowledged images, kept until room is needed, oldest first.
+        self._retained = deque()
+        # Bytes of all the images we keep, and of those being stored.
+        self._used_bytes = 0
+        self._journal_records = 0
+
+        if not self._path.exists():
+            self._path.mkdir(parents=True)
+        self._replay_journal()
+        self._journal = open(str(self._journal_path), mode='ab', buffering=0)
+        self._update_gauges()
+
+    @property
+    def used_bytes(self) -> int:
+        return self._used_bytes
+
+    @property
+    def backlog(self) -> int:
+        # Images not acknowledged yet.
+        with self._lock:
+            return len(self._stored_images) + len(self._unacknowledged)
+
+    def store_image(self, image: Image):
+        size = len(image)
+        with self._lock:
+            if not self._make_room(size):
+                print('No room for image', image.id, 'of', size, 'bytes')
+                get_metrics().counter('worker.storage.dropped_images').add()
+                return
+            # The room is taken while the image is written, so images stored at once don't overflow.
+            self._used_bytes += size
+
+        try:
+            super().store_image(image)
+        except Exception:
+            with self._lock:
+                self._used_bytes -= size
+            raise
+
+    def close(self):
+        with self._lock:
+            self._journal.close()
+
+    def _store(self, image: Image, sequence: int) -> Tuple:
+        image_path = self._path / JOURNALED_IMAGE_FILE_FORMAT.format(sequence)
+        with image_path.open(mode='wb') as f:
+            f.write(image.data)
+        return image.id, sequence, image_path, image.timestamp, len(image)
+
+    def _load(self, record: Tuple) -> Image:
+        image_id, sequence, image_path, timestamp, size = record
+        # Files of images are never written again (they are named by the sequence number), so they can be mapped.
+        return MappedFileImage(image_id, image_path, length=size, timestamp=timestamp)
+
+    def _stored(self, record: Tuple):
+        self._write_journal(_JOURNAL_STORED, record)
+        self._update_gauges()
+
+    def _acknowledged(self, record: Tuple):
+        self._retained.append(record)
+        self._write_journal(_JOURNAL_ACKNOWLEDGED, record)
+        self._update_gauges()
+
+    def _make_room(self, size: int) -> bool:
+        # Called with the lock held. Returns whether there is room for size more bytes.
+        if self._max_bytes is None:
+            return True
+        if size > self._max_bytes:
+            return False
+
+        metrics = get_metrics()
+        while self._used_bytes + size > self._max_bytes:
+            if len(self._retained) > 0:
+                self._remove(self._retained.popleft())
+                continue
+
+            victim = self._choose_victim()
+            if victim is None:
+                # Only images being sent are left, which must be kept until acknowledged.
+                return False
+            self._stored_images.remove(victim)
+            self._remove(victim)
+            metrics.counter('worker.storage.evicted_images').add()
+        return True
+
+    def _choose_victim(self) -> Optional[Tuple]:
+        # Of the images waiting to be sent.
         if len(self._stored_images) == 0:
             return None
+        if self._eviction == EvictionPolicy.OLDEST_FIRST:
+            return min(self._stored_images, key=lambda record: record[1])
+        # The oldest of the images kept by the fewest rounds of thinning.
+        return min(self._stored_images, key=lambda record: (self._thinning_rounds(record[1]), record[1]))
+
+    def _thinning_rounds(self, sequence: int) -> int:
+        # How many rounds of keeping every Nth image the image survives.
+        rounds = 0
+        while sequence % self._keep_every == 0:
+            sequence //= self._keep_every
+            rounds += 1
+        return rounds
+
+    def _remove(self, record: Tuple):
+        # Called with the lock held.
+        try:
+            record[2].unlink()
+        except FileNotFoundError:
+            pass
+        self._used_bytes -= record[4]
+        self._write_journal(_JOURNAL_REMOVED, record)
+
+    def _write_journal(self, operation: int, record: Tuple):
+        # Called with the lock held, after the lists of images show the operation (as the
+        # journal may be compacted from them).
+        image_id, sequence, image_path, timestamp, size = record
+        self._journal.write(JOURNAL_RECORD.pack(operation, sequence, image_id, size, timestamp))
+        if self._sync:
+            os.fsync(self._journal.fileno())
+
+        self._journal_records += 1
+        kept = len(self._stored_images) + len(self._unacknowledged) + len(self._retained)
+        if self._journal_records > max(_COMPACT_MIN_RECORDS, _COMPACT_RATIO * kept):
+            self._compact_journal()
+
+    def _compact_journal(self):
+        # Rewrites the journal with only the images we keep. Written to the side and
+        # replaced, so a crash leaves either journal whole.
+        records = []
+        for record in self._retained:
+            records.append(self._pack_record(_JOURNAL_STORED, record))
+            records.append(self._pack_record(_JOURNAL_ACKNOWLEDGED, record))
+        # Images not acknowledged are still to be sent, after a restart.
+        for record in sorted(list(self._stored_images) + list(self._unacknowledged.values()),
+                             key=lambda record: record[1]):
+            records.append(self._pack_record(_JOURNAL_STORED, record))
+
+        temp_path = self._journal_path.with_name(JOURNAL_FILE_NAME + '.tmp')
+        with temp_path.open(mode='wb') as f:
+            f.write(b''.join(records))
+            if self._sync:
+                f.flush()
+                os.fsync(f.fileno())
+        self._journal.close()
+        os.replace(str(temp_path), str(self._journal_path))
+        self._journal = open(str(self._journal_path), mode='ab', buffering=0)
+        self._journal_records = len(records)
+        get_metrics().counter('worker.storage.journal_compactions').add()
+
+    def _replay_journal(self):
+        if not self._journal_path.exists():
+            return
+
+        with self._journal_path.open(mode='rb') as f:
+            data = f.read()
+        # A partially written record at the end is dropped, so the next ones are whole.
+        usable_size = len(data) - len(data) % JOURNAL_RECORD.size
+        if usable_size < len(data):
+            with self._journal_path.open(mode='r+b') as f:
+                f.truncate(usable_size)
+
+        # Sequence number -> record, and whether it was acknowledged.
+        records: Dict[int, Tuple] = {}
+        acknowledged = set()
+        for operation, sequence, image_id, size, timestamp in JOURNAL_RECORD.iter_unpack(data[:usable_size]):
+            self._journal_records += 1
+            self._next_sequence = max(self._next_sequence, sequence + 1)
+            if operation == _JOURNAL_STORED:
+                image_path = self._path / JOURNALED_IMAGE_FILE_FORMAT.format(sequence)
+                records[sequence] = (image_id, sequence, image_path, timestamp, size)
+            elif operation == _JOURNAL_ACKNOWLEDGED:
+                acknowledged.add(sequence)
+            elif operation == _JOURNAL_REMOVED:
+                records.pop(sequence, None)
+                acknowledged.discard(sequence)
+
+        for sequence in sorted(records.keys()):
+            record = records[sequence]
+            self._used_bytes += record[4]
+            if sequence in acknowledged:
+                self._retained.append(record)
+            else:
+                self._stored_images.append(record)
+
+        print('Recovered', len(self._stored_images), 'images to send from the journal')
+        get_metrics().counter('worker.storage.recovered_images').add(len(self._stored_images))
+
+    def _pack_record(self, operation: int, record: Tuple) -> bytes:
+        image_id, sequence, image_path, timestamp, size = record
+        return JOURNAL_RECORD.pack(operation, sequence, image_id, size, timestamp)
+
+    def _update_gauges(self):
+        # Called with the lock held.
+        metrics = get_metrics()
+        metrics.gauge('worker.storage.bytes').set(self._used_bytes)
+        metrics.gauge('worker.storage.backlog').set(len(self._stored_images) + len(self._unacknowledged))
+
+    @property
+    def _journal_path(self) -> Path:
+        return self._path / JOURNAL_FILE_NAME
 
-        # We take one path from the list of images and remove it
-        # from the list.
-        image_id, image_path = self._stored_images.pop()
+    def __enter__(self):
+        return self
 
-        # Read the image from the file and return it.
-        with image_path.open(mode='rb') as f:
-            image = f.read()
-            return Image(image_id, image)
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return self
@@ -1,21 +1,74 @@
 from pathlib import Path
 
 from client.camera import StubCamera
+from client.capture import CapturePipeline, QueuePolicy
 from client.client import Client
-from client.connection import UdpConnection
-from client.storage import BasicFileSystemStorage
+from client.connection import UdpConnection, TcpConnection
+from client.storage import BasicFileSystemStorage, JournaledStorage, EvictionPolicy
+from common.clock import Clock
+from common.metrics import Metrics, set_metrics, print_tracer
+from common.pacing import Pacer, AdaptivePacer
 
 from settings import *
 
 STORAGE_PARENT = Path('client_results')
 SERVER_ADDRESS = ('localhost', SERVER_PORT)
 
+CAPTURE_QUEUE_SIZE = 8
+CAPTURE_STORE_WORKERS = 2
+# When the queues are full, new pictures are dropped so commands are never held up.
+# QueuePolicy.BLOCK waits for room instead, holding up commands meanwhile.
+CAPTURE_QUEUE_POLICY = QueuePolicy.DROP_NEWEST
+
+# If not None, images are sent over UDP at up to this many bytes per second.
+SEND_RATE = None
+# Whether the send rate adapts to the loss the server reports (with reliable transfers),
+# starting from SEND_RATE if given.
+ADAPTIVE_PACING = RELIABLE_TRANSFER
+# If not None, the size of the socket's send buffer.
+SEND_BUFFER_SIZE = None
+# If not None, images are kept in STORAGE_PARENT (not a new directory for each run) with
+# a journal, so images not sent yet survive restarts, and take at most this many bytes.
+STORAGE_QUOTA = None
+# Which images make room for new ones once the quota is reached.
+STORAGE_EVICTION = EvictionPolicy.OLDEST_FIRST
+# On lossy links, each group of this many parts is sent with a parity from which the server
+# rebuilds a lost part, for 1 / FEC_GROUP_SIZE more data (0 sends no parity).
+FEC_GROUP_SIZE = 0
+
+
+def create_pacer():
+    if ADAPTIVE_PACING:
+        return AdaptivePacer() if SEND_RATE is None else AdaptivePacer(SEND_RATE)
+    if SEND_RATE is not None:
+        return Pacer(SEND_RATE)
+    return None
+
+
+def create_storage():
+    if STORAGE_QUOTA is not None:
+        return JournaledStorage(STORAGE_PARENT, STORAGE_QUOTA, STORAGE_EVICTION)
+    return BasicFileSystemStorage(STORAGE_PARENT, use_datetime=True)
+
+
+def create_connection():
+    if TCP_TRANSFER:
+        return TcpConnection.create(CLIENT_PORT, SERVER_ADDRESS, send_buffer_size=SEND_BUFFER_SIZE)
+    return UdpConnection.create(CLIENT_PORT, SERVER_ADDRESS, reliable=RELIABLE_TRANSFER, pacer=create_pacer(),
+                                send_buffer_size=SEND_BUFFER_SIZE, fec_group_size=FEC_GROUP_SIZE)
+
 
 def main():
-    storage = BasicFileSystemStorage(STORAGE_PARENT, use_datetime=True)
+    set_metrics(Metrics(tracers=[print_tracer]))
+
+    storage = create_storage()
+    # Synchronized with the server's clock, for taking pictures at the time it asks for.
+    clock = Clock()
     with StubCamera() as camera, \
-            UdpConnection.create(CLIENT_PORT, SERVER_ADDRESS) as conn:
-        client = Client(conn, storage, camera)
+            CapturePipeline(camera, storage, CAPTURE_QUEUE_SIZE, CAPTURE_STORE_WORKERS,
+                            CAPTURE_QUEUE_POLICY, clock) as capture_pipeline, \
+            create_connection() as conn:
+        client = Client(conn, storage, camera, capture_pipeline, clock)
 
         print('Starting')
         while True:
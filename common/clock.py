@@ -0,0 +1,80 @@
+"""
+Estimating the offset between the clocks of the clients and the server, the way NTP does,
+so clients can take pictures at times given by the server's clock.
+
+The server sends its time (t0), the client notes when it got it (t1) and when it
+replies (t2), and the server notes when it got the reply (t3). Assuming the way there
+and back take the same time, the offset of the client's clock is the average of
+the differences, and the error is at most half the round trip delay.
+"""
+from typing import List
+
+import time
+
+# Time left to a scheduled time under which we spin instead of sleeping,
+# as sleeps may overshoot by this much.
+_SPIN_SEC = 0.001
+
+
+class ClockSample(object):
+    __slots__ = ('t0', 't1', 't2', 't3')
+
+    def __init__(self, t0: float, t1: float, t2: float, t3: float):
+        # t0 and t3 are by the server's clock, t1 and t2 by the client's.
+        self.t0 = t0
+        self.t1 = t1
+        self.t2 = t2
+        self.t3 = t3
+
+    @property
+    def offset(self) -> float:
+        # How far the client's clock is ahead of the server's.
+        return ((self.t1 - self.t0) + (self.t2 - self.t3)) / 2
+
+    @property
+    def delay(self) -> float:
+        # The round trip time, without the time the client took to reply.
+        return (self.t3 - self.t0) - (self.t2 - self.t1)
+
+
+def best_sample(samples: List[ClockSample]) -> ClockSample:
+    # The sample with the least delay was the least held up on the way,
+    # so its offset has the smallest error.
+    return min(samples, key=lambda sample: sample.delay)
+
+
+class Clock(object):
+    """
+    The local clock of a client, and its offset from the server's clock.
+    """
+
+    def __init__(self, offset: float = 0.0):
+        self._offset = offset
+
+    @property
+    def offset(self) -> float:
+        return self._offset
+
+    def set_offset(self, offset: float):
+        self._offset = offset
+
+    def now(self) -> float:
+        # The time now by the server's clock.
+        return self.to_server(time.time())
+
+    def to_local(self, server_time: float) -> float:
+        return server_time + self._offset
+
+    def to_server(self, local_time: float) -> float:
+        return local_time - self._offset
+
+
+def wait_until(local_time: float):
+    # Sleeps until the given time by the local clock. The last moments are spent
+    # spinning, for precision.
+    while True:
+        left = local_time - time.time()
+        if left <= 0:
+            return
+        if left > _SPIN_SEC:
+            time.sleep(left - _SPIN_SEC)
@@ -1,15 +1,26 @@
 from abc import ABC, abstractmethod
 import enum
+import math
 import struct
 
 
-from typing import Optional, Tuple
+from typing import Optional, Tuple, List
 
 # type + parameters
 MAX_COMMAND_SIZE = 1024
 # All command values must be of size 6
 COMMAND_TYPE_SIZE = 6
 
+# Commands may come in an envelope, which carries the id of the request. Clients echo
+# the id in their replies, so replies can be told from left-overs of earlier requests.
+# Commands without the envelope (from older servers) have no request id.
+ENVELOPE_MAGIC = 0xc7  # not the first byte of any command type
+ENVELOPE_VERSION = 1
+ENVELOPE = struct.Struct('=BBi')  # magic, version, request id
+NO_REQUEST_ID = 0
+# Request ids are positive, and fit in the signed fields of replies.
+MAX_REQUEST_ID = 0x7fffffff
+
 
 class CommandParams(ABC):
 
@@ -23,6 +34,139 @@ class CommandParams(ABC):
 
 
 class TakePictureParams(CommandParams):
+    _STRUCT = struct.Struct('id')
+    # Before capture times, only the picture id was sent.
+    _LEGACY_STRUCT = struct.Struct('i')
+
+    def __init__(self, picture_id: int = -1, capture_time: float = 0.0):
+        self._picture_id = picture_id
+        # When to take the picture by the server's clock, or 0 to take it right away.
+        self._capture_time = capture_time
+
+    @property
+    def picture_id(self) -> int:
+        return self._picture_id
+
+    @property
+    def capture_time(self) -> float:
+        return self._capture_time
+
+    def pack(self) -> bytes:
+        return self._STRUCT.pack(self._picture_id, self._capture_time)
+
+    def unpack(self, data: bytes):
+        if len(data) < self._STRUCT.size:
+            self._picture_id, = self._LEGACY_STRUCT.unpack(data)
+            self._capture_time = 0.0
+        else:
+            self._picture_id, self._capture_time = self._STRUCT.unpack(data)
+
+
+class SyncClockParams(CommandParams):
+
+    def __init__(self, server_time: float = 0.0):
+        # When the server sent the command, by its clock.
+        self._server_time = server_time
+
+    @property
+    def server_time(self) -> float:
+        return self._server_time
+
+    def pack(self) -> bytes:
+        return struct.pack('d', self._server_time)
+
+    def unpack(self, data: bytes):
+        self._server_time, = struct.unpack('d', data)
+
+
+class ClockOffsetParams(CommandParams):
+
+    def __init__(self, offset: float = 0.0):
+        # How far the client's clock is ahead of the server's.
+        self._offset = offset
+
+    @property
+    def offset(self) -> float:
+        return self._offset
+
+    def pack(self) -> bytes:
+        return struct.pack('d', self._offset)
+
+    def unpack(self, data: bytes):
+        self._offset, = struct.unpack('d', data)
+
+
+class AssignShardParams(CommandParams):
+
+    def __init__(self, port: int = -1):
+        self._port = port
+
+    @property
+    def port(self) -> int:
+        return self._port
+
+    def pack(self) -> bytes:
+        return struct.pack('i', self._port)
+
+    def unpack(self, data: bytes):
+        self._port, = struct.unpack('i', data)
+
+
+class StreamParams(CommandParams):
+    _STRUCT = struct.Struct('dii')
+
+    def __init__(self, fps: float = 0.0, first_id: int = 0, limit: int = 0):
+        self._fps = fps
+        # Frames are numbered from first_id, and only frames before limit may be sent
+        # until the server gives more credit.
+        self._first_id = first_id
+        self._limit = limit
+
+    @property
+    def fps(self) -> float:
+        return self._fps
+
+    @property
+    def frame_interval(self) -> Optional[float]:
+        # The time between frames, None if the frame rate is not a positive number.
+        if not 0 < self._fps < math.inf:
+            return None
+        return 1 / self._fps
+
+    @property
+    def first_id(self) -> int:
+        return self._first_id
+
+    @property
+    def limit(self) -> int:
+        return self._limit
+
+    def pack(self) -> bytes:
+        return self._STRUCT.pack(self._fps, self._first_id, self._limit)
+
+    def unpack(self, data: bytes):
+        self._fps, self._first_id, self._limit = self._STRUCT.unpack(data)
+
+
+class CreditParams(CommandParams):
+
+    def __init__(self, limit: int = 0):
+        # Frames with ids before the limit may be sent. The limit only grows, so a lost
+        # credit is made up for by the next one.
+        self._limit = limit
+
+    @property
+    def limit(self) -> int:
+        return self._limit
+
+    def pack(self) -> bytes:
+        return struct.pack('i', self._limit)
+
+    def unpack(self, data: bytes):
+        self._limit, = struct.unpack('i', data)
+
+
+class AcknowledgeParams(CommandParams):
 
     def __init__(self, picture_id: int = -1):
         self._picture_id = picture_id
@@ -38,10 +182,60 @@ class TakePictureParams(CommandParams):
         self._picture_id, = struct.unpack('i', data)
 
 
+class ResumeParams(CommandParams):
+    _HEADER = struct.Struct('i')
+    _INDEX = struct.Struct('i')
+    # As many part indexes as fit in a command.
+    MAX_PARTS = (MAX_COMMAND_SIZE - ENVELOPE.size - COMMAND_TYPE_SIZE - _HEADER.size) // _INDEX.size
+
+    def __init__(self, picture_id: int = -1, missing: Optional[List[int]] = None):
+        self._picture_id = picture_id
+        # The indexes of the parts of the picture the server is missing.
+        self._missing = [] if missing is None else missing[:self.MAX_PARTS]
+
+    @property
+    def picture_id(self) -> int:
+        return self._picture_id
+
+    @property
+    def missing(self) -> List[int]:
+        return self._missing
+
+    def pack(self) -> bytes:
+        return self._HEADER.pack(self._picture_id) + struct.pack('{}i'.format(len(self._missing)), *self._missing)
+
+    def unpack(self, data: bytes):
+        self._picture_id, = self._HEADER.unpack_from(data)
+        count = (len(data) - self._HEADER.size) // self._INDEX.size
+        self._missing = list(struct.unpack_from('{}i'.format(count), data, self._HEADER.size))
+
+
 class CommandType(enum.Enum):
     REGISTER = (b'regist', None)
     TAKE_PICTURE = (b'takpic', TakePictureParams)
     SEND_NEXT_PICTURE = (b'senimg', None)
+    # Send all the stored pictures one after the other, followed by no-image.
+    SEND_ALL_PICTURES = (b'senall', None)
+    # Registered clients reply with their id, and clients which aren't registered register instead.
+    PING = (b'pingme', None)
+    # Send images from now on to another port of the server, where the shard handling us is.
+    ASSIGN_SHARD = (b'asgshd', AssignShardParams)
+    # Reply right away with when the command was received and when the reply is sent.
+    SYNC_CLOCK = (b'synclk', SyncClockParams)
+    # The offset of the client's clock, as estimated by the server from clock syncs.
+    SET_CLOCK_OFFSET = (b'setclk', ClockOffsetParams)
+    # Take pictures at a frame rate and send each as it is taken, as long as there is credit.
+    # If already streaming, changes the frame rate.
+    START_STREAM = (b'stream', StreamParams)
+    # More credit for streaming.
+    CREDIT = (b'credit', CreditParams)
+    # Stop streaming, followed by no-image once the last frame was sent.
+    STOP_STREAM = (b'stpstr', None)
+    # The server received the picture, so it may be forgotten. Pictures sent and not
+    # acknowledged are sent again once there are no others to send.
+    ACKNOWLEDGE_PICTURE = (b'ackimg', AcknowledgeParams)
+    # Send again the parts the server is missing of a picture whose transfer was cut off.
+    RESUME_PICTURE = (b'resume', ResumeParams)
 
     @staticmethod
     def from_header(header: bytes):
@@ -52,19 +246,35 @@ class CommandType(enum.Enum):
         raise ValueError('unknown command: ' + str(header))
 
 
-def pack_command(command: CommandType, params: Optional[CommandParams]) -> bytes:
+def pack_command(command: CommandType, params: Optional[CommandParams], request_id: int = NO_REQUEST_ID) -> bytes:
+    # With a request id, the command is put in an envelope.
     type_header, params_class = command.value
     if params is None:
         if params_class is not None:
             raise ValueError('expected parameters of type: ' + params_class)
-        return type_header
+        data = type_header
     else:
         if params_class != type(params):
             raise ValueError('expected parameters of type: ' + params_class)
-        return type_header + params.pack()
+        data = type_header + params.pack()
 
+    if request_id == NO_REQUEST_ID:
+        return data
+    return ENVELOPE.pack(ENVELOPE_MAGIC, ENVELOPE_VERSION, request_id) + data
+
+
+def unpack_request(data: bytes) -> Tuple[CommandType, Optional[CommandParams], int]:
+    """
+    Unpacks a command, in an envelope or not. Returns the command, its parameters
+    and the id of the request (NO_REQUEST_ID if not in an envelope).
+    """
+    request_id = NO_REQUEST_ID
+    if len(data) > 0 and data[0] == ENVELOPE_MAGIC:
+        magic, version, request_id = ENVELOPE.unpack_from(data)
+        if version != ENVELOPE_VERSION:
+            raise ValueError('unknown command envelope version: ' + str(version))
+        data = data[ENVELOPE.size:]
 
-def unpack_command(data: bytes) -> Tuple[CommandType, Optional[CommandParams]]:
     type_header = data[:COMMAND_TYPE_SIZE]
     command_type = CommandType.from_header(type_header)
     params_class = command_type.value[1]
@@ -75,4 +285,9 @@ def unpack_command(data: bytes) -> Tuple[CommandType, Optional[CommandParams]]:
         params = params_class()
         params.unpack(params_data)
 
+    return command_type, params, request_id
+
+
+def unpack_command(data: bytes) -> Tuple[CommandType, Optional[CommandParams]]:
+    command_type, params, request_id = unpack_request(data)
     return command_type, params
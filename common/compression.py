@@ -0,0 +1,143 @@
+from typing import Tuple
+
+import enum
+import lzma
+import struct
+import zlib
+
+from common.image import Image
+from common.metrics import get_metrics
+
+
+class Codec(enum.IntEnum):
+    NONE = 0
+    ZLIB = 1
+    LZMA = 2
+
+
+# Bit mask of the codecs we can use, sent by clients when registering.
+SUPPORTED_CODECS = (1 << Codec.ZLIB) | (1 << Codec.LZMA)
+
+DEFAULT_LEVEL = 6
+# The sample compressed to decide whether compressing an image pays off
+# is made of chunks from across the image.
+ADAPTIVE_SAMPLE_CHUNKS = 4
+ADAPTIVE_SAMPLE_CHUNK_SIZE = 16 * 1024
+# Compression pays off only if the sample shrinks to less than this.
+ADAPTIVE_MAX_RATIO = 0.9
+# Images are compressed this much at a time, so images in files aren't read whole.
+COMPRESS_CHUNK_SIZE = 1024 * 1024
+# Raised by decompress for corrupt or truncated data (and by Codec for unknown codecs).
+DECOMPRESSION_ERRORS = (zlib.error, lzma.LZMAError, ValueError)
+
+
+def compress(codec: Codec, data, level: int = DEFAULT_LEVEL) -> bytes:
+    if codec == Codec.ZLIB:
+        return zlib.compress(data, level)
+    if codec == Codec.LZMA:
+        return lzma.compress(data, preset=level)
+    return bytes(data)
+
+
+def compress_image_data(codec: Codec, image: Image, level: int = DEFAULT_LEVEL) -> bytes:
+    # Like compress on the data of the image, reading it a part at a time.
+    if codec == Codec.ZLIB:
+        compressor = zlib.compressobj(level)
+    elif codec == Codec.LZMA:
+        compressor = lzma.LZMACompressor(preset=level)
+    else:
+        return b''.join(image.read_part(offset, COMPRESS_CHUNK_SIZE)
+                        for offset in range(0, len(image), COMPRESS_CHUNK_SIZE))
+
+    chunks = [compressor.compress(image.read_part(offset, COMPRESS_CHUNK_SIZE))
+              for offset in range(0, len(image), COMPRESS_CHUNK_SIZE)]
+    chunks.append(compressor.flush())
+    return b''.join(chunks)
+
+
+def decompress(codec: Codec, data) -> bytes:
+    if codec == Codec.ZLIB:
+        return zlib.decompress(data)
+    if codec == Codec.LZMA:
+        return lzma.decompress(data)
+    return data
+
+
+class CompressionSettings(object):
+    """
+    How a client should compress its images. Chosen by the server when the
+    client registers, out of the codecs the client supports.
+    """
+    FORMAT = 'BbB'  # codec, level, adaptive
+    STRUCT = struct.Struct(FORMAT)
+
+    def __init__(self, codec: Codec = Codec.NONE, level: int = DEFAULT_LEVEL, adaptive: bool = True):
+        self._codec = codec
+        self._level = level
+        self._adaptive = adaptive
+
+    @property
+    def codec(self) -> Codec:
+        return self._codec
+
+    @property
+    def level(self) -> int:
+        return self._level
+
+    @property
+    def adaptive(self) -> bool:
+        return self._adaptive
+
+    def negotiate(self, supported_codecs: int) -> 'CompressionSettings':
+        # The settings to give a client supporting the codecs in the mask.
+        if self._codec == Codec.NONE or (supported_codecs & (1 << self._codec)) == 0:
+            return CompressionSettings(Codec.NONE)
+        return self
+
+    def pack(self) -> bytes:
+        return self.STRUCT.pack(self._codec, self._level, 1 if self._adaptive else 0)
+
+    @staticmethod
+    def unpack(data: bytes) -> 'CompressionSettings':
+        codec, level, adaptive = CompressionSettings.STRUCT.unpack_from(data)
+        return CompressionSettings(Codec(codec), level, adaptive != 0)
+
+
+class Compressor(object):
+    """
+    Compresses images before they are sent.
+    In adaptive mode, a sample of each image is compressed first, and the image
+    is sent as is if the sample does not shrink enough.
+    Compressed images are sent from memory: images in files (see FileImage) are read
+    a part at a time to be compressed, and are only sent straight from their files
+    when they are sent as is.
+    """
+
+    def __init__(self, settings: CompressionSettings):
+        self._settings = settings
+
+    def compress_image(self, image: Image) -> Tuple[Codec, Image]:
+        codec = self._settings.codec
+        if codec == Codec.NONE or len(image) == 0:
+            return Codec.NONE, image
+
+        metrics = get_metrics()
+        if self._settings.adaptive and len(image) > ADAPTIVE_SAMPLE_CHUNKS * ADAPTIVE_SAMPLE_CHUNK_SIZE:
+            sample = self._sample(image)
+            if len(compress(codec, sample, self._settings.level)) > len(sample) * ADAPTIVE_MAX_RATIO:
+                metrics.counter('compression.skipped_images').add()
+                return Codec.NONE, image
+
+        data = compress_image_data(codec, image, self._settings.level)
+        if len(data) >= len(image):
+            metrics.counter('compression.skipped_images').add()
+            return Codec.NONE, image
+
+        metrics.counter('compression.compressed_images').add()
+        metrics.counter('compression.saved_bytes').add(len(image) - len(data))
+        return codec, Image(image.id, data, image.timestamp)
+
+    def _sample(self, image: Image) -> bytes:
+        step = len(image) // ADAPTIVE_SAMPLE_CHUNKS
+        return b''.join(image.read_part(i * step, ADAPTIVE_SAMPLE_CHUNK_SIZE)
+                        for i in range(ADAPTIVE_SAMPLE_CHUNKS))
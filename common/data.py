@@ -1,2 +1,36 @@
+import struct
+
+from common.command import NO_REQUEST_ID
 
 REGISTER_RESPONSE = b'hi'
+# Following the register response, the codecs the client supports (see common.compression).
+REGISTER_CODECS = struct.Struct('I')
+# The reply to the register response is the client id, followed by the compression settings.
+REGISTER_ID = struct.Struct('i')
+# Reply of registered clients to a ping, followed by the client id.
+PING_RESPONSE = b'po'
+# Reply to a clock sync, followed by the server time from the command, and the client
+# times when it was received and when the reply was sent (see common.clock).
+CLOCK_RESPONSE = b'tm'
+CLOCK_TIMES = struct.Struct('ddd')
+# Reply to a shard assignment, followed by the port images are now sent to.
+SHARD_RESPONSE = b'sh'
+SHARD_PORT = struct.Struct('i')
+
+# Replies to commands which came with a request id (see common.command) are followed by
+# the id, so the server can tell them from replies to earlier requests.
+REPLY_REQUEST_ID = struct.Struct('i')
+
+
+def pack_reply(data: bytes, request_id: int) -> bytes:
+    if request_id == NO_REQUEST_ID:
+        return data
+    return data + REPLY_REQUEST_ID.pack(request_id)
+
+
+def unpack_reply_request_id(data: bytes, reply_size: int) -> int:
+    # The request id following a reply of reply_size bytes, or NO_REQUEST_ID if there is none.
+    if len(data) < reply_size + REPLY_REQUEST_ID.size:
+        return NO_REQUEST_ID
+    request_id, = REPLY_REQUEST_ID.unpack_from(data, reply_size)
+    return request_id
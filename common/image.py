@@ -1,15 +1,31 @@
+from pathlib import Path
+from typing import Optional
+
+import hashlib
+import mmap
+import os
+
+# Size of the parts digests are computed over, so images are not read as a whole.
+_DIGEST_PART_SIZE = 1024 * 1024
 
 
 class Image(object):
+    __slots__ = ('_id', '_data', '_timestamp')
 
-    def __init__(self, id: int, data: bytes):
+    def __init__(self, id: int, data: Optional[bytes], timestamp: float = 0.0):
         self._id = id
         self._data = data
+        # When the picture was taken by the server's clock, 0 if not known.
+        self._timestamp = timestamp
 
     @property
     def id(self) -> int:
         return self._id
 
+    @property
+    def timestamp(self) -> float:
+        return self._timestamp
+
     @property
     def data(self) -> bytes:
         return self._data
@@ -18,5 +34,141 @@ class Image(object):
     def extension(self):
         return 'jpg'
 
+    def read_part(self, offset: int, size: int):
+        """
+        Returns up to size bytes of the image data, starting at offset.
+        """
+        return memoryview(self._data)[offset:offset + size]
+
     def __len__(self):
         return len(self._data)
+
+
+class FileImage(Image):
+    """
+    An image whose data is in a file (or a region of a file).
+    The data is read a part at a time as it is asked for, and never kept. Parts are
+    read from the file opened on the first read and kept open for the life of the
+    image, or until it is closed.
+    """
+    __slots__ = ('_path', '_offset', '_length', '_fd')
+
+    def __init__(self, id: int, path: Path, offset: int = 0, length: int = None, timestamp: float = 0.0):
+        super().__init__(id, None, timestamp)
+        self._fd = None
+        self._path = path
+        self._offset = offset
+        if length is None:
+            length = path.stat().st_size - offset
+        self._length = length
+
+    @property
+    def path(self) -> Path:
+        return self._path
+
+    @property
+    def offset(self) -> int:
+        return self._offset
+
+    @property
+    def data(self) -> bytes:
+        # Reads all of the data each time, read_part should be used where possible.
+        return self.read_part(0, self._length)
+
+    def read_part(self, offset: int, size: int):
+        size = max(0, min(size, self._length - offset))
+        if self._fd is None:
+            self._fd = os.open(str(self._path), os.O_RDONLY)
+        return os.pread(self._fd, size, self._offset + offset)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __len__(self):
+        return self._length
+
+    def __del__(self):
+        self.close()
+
+
+class MappedFileImage(FileImage):
+    """
+    An image whose data is in a file (or a region of a file), read through a memory
+    map of it. The map is made on the first read, and parts are views of it, so they
+    are read without a system call or a copy each. The file must not be truncated
+    while the image is in use (it may be deleted).
+    """
+    __slots__ = ('_map', '_view')
+
+    def __init__(self, id: int, path: Path, offset: int = 0, length: int = None, timestamp: float = 0.0):
+        self._map = None
+        self._view = None
+        super().__init__(id, path, offset, length, timestamp)
+
+    @property
+    def data(self) -> memoryview:
+        return self._map_view()
+
+    def read_part(self, offset: int, size: int):
+        return self._map_view()[offset:offset + size]
+
+    def close(self):
+        if self._map is not None:
+            try:
+                self._view.release()
+                self._map.close()
+            except BufferError:
+                # Parts read are still in use, the map is closed once they are gone.
+                pass
+            self._map = None
+            self._view = None
+
+    def _map_view(self) -> memoryview:
+        if self._view is None:
+            if self._length == 0:
+                # Empty files can't be mapped.
+                self._view = memoryview(b'')
+                return self._view
+            # Maps start at a multiple of the allocation granularity.
+            start = self._offset - self._offset % mmap.ALLOCATIONGRANULARITY
+            with self._path.open(mode='rb') as f:
+                self._map = mmap.mmap(f.fileno(), self._offset - start + self._length, access=mmap.ACCESS_READ,
+                                      offset=start)
+            self._view = memoryview(self._map)[self._offset - start:]
+        return self._view
+
+
+class ReferenceImage(Image):
+    """
+    An image we did not receive the data of, only its digest, because
+    we already have an image with the same data.
+    """
+    __slots__ = ('_digest', '_length')
+
+    def __init__(self, id: int, digest: bytes, length: int, timestamp: float = 0.0):
+        super().__init__(id, None, timestamp)
+        self._digest = digest
+        self._length = length
+
+    @property
+    def digest(self) -> bytes:
+        return self._digest
+
+    def read_part(self, offset: int, size: int):
+        raise ValueError('image data is not available, only a reference to it')
+
+    def __len__(self):
+        return self._length
+
+
+def compute_digest(image: Image) -> bytes:
+    # Identifies the data of the image, images with the same data have the same digest.
+    if isinstance(image, ReferenceImage):
+        return image.digest
+
+    digest = hashlib.sha256()
+    for offset in range(0, len(image), _DIGEST_PART_SIZE):
+        digest.update(image.read_part(offset, _DIGEST_PART_SIZE))
+    return digest.digest()
@@ -0,0 +1,262 @@
+"""
+Counters, gauges and histograms for measuring the system, and hooks for tracing events.
+
+All the code reports to the global metrics, which by default are disabled: every
+instrument is a shared object which does nothing. To collect, install enabled metrics:
+
+    metrics.set_metrics(metrics.Metrics(exporters=[metrics.PrintExporter()]))
+
+and call export() on them (or start_export) to send a snapshot to the exporters.
+"""
+from abc import ABC, abstractmethod
+from collections import deque
+from pathlib import Path
+from typing import Dict, List, Callable, Optional
+
+import json
+import threading
+import time
+
+HISTOGRAM_SAMPLES = 1024
+
+
+class Counter(object):
+    __slots__ = ('_value', '_lock')
+
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def add(self, amount: int = 1):
+        with self._lock:
+            self._value += amount
+
+    def snapshot(self):
+        with self._lock:
+            return self._value
+
+
+class Gauge(object):
+    __slots__ = ('_value',)
+
+    def __init__(self):
+        self._value = 0
+
+    def set(self, value: float):
+        self._value = value
+
+    def snapshot(self):
+        return self._value
+
+
+class Histogram(object):
+    """
+    Keeps the count, sum, min and max of all the values recorded, and the last
+    HISTOGRAM_SAMPLES values for percentiles.
+    """
+    __slots__ = ('_count', '_sum', '_min', '_max', '_samples', '_lock')
+
+    def __init__(self):
+        self._count = 0
+        self._sum = 0.0
+        self._min = None
+        self._max = None
+        self._samples = deque(maxlen=HISTOGRAM_SAMPLES)
+        self._lock = threading.Lock()
+
+    def record(self, value: float):
+        with self._lock:
+            self._count += 1
+            self._sum += value
+            if self._min is None or value < self._min:
+                self._min = value
+            if self._max is None or value > self._max:
+                self._max = value
+            self._samples.append(value)
+
+    def snapshot(self):
+        with self._lock:
+            samples = sorted(self._samples)
+            snapshot = {
+                'count': self._count,
+                'sum': self._sum,
+                'min': self._min,
+                'max': self._max,
+                'mean': self._sum / self._count if self._count > 0 else None,
+            }
+
+        for percent in (50, 90, 99):
+            value = None
+            if len(samples) > 0:
+                value = samples[min(len(samples) - 1, int(round(percent / 100 * (len(samples) - 1))))]
+            snapshot['p{}'.format(percent)] = value
+
+        return snapshot
+
+
+class _NullInstrument(object):
+    __slots__ = ()
+
+    def add(self, amount: int = 1):
+        pass
+
+    def set(self, value: float):
+        pass
+
+    def record(self, value: float):
+        pass
+
+    def snapshot(self):
+        return None
+
+
+class Exporter(ABC):
+
+    @abstractmethod
+    def export(self, snapshot: Dict):
+        pass
+
+
+class PrintExporter(Exporter):
+
+    def export(self, snapshot: Dict):
+        for name, value in sorted(snapshot.items()):
+            print(name, value)
+
+
+class JsonLinesExporter(Exporter):
+    """
+    Appends each snapshot as a line of JSON to a file.
+    """
+
+    def __init__(self, path: Path):
+        self._path = path
+
+    def export(self, snapshot: Dict):
+        with self._path.open(mode='a') as f:
+            f.write(json.dumps(snapshot) + '\n')
+
+
+class CallbackExporter(Exporter):
+
+    def __init__(self, callback: Callable[[Dict], None]):
+        self._callback = callback
+
+    def export(self, snapshot: Dict):
+        self._callback(snapshot)
+
+
+class Metrics(object):
+    """
+    Creates instruments by name, so every place reporting under a name
+    updates the same instrument.
+    Tracers are called with every traced event.
+    """
+
+    def __init__(self, exporters: Optional[List[Exporter]] = None,
+                 tracers: Optional[List[Callable[..., None]]] = None):
+        self._exporters = exporters if exporters is not None else []
+        self._tracers = tracers if tracers is not None else []
+        self._instruments = {}
+        self._lock = threading.Lock()
+        self._export_thread = None
+        self._export_stop = threading.Event()
+
+    @property
+    def enabled(self) -> bool:
+        return True
+
+    def counter(self, name: str) -> Counter:
+        return self._instrument(name, Counter)
+
+    def gauge(self, name: str) -> Gauge:
+        return self._instrument(name, Gauge)
+
+    def histogram(self, name: str) -> Histogram:
+        return self._instrument(name, Histogram)
+
+    def trace(self, event: str, **fields):
+        for tracer in self._tracers:
+            tracer(event, time.time(), **fields)
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            instruments = list(self._instruments.items())
+        return {name: instrument.snapshot() for name, instrument in instruments}
+
+    def export(self):
+        snapshot = self.snapshot()
+        for exporter in self._exporters:
+            exporter.export(snapshot)
+
+    def start_export(self, interval: float):
+        # Exports in the background every interval seconds, until stop_export.
+        self._export_stop.clear()
+        self._export_thread = threading.Thread(target=self._export_loop, args=(interval,),
+                                               name='metrics-export', daemon=True)
+        self._export_thread.start()
+
+    def stop_export(self):
+        if self._export_thread is not None:
+            self._export_stop.set()
+            self._export_thread.join()
+            self._export_thread = None
+        self.export()
+
+    def _export_loop(self, interval: float):
+        while not self._export_stop.wait(interval):
+            self.export()
+
+    def _instrument(self, name: str, instrument_class):
+        instrument = self._instruments.get(name)
+        if instrument is None:
+            with self._lock:
+                instrument = self._instruments.setdefault(name, instrument_class())
+
+        return instrument
+
+
+class NullMetrics(Metrics):
+    """
+    Disabled metrics. All the instruments are a single object which does nothing.
+    """
+
+    _NULL_INSTRUMENT = _NullInstrument()
+
+    @property
+    def enabled(self) -> bool:
+        return False
+
+    def counter(self, name: str) -> Counter:
+        return self._NULL_INSTRUMENT
+
+    def gauge(self, name: str) -> Gauge:
+        return self._NULL_INSTRUMENT
+
+    def histogram(self, name: str) -> Histogram:
+        return self._NULL_INSTRUMENT
+
+    def trace(self, event: str, **fields):
+        pass
+
+    def snapshot(self) -> Dict:
+        return {}
+
+    def start_export(self, interval: float):
+        pass
+
+
+def print_tracer(event: str, timestamp: float, **fields):
+    print(event, ' '.join('{}={}'.format(name, value) for name, value in fields.items()))
+
+
+_metrics: Metrics = NullMetrics()
+
+
+def get_metrics() -> Metrics:
+    return _metrics
+
+
+def set_metrics(metrics: Metrics):
+    global _metrics
+    _metrics = metrics
@@ -0,0 +1,88 @@
+"""
+Pacing of sends, so a sender doesn't send faster than the receiver (or the network)
+can take, which over UDP means losing datagrams without knowing.
+"""
+import time
+
+from common.metrics import get_metrics
+
+# How many bytes may be sent at once, before pacing kicks in.
+DEFAULT_BURST_SIZE = 256 * 1024
+
+# Adaptive pacing starts at this rate, and stays between the minimum and maximum rates.
+DEFAULT_INITIAL_RATE = 32 * 1024 * 1024  # bytes per second
+DEFAULT_MIN_RATE = 1024 * 1024
+DEFAULT_MAX_RATE = 1024 * 1024 * 1024
+# Each report without loss raises the rate by this much.
+DEFAULT_RATE_INCREASE = 4 * 1024 * 1024
+# Each report with loss cuts the rate by this factor.
+DEFAULT_RATE_DECREASE = 0.7
+# Loss below this fraction of the parts reported on is not taken as congestion.
+LOSS_TOLERANCE = 0.01
+
+
+class Pacer(object):
+    """
+    Limits the rate of sending to a fixed number of bytes per second, with a token bucket:
+    up to burst_size bytes may be sent at once, and then sends wait for the bucket to refill.
+    """
+
+    def __init__(self, rate: float, burst_size: int = DEFAULT_BURST_SIZE):
+        self._rate = rate
+        self._burst_size = burst_size
+        self._tokens = burst_size
+        self._last_time = time.perf_counter()
+
+    @property
+    def rate(self) -> float:
+        return self._rate
+
+    def wait(self, size: int):
+        # Takes size bytes out of the bucket, first waiting until they are in it.
+        delay = self.delay(size)
+        if delay > 0:
+            time.sleep(delay)
+
+    def delay(self, size: int) -> float:
+        # Takes size bytes out of the bucket, and returns how long to wait before
+        # sending them (for callers which can't sleep, e.g. in asyncio).
+        now = time.perf_counter()
+        self._tokens = min(self._burst_size, self._tokens + (now - self._last_time) * self._rate)
+        self._last_time = now
+
+        self._tokens -= size
+        return -self._tokens / self._rate if self._tokens < 0 else 0.0
+
+    def on_feedback(self, reported: int, lost: int):
+        """
+        Tells of how many of the parts sent the receiver reported on, and how many
+        of those were lost. The rate is fixed, so this does nothing.
+        """
+        pass
+
+
+class AdaptivePacer(Pacer):
+    """
+    Paces sends at a rate which adapts to the loss reported by the receiver: the rate
+    is raised a little for every report without loss, and cut by a factor for every
+    report with loss (additive increase, multiplicative decrease, like TCP).
+    """
+
+    def __init__(self, rate: float = DEFAULT_INITIAL_RATE, min_rate: float = DEFAULT_MIN_RATE,
+                 max_rate: float = DEFAULT_MAX_RATE, increase: float = DEFAULT_RATE_INCREASE,
+                 decrease: float = DEFAULT_RATE_DECREASE, burst_size: int = DEFAULT_BURST_SIZE):
+        super().__init__(rate, burst_size)
+        self._min_rate = min_rate
+        self._max_rate = max_rate
+        self._increase = increase
+        self._decrease = decrease
+
+    def on_feedback(self, reported: int, lost: int):
+        if reported <= 0:
+            return
+
+        if lost > reported * LOSS_TOLERANCE:
+            self._rate = max(self._min_rate, self._rate * self._decrease)
+        else:
+            self._rate = min(self._max_rate, self._rate + self._increase)
+        get_metrics().gauge('udp.pacing_rate').set(self._rate)
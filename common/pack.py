@@ -0,0 +1,243 @@
+from pathlib import Path
+from typing import Dict, Tuple, Iterator, Optional
+
+import mmap
+import os
+import struct
+import threading
+
+from common.metrics import get_metrics
+
+INDEX_FILE_NAME = 'index'
+SEGMENT_FILE_FORMAT = 'segment-{:06d}.pack'
+SEGMENT_FILE_PATTERN = 'segment-*.pack'
+INDEX_RECORD = struct.Struct('=iiIQId')  # client_id, image_id, segment, offset, length, timestamp
+# The segment of the index records of removed images.
+_REMOVED_SEGMENT = 0xFFFFFFFF
+# The index is compacted once it has more than this many records, and more than
+# this many times as many records as images kept.
+_COMPACT_MIN_RECORDS = 1024
+_COMPACT_RATIO = 2
+
+DEFAULT_MAX_SEGMENT_SIZE = 256 * 1024 * 1024
+
+
+class PackFile(object):
+    """
+    Stores images by appending them to large segment files, instead of a file per image.
+    An index file maps each (client_id, image_id) to where its data is. The index is
+    appended to after the data, so an image is only known once all of it was written.
+    Images are read through memory maps of the segments, without copying them.
+    Images may be removed: a segment is deleted once all its images are removed (or
+    replaced), and the index is compacted as it fills up with removed images.
+    """
+
+    def __init__(self, path: Path, max_segment_size: int = DEFAULT_MAX_SEGMENT_SIZE):
+        self._path = path
+        self._max_segment_size = max_segment_size
+
+        if not self._path.exists():
+            self._path.mkdir(parents=True)
+
+        # (client_id, image_id) -> (segment, offset, length, timestamp)
+        self._index: Dict[Tuple[int, int], Tuple[int, int, int, float]] = {}
+        # Segment -> how many images in the index are in it.
+        self._segment_images: Dict[int, int] = {}
+        self._index_records = 0
+        self._index_file = None
+        self._load_index()
+
+        self._lock = threading.Lock()
+        self._maps: Dict[int, mmap.mmap] = {}
+
+        segments = {int(path.stem.split('-')[1]) for path in self._path.glob(SEGMENT_FILE_PATTERN)}
+        # Images of segments deleted after removing them from an index which was not synced.
+        for key, location in list(self._index.items()):
+            if location[0] not in segments:
+                self._set_location(key, None)
+        # Appending goes on in the last segment, even if its images were all removed.
+        self._segment = max(segments, default=0)
+        for segment in segments:
+            if segment != self._segment and segment not in self._segment_images:
+                self._retire_segment(segment)
+        self._segment_file = None
+        self._segment_size = 0
+        self._open_segment(self._segment)
+        self._index_file = open(str(self._index_path), mode='ab', buffering=0)
+
+    def __contains__(self, key: Tuple[int, int]) -> bool:
+        return key in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def keys(self) -> Iterator[Tuple[int, int]]:
+        return iter(list(self._index.keys()))
+
+    def append(self, client_id: int, image_id: int, data: bytes, timestamp: float = 0.0):
+        # An image appended again with the same key replaces the first.
+        length = len(data)
+        with self._lock:
+            # Start a new segment once the current one is full, but never
+            # leave a segment empty.
+            if self._segment_size > 0 and self._segment_size + length > self._max_segment_size:
+                previous = self._segment
+                self._open_segment(self._segment + 1)
+                if self._segment_images.get(previous, 0) == 0:
+                    self._retire_segment(previous)
+
+            offset = self._segment_size
+            self._segment_file.write(data)
+            self._segment_size += length
+
+            location = (self._segment, offset, length, timestamp)
+            self._write_index(client_id, image_id, location)
+            self._set_location((client_id, image_id), location)
+
+    def remove(self, client_id: int, image_id: int):
+        with self._lock:
+            if (client_id, image_id) not in self._index:
+                return
+            self._write_index(client_id, image_id, (_REMOVED_SEGMENT, 0, 0, 0.0))
+            self._set_location((client_id, image_id), None)
+
+    def timestamp_of(self, client_id: int, image_id: int) -> float:
+        return self._index[(client_id, image_id)][3]
+
+    def location_of(self, client_id: int, image_id: int) -> Optional[str]:
+        # As the segment file and the offset of the data in it.
+        location = self._index.get((client_id, image_id))
+        if location is None:
+            return None
+        return '{}@{}'.format(self._segment_path(location[0]), location[1])
+
+    def read(self, client_id: int, image_id: int) -> memoryview:
+        segment, offset, length, timestamp = self._index[(client_id, image_id)]
+        if length == 0:
+            return memoryview(b'')
+
+        with self._lock:
+            segment_map = self._maps.get(segment)
+            if segment_map is None or len(segment_map) < offset + length:
+                # The segment grew since we mapped it (or was never mapped).
+                # The old map is not closed, since views of it may still be in use.
+                segment_map = self._map_segment(segment)
+
+        return memoryview(segment_map)[offset:offset + length]
+
+    def flush(self):
+        with self._lock:
+            os.fsync(self._segment_file.fileno())
+            os.fsync(self._index_file.fileno())
+
+    def close(self):
+        with self._lock:
+            self._segment_file.close()
+            self._index_file.close()
+            for segment_map in self._maps.values():
+                try:
+                    segment_map.close()
+                except BufferError:
+                    # Images read from it are still in use, it is closed once they are gone.
+                    pass
+            self._maps.clear()
+
+    def _write_index(self, client_id: int, image_id: int, location: Tuple[int, int, int, float]):
+        # Called with the lock held.
+        self._index_file.write(INDEX_RECORD.pack(client_id, image_id, *location))
+        self._index_records += 1
+
+    def _set_location(self, key: Tuple[int, int], location: Optional[Tuple[int, int, int, float]]):
+        # Called with the lock held (or while loading), after the index file has the change.
+        previous = self._index.pop(key, None)
+        if location is not None:
+            self._index[key] = location
+            self._segment_images[location[0]] = self._segment_images.get(location[0], 0) + 1
+        if previous is not None:
+            self._segment_images[previous[0]] -= 1
+            if self._segment_images[previous[0]] == 0:
+                del self._segment_images[previous[0]]
+                if self._index_file is not None and previous[0] != self._segment:
+                    self._retire_segment(previous[0])
+
+        if self._index_file is not None and \
+                self._index_records > max(_COMPACT_MIN_RECORDS, _COMPACT_RATIO * len(self._index)):
+            self._compact_index()
+
+    def _retire_segment(self, segment: int):
+        # Deletes a segment none of the images in the index are in.
+        segment_map = self._maps.pop(segment, None)
+        if segment_map is not None:
+            try:
+                segment_map.close()
+            except BufferError:
+                # Images read from it are still in use, it is closed once they are gone.
+                pass
+        try:
+            self._segment_path(segment).unlink()
+        except FileNotFoundError:
+            pass
+        get_metrics().counter('pack.retired_segments').add()
+
+    def _compact_index(self):
+        # Rewrites the index with only the images kept. Written to the side and
+        # replaced, so a crash leaves either index whole.
+        temp_path = self._index_path.with_name(INDEX_FILE_NAME + '.tmp')
+        with temp_path.open(mode='wb') as f:
+            f.write(b''.join(INDEX_RECORD.pack(client_id, image_id, *location)
+                             for (client_id, image_id), location in self._index.items()))
+            f.flush()
+            os.fsync(f.fileno())
+        self._index_file.close()
+        os.replace(str(temp_path), str(self._index_path))
+        self._index_file = open(str(self._index_path), mode='ab', buffering=0)
+        self._index_records = len(self._index)
+        get_metrics().counter('pack.index_compactions').add()
+
+    def _load_index(self):
+        if not self._index_path.exists():
+            return
+
+        with self._index_path.open(mode='rb') as f:
+            data = f.read()
+
+        # Ignore a partially written record at the end, and cut it off, so the next ones are whole.
+        usable_size = len(data) - len(data) % INDEX_RECORD.size
+        if usable_size < len(data):
+            with self._index_path.open(mode='r+b') as f:
+                f.truncate(usable_size)
+
+        for client_id, image_id, segment, offset, length, timestamp in INDEX_RECORD.iter_unpack(data[:usable_size]):
+            self._index_records += 1
+            location = None if segment == _REMOVED_SEGMENT else (segment, offset, length, timestamp)
+            self._set_location((client_id, image_id), location)
+
+    def _open_segment(self, segment: int):
+        if self._segment_file is not None:
+            self._segment_file.close()
+
+        # Writes are not buffered by us, so maps of the segment see them right away.
+        self._segment = segment
+        self._segment_file = open(str(self._segment_path(segment)), mode='ab', buffering=0)
+        self._segment_size = self._segment_file.tell()
+
+    def _map_segment(self, segment: int) -> mmap.mmap:
+        with open(str(self._segment_path(segment)), mode='rb') as f:
+            segment_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self._maps[segment] = segment_map
+        return segment_map
+
+    def _segment_path(self, segment: int) -> Path:
+        return self._path / SEGMENT_FILE_FORMAT.format(segment)
+
+    @property
+    def _index_path(self) -> Path:
+        return self._path / INDEX_FILE_NAME
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return self
@@ -0,0 +1,276 @@
+"""
+Image transfers over TCP. Each client keeps a single connection to the server open,
+and sends its images over it one after the other, each as a header followed by the data.
+
+Images whose data is in a file are sent straight from the file by the kernel (sendfile),
+without being read into memory.
+"""
+from collections import deque
+from typing import Optional, Tuple, Dict, List, Callable
+
+import hashlib
+import selectors
+import socket
+import struct
+
+from common.compression import Codec, DECOMPRESSION_ERRORS, decompress
+from common.image import Image, FileImage, ReferenceImage
+from common.metrics import get_metrics
+from common.udp import FLAG_DIGEST_OFFER, FLAG_CODEC_SHIFT, FLAG_CODEC_MASK, DIGEST_REPLY_MARKER, DIGEST_REPLY
+
+# The socket parameters of the functions here shadow the module.
+_socket_timeout = socket.timeout
+
+FRAME_HEADER_FORMAT = 'iiIQd'  # client_id, image_id, flags, image size, capture time
+FRAME_HEADER = struct.Struct(FRAME_HEADER_FORMAT)
+# Digest offers carry the digest instead of the image data.
+DIGEST_SIZE = hashlib.sha256().digest_size
+DIGEST_REPLY_SIZE = len(DIGEST_REPLY_MARKER) + DIGEST_REPLY.size
+
+LISTEN_BACKLOG = 128
+# Data is read from the connections in chunks of up to this size.
+_RECEIVE_CHUNK_SIZE = 1024 * 1024
+
+
+def send_image(socket: socket.socket, sender_id: int, image: Image, codec: Codec = Codec.NONE):
+    # If the image data was compressed, codec tells the receiver how to decompress it.
+    flags = codec << FLAG_CODEC_SHIFT
+    socket.sendall(FRAME_HEADER.pack(sender_id, image.id, flags, len(image), image.timestamp))
+
+    metrics = get_metrics()
+    if isinstance(image, FileImage) and codec == Codec.NONE:
+        # Let the kernel copy the data from the file to the socket.
+        with image.path.open(mode='rb') as f:
+            socket.sendfile(f, image.offset, len(image))
+        metrics.counter('tcp.sendfile_images').add()
+    elif len(image) > 0:
+        socket.sendall(image.read_part(0, len(image)))
+
+    metrics.counter('tcp.images_sent').add()
+    metrics.counter('tcp.bytes_sent').add(FRAME_HEADER.size + len(image))
+
+
+def send_no_image(socket: socket.socket, sender_id: int):
+    # Like over UDP, an image id of -1 means we have no more images.
+    socket.sendall(FRAME_HEADER.pack(sender_id, -1, 0, 0, 0.0))
+
+
+def offer_digest(socket: socket.socket, sender_id: int, image: Image, digest: bytes) -> bool:
+    # Sends the digest of the image instead of the image, and returns whether
+    # the receiver wants the image itself.
+    header = FRAME_HEADER.pack(sender_id, image.id, FLAG_DIGEST_OFFER, len(image), image.timestamp)
+    socket.sendall(header + digest)
+
+    reply = _receive_exactly(socket, DIGEST_REPLY_SIZE)
+    reply_sender_id, image_id, wanted = DIGEST_REPLY.unpack_from(reply, len(DIGEST_REPLY_MARKER))
+    return wanted != 0
+
+
+def _receive_exactly(socket: socket.socket, size: int) -> bytes:
+    data = bytearray(size)
+    view = memoryview(data)
+    received = 0
+    while received < size:
+        count = socket.recv_into(view[received:])
+        if count == 0:
+            raise ConnectionError('connection closed by the receiver')
+        received += count
+    return bytes(data)
+
+
+class _FrameReader(object):
+    """
+    Reads the frames sent over one connection, as data becomes available.
+    """
+    __slots__ = ('header', 'data', 'view', 'received', 'sender_id', 'image_id', 'flags', 'size', 'timestamp',
+                 'replies')
+
+    def __init__(self):
+        self.header = bytearray(FRAME_HEADER.size)
+        # Replies to the sender waiting for room in the connection's send buffer.
+        self.replies = bytearray()
+        self._start_header()
+
+    def _start_header(self):
+        self.data = None
+        self.view = memoryview(self.header)
+        self.received = 0
+
+    def read(self, connection: socket.socket) -> Optional[Tuple[int, int, int, int, float, bytearray]]:
+        """
+        Reads what is available from the connection. Returns the next frame
+        (sender_id, image_id, flags, image size, capture time, data), if it was completed.
+        """
+        count = connection.recv_into(self.view[self.received:self.received + _RECEIVE_CHUNK_SIZE])
+        if count == 0:
+            raise ConnectionError('connection closed by the sender')
+        self.received += count
+        if self.received < len(self.view):
+            return None
+
+        if self.data is None:
+            self.sender_id, self.image_id, self.flags, self.size, self.timestamp = FRAME_HEADER.unpack(self.header)
+            if self.image_id < 0:
+                return self._complete()
+
+            # The data is received straight into its place, allocated once.
+            data_size = DIGEST_SIZE if (self.flags & FLAG_DIGEST_OFFER) != 0 else self.size
+            self.data = bytearray(data_size)
+            self.view = memoryview(self.data)
+            self.received = 0
+            if data_size > 0:
+                return None
+
+        return self._complete()
+
+    def _complete(self) -> Tuple[int, int, int, int, float, bytearray]:
+        frame = (self.sender_id, self.image_id, self.flags, self.size, self.timestamp, self.data)
+        self._start_header()
+        return frame
+
+
+class ImageReceiver(object):
+    """
+    Receives images from clients connecting to a listening socket.
+    Connections are kept open, so each client connects once and sends
+    all its images over the same connection.
+    Like the UDP receiver, completed images are kept per sender until they are asked for.
+    """
+
+    def __init__(self, listen_socket: socket.socket, timeout: Optional[float] = None,
+                 digest_lookup: Optional[Callable[[bytes], bool]] = None):
+        self._listen_socket = listen_socket
+        self._listen_socket.setblocking(False)
+        # If nothing arrives for this long, socket.timeout is raised.
+        self._timeout = timeout
+        self._digest_lookup = digest_lookup
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(listen_socket, selectors.EVENT_READ, None)
+        self._completed: Dict[int, deque] = {}
+
+    def set_digest_lookup(self, digest_lookup: Optional[Callable[[bytes], bool]]):
+        self._digest_lookup = digest_lookup
+
+    def missing_parts(self, sender_id: int) -> Dict[int, List[int]]:
+        # Frames cut off are dropped with their connection, so nothing can be resumed,
+        # the images are sent again whole.
+        return {}
+
+    def receive(self) -> Tuple[int, Optional[Image]]:
+        for sender_id, completed in self._completed.items():
+            if len(completed) > 0:
+                return sender_id, completed.popleft()
+
+        return self._receive_from_connections()
+
+    def receive_from(self, sender_id: int) -> Optional[Image]:
+        completed = self._completed.get(sender_id)
+        if completed:
+            return completed.popleft()
+
+        while True:
+            result_sender_id, image = self._receive_from_connections()
+            if result_sender_id == sender_id:
+                return image
+
+            self._completed.setdefault(result_sender_id, deque()).append(image)
+
+    def close(self):
+        for key in list(self._selector.get_map().values()):
+            if key.fileobj is not self._listen_socket:
+                key.fileobj.close()
+        self._selector.close()
+        self._listen_socket.close()
+
+    def _receive_from_connections(self) -> Tuple[int, Optional[Image]]:
+        while True:
+            events = self._selector.select(self._timeout)
+            if len(events) == 0:
+                raise _socket_timeout('timed out')
+
+            for key, mask in events:
+                if key.data is None:
+                    self._accept()
+                    continue
+
+                if (mask & selectors.EVENT_WRITE) != 0 and not self._send_replies(key.fileobj, key.data):
+                    continue
+                if (mask & selectors.EVENT_READ) == 0:
+                    continue
+                result = self._read(key.fileobj, key.data)
+                if result is not None:
+                    # The other ready connections will still be ready on the next select.
+                    return result
+
+    def _accept(self):
+        connection, address = self._listen_socket.accept()
+        connection.setblocking(False)
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._selector.register(connection, selectors.EVENT_READ, _FrameReader())
+        get_metrics().counter('tcp.connections').add()
+
+    def _send_replies(self, connection: socket.socket, reader: _FrameReader) -> bool:
+        """
+        Sends what the send buffer of the connection takes of the replies waiting, and
+        waits for it to be writable if some are left (the connection doesn't block).
+        Returns False if the connection is gone.
+        """
+        try:
+            sent = connection.send(reader.replies)
+        except BlockingIOError:
+            sent = 0
+        except ConnectionError:
+            self._drop(connection)
+            return False
+
+        del reader.replies[:sent]
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if len(reader.replies) > 0 else 0)
+        if self._selector.get_key(connection).events != events:
+            self._selector.modify(connection, events, reader)
+        return True
+
+    def _drop(self, connection: socket.socket):
+        self._selector.unregister(connection)
+        connection.close()
+
+    def _read(self, connection: socket.socket, reader: _FrameReader) -> Optional[Tuple[int, Optional[Image]]]:
+        try:
+            frame = reader.read(connection)
+        except BlockingIOError:
+            return None
+        except ConnectionError:
+            # The client is gone, anything it was in the middle of sending is lost.
+            self._drop(connection)
+            return None
+
+        if frame is None:
+            return None
+
+        sender_id, image_id, flags, image_size, timestamp, data = frame
+        if image_id < 0:
+            return sender_id, None
+
+        if (flags & FLAG_DIGEST_OFFER) != 0:
+            digest = bytes(data)
+            wanted = self._digest_lookup is None or not self._digest_lookup(digest)
+            reader.replies += DIGEST_REPLY_MARKER + DIGEST_REPLY.pack(sender_id, image_id, 1 if wanted else 0)
+            if not self._send_replies(connection, reader):
+                return None
+            if wanted:
+                return None
+            get_metrics().counter('tcp.digest_hits').add()
+            return sender_id, ReferenceImage(image_id, digest, image_size, timestamp)
+
+        metrics = get_metrics()
+        metrics.counter('tcp.images_received').add()
+        metrics.counter('tcp.bytes_received').add(FRAME_HEADER.size + len(data))
+
+        codec = (flags & FLAG_CODEC_MASK) >> FLAG_CODEC_SHIFT
+        if codec != Codec.NONE:
+            try:
+                data = decompress(Codec(codec), data)
+            except DECOMPRESSION_ERRORS:
+                # The image is dropped, the client sends it again as it isn't acknowledged.
+                metrics.counter('tcp.corrupt_images').add()
+                return None
+        return sender_id, Image(image_id, data, timestamp)
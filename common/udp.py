@@ -1,107 +1,862 @@
-from typing import Optional, Tuple
+from collections import deque, OrderedDict
+from typing import Optional, Tuple, Dict, List, Callable, Iterator
 
 import socket
 import struct
-import io
+import time
 
-from common.image import Image
+from common.command import NO_REQUEST_ID
+from common.compression import Codec, DECOMPRESSION_ERRORS, decompress
+from common.image import Image, ReferenceImage
+from common.metrics import get_metrics
+from common.pacing import Pacer
+
+# The socket parameters of the functions here shadow the module.
+_socket_timeout = socket.timeout
+_SOL_SOCKET = socket.SOL_SOCKET
+_SO_SNDBUF = socket.SO_SNDBUF
+_SO_RCVBUF = socket.SO_RCVBUF
 
 MAX_UDP_SIZE = 64000
-IMAGE_HEADER_FORMAT = 'iiii'  # client_id, image_id, index, has next
+IMAGE_HEADER_FORMAT = 'iiiiId'  # client_id, image_id, index, flags, image size, capture time
+IMAGE_HEADER = struct.Struct(IMAGE_HEADER_FORMAT)
+# The first field of the header, when only the sender is wanted.
+_SENDER_ID = struct.Struct(IMAGE_HEADER_FORMAT[0])
 
+# The sender expects the receiver to report which parts it got.
+FLAG_RELIABLE = 0x1
+# The receiver should report which parts it got right now.
+FLAG_ACK_REQUEST = 0x2
+# Instead of a part, the datagram has the digest of the image. The receiver
+# tells the sender whether it wants the image.
+FLAG_DIGEST_OFFER = 0x4
+# Instead of a part, the datagram has the parity of a group of parts (see _Parity),
+# and the index is of the group.
+FLAG_PARITY = 0x8
+# The codec the image was compressed with (see common.compression) is kept in these bits.
+FLAG_CODEC_SHIFT = 4
+FLAG_CODEC_MASK = 0xf << FLAG_CODEC_SHIFT
+# With forward error correction, the parts are sent in groups of this many, each followed
+# by its parity. The size is kept in these bits of the parts and parities (0 is without).
+FLAG_FEC_GROUP_SHIFT = 8
+FLAG_FEC_GROUP_MASK = 0xff << FLAG_FEC_GROUP_SHIFT
+MAX_FEC_GROUP_SIZE = 0xff
 
-def send_no_image(socket: socket.socket, sender_id: int, dest_address: Tuple[str, int]):
-    # If we don't have anymore images, then we send a response
-    # indicating that by setting the picture id to -1.
-    header = struct.pack(IMAGE_HEADER_FORMAT, sender_id, -1, 0, 0)
-    socket.sendto(header, dest_address)
+# Status reports are sent back by the receiver of a reliable transfer.
+# They start with a marker of the same size as command types, so a client
+# can tell them apart from commands.
+STATUS_MARKER = b'imgsts'
+STATUS_HEADER_FORMAT = 'iiii'  # client_id, image_id, covered index, complete
+STATUS_HEADER = struct.Struct(STATUS_HEADER_FORMAT)
+# Following the header are the indexes of the missing parts (up to covered index).
+STATUS_MISSING_FORMAT = 'i'
+MAX_MISSING_IN_STATUS = 1024
 
+# Replies to digest offers.
+DIGEST_REPLY_MARKER = b'imgdig'
+DIGEST_REPLY_FORMAT = 'iii'  # client_id, image_id, wanted
+DIGEST_REPLY = struct.Struct(DIGEST_REPLY_FORMAT)
 
-def send_image(socket: socket.socket, sender_id: int, dest_address: Tuple[str, int], image: Image):
-    # Because UDP has a size limit, we must send the image in parts.
+DEFAULT_WINDOW_SIZE = 32  # parts
+DEFAULT_ACK_TIMEOUT = 0.2  # seconds
+DEFAULT_MAX_RETRIES = 10
+
+# Maximum size of a part of image. Based on the size limitations of UDP
+# and the header size
+MAX_PART_SIZE = MAX_UDP_SIZE - IMAGE_HEADER.size
+
+# How long to remember completed images, so we may answer retransmissions
+# which arrive after an image was completed. After that, the same image id
+# is considered a new image. Well beyond how long a sender keeps retrying
+# (and its sends may be paced), so late probes aren't taken for new images.
+_COMPLETED_MEMORY_SEC = 5 * DEFAULT_ACK_TIMEOUT * DEFAULT_MAX_RETRIES
+
+# Images which stop getting parts for this long are given up on (their parts were lost),
+# and the oldest are given up on once those being received take more than this many bytes.
+DEFAULT_MAX_PARTIAL_AGE_SEC = 30.0
+DEFAULT_MAX_PARTIAL_BYTES = 256 * 1024 * 1024
+
+# Not all platforms support scatter-gather sends.
+_HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')
+
+
+def _part_count(image_size: int) -> int:
+    # Even an empty image is sent as one (empty) part.
+    return max(1, (image_size + MAX_PART_SIZE - 1) // MAX_PART_SIZE)
+
+
+def _pack_part(sender_id: int, image: Image, index: int, flags: int) -> List:
     # Each part of the image is sent with an header + data, where the header
     # contains information about the client and the image and the data is
     # part of the image.
+    # The data is read from the image as a part, so it is not copied
+    # (or read from the file at all) as a whole.
+    header = IMAGE_HEADER.pack(sender_id, image.id, index, flags, len(image), image.timestamp)
+    data = image.read_part(index * MAX_PART_SIZE, MAX_PART_SIZE)
+    return [header, data]
 
-    image_size = len(image)  # total image size
-    header_size = struct.calcsize(IMAGE_HEADER_FORMAT)  # size of header
-    # Maximum size of a part of image. Based on the size limitations of UDP
-    # and the header size
-    max_part_size = MAX_UDP_SIZE - header_size
-
-    image_data = image.data
-
-    # We will no run in a loop and send the image part by part until
-    # we've sent everything.
-    last_index = 0
-    part_index = 0
-    while image_size > 0:
-        # The current data size (part size).
-        # If the image still has more data then we can send at once,
-        # we set the size to the maximum possible size.
-        # If the image left has enough data to fit in one send, we set
-        # the size to the data left.
-        # We then update the remaining size of the image
-        if image_size < max_part_size:
-            current_size = image_size
-        else:
-            current_size = max_part_size
 
-        image_size -= current_size
+class _Parity(object):
+    """
+    The XOR of a group of parts, as long as the longest of them (shorter parts count
+    as padded with zeros). Any single part missing of the group is the XOR of the
+    parity and the other parts of the group.
+    """
+    __slots__ = ('value', 'size')
+
+    def __init__(self):
+        # The parts are XORed as (little endian) integers, which is much faster
+        # than byte by byte.
+        self.value = 0
+        self.size = 0
+
+    def add(self, data):
+        self.value ^= int.from_bytes(data, 'little')
+        self.size = max(self.size, len(data))
+
+    def to_bytes(self) -> bytes:
+        return self.value.to_bytes(self.size, 'little')
+
+
+def _fec_flags(fec_group_size: int) -> int:
+    if not 0 <= fec_group_size <= MAX_FEC_GROUP_SIZE:
+        raise ValueError('FEC groups are of up to {} parts, not {}'.format(MAX_FEC_GROUP_SIZE, fec_group_size))
+    return fec_group_size << FLAG_FEC_GROUP_SHIFT
+
+
+def _is_group_end(index: int, part_count: int, fec_group_size: int) -> bool:
+    return fec_group_size > 0 and ((index + 1) % fec_group_size == 0 or index == part_count - 1)
+
+
+def _pack_parity(sender_id: int, image: Image, group_index: int, flags: int, parity: _Parity) -> List:
+    header = IMAGE_HEADER.pack(sender_id, image.id, group_index, flags | FLAG_PARITY, len(image), image.timestamp)
+    return [header, parity.to_bytes()]
+
+
+def _pack_group_parity(sender_id: int, image: Image, group_index: int, fec_group_size: int, flags: int) -> List:
+    # The parity of a group, reading its parts again.
+    parity = _Parity()
+    first_index = group_index * fec_group_size
+    for index in range(first_index, min(first_index + fec_group_size, _part_count(len(image)))):
+        parity.add(image.read_part(index * MAX_PART_SIZE, MAX_PART_SIZE))
+    return _pack_parity(sender_id, image, group_index, flags, parity)
+
+
+def pack_parts(sender_id: int, image: Image, codec: Codec = Codec.NONE,
+               indexes: Optional[List[int]] = None, fec_group_size: int = 0) -> Iterator[List]:
+    """
+    The datagrams of the parts of the image (or of only the parts at indexes), for
+    sending without waiting for replies. Parts are packed only as they are asked for.
+    With fec_group_size, each group of that many parts is followed by its parity, from
+    which the receiver rebuilds any one part lost of the group, at the cost of sending
+    1 / fec_group_size more. Parts sent again (at indexes) are sent without parity.
+    """
+    flags = (codec << FLAG_CODEC_SHIFT) | _fec_flags(fec_group_size)
+    part_count = _part_count(len(image))
+    if indexes is not None:
+        fec_group_size = 0
+
+    parity = _Parity()
+    for part_index in range(part_count) if indexes is None else indexes:
+        if 0 <= part_index < part_count:
+            datagram = _pack_part(sender_id, image, part_index, flags)
+            yield datagram
+            if fec_group_size > 0:
+                parity.add(datagram[1])
+                if _is_group_end(part_index, part_count, fec_group_size):
+                    yield _pack_parity(sender_id, image, part_index // fec_group_size, flags, parity)
+                    parity = _Parity()
+
+
+def send_datagram(socket: socket.socket, buffers: List, dest_address: Tuple[str, int]):
+    # Sends the buffers as a single datagram, letting the kernel gather them
+    # instead of joining them ourselves.
+    if _HAS_SENDMSG:
+        socket.sendmsg(buffers, (), 0, dest_address)
+    else:
+        socket.sendto(b''.join(buffers), dest_address)
+
+    metrics = get_metrics()
+    if metrics.enabled:
+        metrics.counter('udp.datagrams_sent').add()
+        metrics.counter('udp.bytes_sent').add(sum(len(buffer) for buffer in buffers))
+
+
+def pack_no_image(sender_id: int, request_id: int = NO_REQUEST_ID, flags: int = 0) -> bytes:
+    # If we don't have anymore images, then we send a response
+    # indicating that by setting the picture id to -1.
+    # The id of the request this answers goes where the part index would be.
+    return IMAGE_HEADER.pack(sender_id, -1, request_id, flags, 0, 0.0)
+
+
+def send_no_image(socket: socket.socket, sender_id: int, dest_address: Tuple[str, int],
+                  request_id: int = NO_REQUEST_ID):
+    socket.sendto(pack_no_image(sender_id, request_id), dest_address)
+
+
+def send_paced(socket: socket.socket, buffers: List, dest_address: Tuple[str, int], pacer: Optional[Pacer]):
+    # Like send_datagram, but first waits for the pacer (if any) to let the datagram go.
+    if pacer is not None:
+        pacer.wait(sum(len(buffer) for buffer in buffers))
+    send_datagram(socket, buffers, dest_address)
+
+
+def set_buffer_sizes(socket: socket.socket, send_buffer_size: Optional[int] = None,
+                     receive_buffer_size: Optional[int] = None):
+    # Sets the sizes of the kernel's buffers for the socket, where given.
+    # A bigger receive buffer lets bursts of parts wait there instead of being dropped.
+    for option, size, name in ((_SO_SNDBUF, send_buffer_size, 'send'), (_SO_RCVBUF, receive_buffer_size, 'receive')):
+        if size is None:
+            continue
+
+        socket.setsockopt(_SOL_SOCKET, option, size)
+        # The kernel caps the size (net.core.wmem_max and rmem_max on Linux),
+        # and may report more than asked for, for its own bookkeeping.
+        actual_size = socket.getsockopt(_SOL_SOCKET, option)
+        metrics = get_metrics()
+        if actual_size < size:
+            metrics.counter('udp.capped_{}_buffers'.format(name)).add()
+        metrics.gauge('udp.{}_buffer_size'.format(name)).set(actual_size)
+
+
+def send_image(socket: socket.socket, sender_id: int, dest_address: Tuple[str, int], image: Image,
+               codec: Codec = Codec.NONE, pacer: Optional[Pacer] = None, fec_group_size: int = 0):
+    # Because UDP has a size limit, we must send the image in parts.
+    # We send the image part by part until we've sent everything,
+    # as fast as the pacer (if any) lets us.
+    # If the image data was compressed, codec tells the receiver how to decompress it.
+    # See pack_parts for fec_group_size.
+    for datagram in pack_parts(sender_id, image, codec, fec_group_size=fec_group_size):
+        send_paced(socket, datagram, dest_address, pacer)
+
+
+def send_parts(socket: socket.socket, sender_id: int, dest_address: Tuple[str, int], image: Image,
+               indexes: List[int], codec: Codec = Codec.NONE, pacer: Optional[Pacer] = None):
+    # Sends only some of the parts of the image, to resume a transfer which was cut off.
+    # The image must be sent as it was the first time (compressed the same way).
+    for datagram in pack_parts(sender_id, image, codec, indexes):
+        send_paced(socket, datagram, dest_address, pacer)
+    get_metrics().counter('udp.resumed_parts').add(len(indexes))
+
+
+def sender_of(data) -> int:
+    # The id of the client which sent an image part.
+    return _SENDER_ID.unpack_from(data)[0]
+
+
+def pack_status(sender_id: int, image_id: int, covered_index: int, complete: bool, missing: List[int]) -> bytes:
+    header = STATUS_HEADER.pack(sender_id, image_id, covered_index, 1 if complete else 0)
+    missing_data = struct.pack(STATUS_MISSING_FORMAT * len(missing), *missing)
+    return STATUS_MARKER + header + missing_data
+
+
+def unpack_status(data: bytes) -> Tuple[int, int, int, bool, List[int]]:
+    data = data[len(STATUS_MARKER):]
+    sender_id, image_id, covered_index, complete = STATUS_HEADER.unpack_from(data)
+    missing_data = data[STATUS_HEADER.size:]
+    missing_count = len(missing_data) // struct.calcsize(STATUS_MISSING_FORMAT)
+    missing = list(struct.unpack(STATUS_MISSING_FORMAT * missing_count, missing_data))
+    return sender_id, image_id, covered_index, complete != 0, missing
+
+
+def is_status(data: bytes) -> bool:
+    return data[:len(STATUS_MARKER)] == STATUS_MARKER
+
+
+class ReliableTransfer(object):
+    """
+    The sending side of a reliable image transfer.
+    Parts are sent in bursts which fill the send window. The last part of each burst
+    asks the receiver for a status report, which lists the parts still missing.
+    Only those parts are sent again.
+    With fec_group_size, the parities of the groups of new parts go with each burst (see
+    pack_parts), so parts lost on steadily lossy links need not be sent again.
+
+    This class only decides what to send, the caller is in charge of the socket.
+    Each datagram is given as a list of buffers, to be sent with send_datagram.
+    """
+
+    def __init__(self, sender_id: int, image: Optional[Image], window_size: int = DEFAULT_WINDOW_SIZE,
+                 codec: Codec = Codec.NONE, request_id: int = NO_REQUEST_ID, fec_group_size: int = 0):
+        self._sender_id = sender_id
+        self._image = image
+        # For the end marker, the id of the request it answers.
+        self._request_id = request_id
+        self._window_size = window_size
+        self._fec_group_size = fec_group_size
+        self._flags = FLAG_RELIABLE | (codec << FLAG_CODEC_SHIFT) | _fec_flags(fec_group_size)
+
+        # A transfer of no image is the end marker, which is acknowledged like any image.
+        self._part_count = 0 if image is None else _part_count(len(image))
+
+        self._acked = [False] * self._part_count
+        self._acked_count = 0
+        # Parts which were sent and not yet reported as received or missing.
+        self._in_flight = set()
+        self._next_new_index = 0
+        self._retransmit = deque()
+        self._complete = False
+        # How many parts the last report told of, and how many of those were missing.
+        self._last_reported = 0
+        self._last_missing = 0
+
+    @property
+    def image_id(self) -> int:
+        return -1 if self._image is None else self._image.id
+
+    @property
+    def is_complete(self) -> bool:
+        return self._complete
+
+    @property
+    def last_report(self) -> Tuple[int, int]:
+        # The parts in flight the last status report told of, and how many of those were lost.
+        return self._last_reported, self._last_missing
+
+    def next_burst(self) -> List[List]:
+        if self._image is None:
+            return [self.probe()]
+
+        # Fill the window, first with parts reported missing and then with new parts.
+        indexes = []
+        first_new_index = self._next_new_index
+        while len(self._in_flight) + len(indexes) < self._window_size:
+            if len(self._retransmit) > 0:
+                index = self._retransmit.popleft()
+                if self._acked[index]:
+                    continue
+                get_metrics().counter('udp.retransmits').add()
+            elif self._next_new_index < self._part_count:
+                index = self._next_new_index
+                self._next_new_index += 1
+            else:
+                break
+
+            indexes.append(index)
+
+        if len(indexes) == 0:
+            # The window is full, all we can do is ask for a report.
+            return [self.probe()]
+
+        self._in_flight.update(indexes)
+
+        # The groups completed by the new parts get their parity.
+        fec_groups = [index // self._fec_group_size for index in range(first_new_index, self._next_new_index)
+                      if _is_group_end(index, self._part_count, self._fec_group_size)]
+
+        # The report covers all the parts up to the highest part received, so we ask for it
+        # on the highest part we send, or on the last parity, so the parts the parities
+        # rebuild are reported as received.
+        highest_index = max(indexes)
+        datagrams = []
+        for index in indexes:
+            flags = self._flags
+            if index == highest_index and len(fec_groups) == 0:
+                flags |= FLAG_ACK_REQUEST
+            datagrams.append(_pack_part(self._sender_id, self._image, index, flags))
+        for group_index in fec_groups:
+            flags = self._flags
+            if group_index == fec_groups[-1]:
+                flags |= FLAG_ACK_REQUEST
+            datagrams.append(_pack_group_parity(self._sender_id, self._image, group_index, self._fec_group_size,
+                                                flags))
+
+        return datagrams
+
+    def probe(self) -> List:
+        # Asks for a status report, used when one did not arrive in time.
+        # Sending the highest part which is in flight again will make the report
+        # cover all the parts in flight.
+        flags = self._flags | FLAG_ACK_REQUEST
+        if self._image is None:
+            return [pack_no_image(self._sender_id, self._request_id, flags)]
 
-        # If the remaining size is less than 1, then we don't have more parts.
-        if image_size <= 0:
-            has_next = 0
+        if len(self._in_flight) > 0:
+            index = max(self._in_flight)
         else:
-            has_next = 1
+            index = self._part_count - 1
+        return _pack_part(self._sender_id, self._image, index, flags)
 
-        print('Sending part', part_index)
+    def handle_status(self, data: bytes) -> bool:
+        sender_id, image_id, covered_index, complete, missing = unpack_status(data)
+        if sender_id != self._sender_id or image_id != self.image_id:
+            # Report on a previous transfer, ignore it.
+            return False
 
-        # Build the header and data, and send.
-        header = struct.pack(IMAGE_HEADER_FORMAT, sender_id, image.id, part_index, has_next)
-        data = image_data[last_index:(last_index + current_size)]
-        socket.sendto(header + data, dest_address)
+        if complete:
+            self._complete = True
+            return True
 
-        # Prepare for next run of the loop.
-        last_index = last_index + current_size
-        part_index += 1
+        missing = set(missing)
+        self._last_reported = 0
+        self._last_missing = 0
+        for index in range(min(covered_index + 1, self._part_count)):
+            if index in missing:
+                if index in self._in_flight:
+                    self._in_flight.discard(index)
+                    self._retransmit.append(index)
+                    self._last_reported += 1
+                    self._last_missing += 1
+            elif not self._acked[index]:
+                self._acked[index] = True
+                self._acked_count += 1
+                if index in self._in_flight:
+                    self._in_flight.discard(index)
+                    self._last_reported += 1
 
+        if self._acked_count == self._part_count:
+            self._complete = True
 
-def receive_image(socket: socket.socket) -> Optional[Image]:
-    # Because of size limitations of UDP, we will expect the image in parts.
-    # We will store the parts in image_parts (by order according to the header).
-    image_parts = []
-    header_size = struct.calcsize(IMAGE_HEADER_FORMAT)
+        return True
+
+
+def send_image_reliable(socket: socket.socket, sender_id: int, dest_address: Tuple[str, int],
+                        image: Optional[Image],
+                        window_size: int = DEFAULT_WINDOW_SIZE,
+                        ack_timeout: float = DEFAULT_ACK_TIMEOUT,
+                        max_retries: int = DEFAULT_MAX_RETRIES,
+                        on_other_data: Callable[[bytes, Tuple], None] = None,
+                        codec: Codec = Codec.NONE,
+                        pacer: Optional[Pacer] = None,
+                        request_id: int = NO_REQUEST_ID,
+                        fec_group_size: int = 0):
+    # Sends the image (or the end marker if image is None) and waits until the receiver
+    # reports it got all of it. Anything else received while waiting is passed to
+    # on_other_data.
+    # Sends are paced by the pacer (if any), which is told of the loss in each report.
+    transfer = ReliableTransfer(sender_id, image, window_size, codec, request_id, fec_group_size)
+
+    old_timeout = socket.gettimeout()
+    socket.settimeout(ack_timeout)
+    try:
+        retries = 0
+        while not transfer.is_complete:
+            for datagram in transfer.next_burst():
+                send_paced(socket, datagram, dest_address, pacer)
+
+            while True:
+                try:
+                    data, addr = socket.recvfrom(MAX_UDP_SIZE)
+                except _socket_timeout:
+                    retries += 1
+                    if retries > max_retries:
+                        get_metrics().counter('udp.transfer_failures').add()
+                        raise
+
+                    get_metrics().counter('udp.probes').add()
+                    if pacer is not None:
+                        # The report (or all of the burst) was lost, slow down.
+                        pacer.on_feedback(1, 1)
+                    send_paced(socket, transfer.probe(), dest_address, pacer)
+                    continue
+
+                if not is_status(data):
+                    if on_other_data is not None:
+                        on_other_data(data, addr)
+                    continue
+
+                if transfer.handle_status(data):
+                    if pacer is not None:
+                        pacer.on_feedback(*transfer.last_report)
+                    retries = 0
+                    break
+    finally:
+        socket.settimeout(old_timeout)
+
+
+def is_digest_reply(data: bytes) -> bool:
+    return data[:len(DIGEST_REPLY_MARKER)] == DIGEST_REPLY_MARKER
+
+
+def is_transfer_reply(data: bytes) -> bool:
+    # Whether the data is a reply of a receiver to something we sent.
+    return is_status(data) or is_digest_reply(data)
+
+
+def offer_digest(socket: socket.socket, sender_id: int, dest_address: Tuple[str, int],
+                 image: Image, digest: bytes,
+                 timeout: float = DEFAULT_ACK_TIMEOUT,
+                 max_retries: int = DEFAULT_MAX_RETRIES,
+                 on_other_data: Callable[[bytes, Tuple], None] = None) -> bool:
+    # Sends the digest of the image instead of the image, and returns whether
+    # the receiver wants the image itself. If the receiver does not answer,
+    # we assume it wants it.
+    offer = IMAGE_HEADER.pack(sender_id, image.id, 0, FLAG_DIGEST_OFFER, len(image), image.timestamp) + digest
+
+    old_timeout = socket.gettimeout()
+    socket.settimeout(timeout)
+    try:
+        for _ in range(max_retries + 1):
+            socket.sendto(offer, dest_address)
+            try:
+                while True:
+                    data, addr = socket.recvfrom(MAX_UDP_SIZE)
+                    if not is_digest_reply(data):
+                        if on_other_data is not None:
+                            on_other_data(data, addr)
+                        continue
+
+                    reply_sender_id, image_id, wanted = DIGEST_REPLY.unpack_from(data, len(DIGEST_REPLY_MARKER))
+                    if reply_sender_id == sender_id and image_id == image.id:
+                        return wanted != 0
+            except _socket_timeout:
+                continue
+    finally:
+        socket.settimeout(old_timeout)
+
+    return True
+
+
+class _PartialImage(object):
+    __slots__ = ('data', 'part_count', 'received', 'highest_index', 'fec_group_size', 'parities', 'updated')
+
+    def __init__(self, image_size: int, fec_group_size: int):
+        # The whole image is allocated once, and parts are copied into place.
+        self.data = bytearray(image_size)
+        self.part_count = _part_count(image_size)
+        self.received = set()
+        self.highest_index = 0
+        self.fec_group_size = fec_group_size
+        # Group index -> parity, of the groups which are missing parts.
+        self.parities: Dict[int, bytes] = {}
+        # When we last got a part or parity of the image.
+        self.updated = time.monotonic()
+
+    def add_part(self, index: int, part):
+        # Copy the part straight into its place in the image.
+        offset = index * MAX_PART_SIZE
+        self.data[offset:offset + len(part)] = part
+        self.received.add(index)
+        self.highest_index = max(self.highest_index, index)
+
+    def group_indexes(self, group_index: int) -> range:
+        first_index = group_index * self.fec_group_size
+        return range(first_index, min(first_index + self.fec_group_size, self.part_count))
+
+    def recover_part(self, group_index: int) -> bool:
+        """
+        Rebuilds the part missing of the group from its parity, if only one is missing
+        and we have the parity. Returns whether it did.
+        """
+        parity_data = self.parities.get(group_index)
+        if parity_data is None:
+            return False
+        indexes = self.group_indexes(group_index)
+        missing = [index for index in indexes if index not in self.received]
+        if len(missing) != 1:
+            if len(missing) == 0:
+                del self.parities[group_index]
+            return False
+
+        parity = _Parity()
+        parity.add(parity_data)
+        view = memoryview(self.data)
+        for index in indexes:
+            if index != missing[0]:
+                parity.add(view[index * MAX_PART_SIZE:(index + 1) * MAX_PART_SIZE])
+        # The part is as long as its place in the image, the rest of the parity is padding.
+        offset = missing[0] * MAX_PART_SIZE
+        part_size = min(MAX_PART_SIZE, len(self.data) - offset)
+        view.release()
+        self.add_part(missing[0], parity.to_bytes()[:part_size])
+        del self.parities[group_index]
+        return True
+
+
+class ImageAssembler(object):
+    """
+    Rebuilds images from their parts. Parts are kept separately for each
+    sender and image, so parts of images from several senders may arrive
+    interleaved.
+    For reliable transfers, status reports are created for the sender.
+
+    Senders may offer a digest of an image instead of the image. digest_lookup
+    tells whether we already have an image with the digest. If we do, the result is
+    a ReferenceImage, and the sender is told not to send the image.
+
+    end_filter tells whether an end marker of a sender, answering the request with
+    an id, is expected. Markers which are not are left-overs of earlier requests,
+    and are dropped (see master.inflight).
+
+    Images which stop getting parts for max_partial_age seconds are given up on, and so
+    are the least recently updated images once all those not complete take more than
+    max_partial_bytes (so images whose parts were lost don't pile up). Images said to be
+    bigger than max_partial_bytes are dropped before anything is allocated for them, as
+    the size is whatever the header of their first part says.
+    """
+
+    def __init__(self, digest_lookup: Optional[Callable[[bytes], bool]] = None,
+                 end_filter: Optional[Callable[[int, int], bool]] = None,
+                 max_partial_age: float = DEFAULT_MAX_PARTIAL_AGE_SEC,
+                 max_partial_bytes: int = DEFAULT_MAX_PARTIAL_BYTES):
+        # (sender_id, image_id) -> _PartialImage, least recently updated first.
+        self._partial_images: OrderedDict = OrderedDict()
+        self._partial_bytes = 0
+        self._max_partial_age = max_partial_age
+        self._max_partial_bytes = max_partial_bytes
+        # (sender_id, image_id) -> when completed
+        self._completed_keys = {}
+        self._completed_history = deque()
+        self._digest_lookup = digest_lookup
+        self._end_filter = end_filter
+
+    def set_digest_lookup(self, digest_lookup: Optional[Callable[[bytes], bool]]):
+        self._digest_lookup = digest_lookup
+
+    def set_end_filter(self, end_filter: Optional[Callable[[int, int], bool]]):
+        self._end_filter = end_filter
+
+    def feed(self, data) -> Tuple[Optional[Tuple[int, Optional[Image]]], Optional[bytes]]:
+        """
+        Handles a datagram from a sender. The datagram may be any buffer, and is
+        not used after this call returns.
+        Returns the result, if an image was completed or the sender has no more images,
+        and a status report to send back to the sender, if one is needed.
+        """
+        if len(data) < IMAGE_HEADER.size:
+            # Too short to be a part, e.g. a late reply to a command.
+            get_metrics().counter('udp.stray_datagrams').add()
+            return None, None
 
-    # We will run until the client tells us that there are no more parts.
-    while True:
-        # Receive data from the client.
         # The data is made up of header and image data.
         # We unpack the header information to understand more about the information we received.
-        data, addr = socket.recvfrom(MAX_UDP_SIZE)
-        header, data = data[:header_size], data[header_size:]
-        sender_id, image_id, index, has_next = struct.unpack(IMAGE_HEADER_FORMAT, header)
+        sender_id, image_id, index, flags, image_size, timestamp = IMAGE_HEADER.unpack_from(data)
+        reliable = (flags & FLAG_RELIABLE) != 0
 
-        # If the image id is negative, then there is no image to read.
+        # If the image id is negative, then the sender has no image to send.
         if image_id < 0:
-            return None
+            # Left-overs are acknowledged as well, so the sender doesn't keep sending them.
+            reply = pack_status(sender_id, image_id, 0, True, []) if reliable else None
+            if self._end_filter is not None and not self._end_filter(sender_id, index):
+                get_metrics().counter('udp.stale_end_markers').add()
+                return None, reply
+            return (sender_id, None), reply
+
+        key = (sender_id, image_id)
+        if self._is_completed(key):
+            # Retransmission of an image we already have, the sender probably
+            # missed the report.
+            if (flags & FLAG_DIGEST_OFFER) != 0:
+                return None, self._pack_digest_reply(sender_id, image_id, False)
+            reply = pack_status(sender_id, image_id, index, True, []) if reliable else None
+            return None, reply
+
+        if (flags & FLAG_DIGEST_OFFER) != 0:
+            return self._handle_digest_offer(sender_id, image_id, image_size, timestamp,
+                                             bytes(data[IMAGE_HEADER.size:]))
 
-        print('Received part', index, 'Next?', has_next)
+        metrics = get_metrics()
+        if metrics.enabled:
+            metrics.counter('udp.parts_received').add()
+            metrics.counter('udp.bytes_received').add(len(data))
 
-        # We need to place data in the image_parts list. This must be by order as specified by
-        # index.
-        if len(image_parts) <= index:
-            image_parts.insert(index, data)
+        partial = self._partial_images.get(key)
+        if partial is None:
+            if image_size > self._max_partial_bytes:
+                metrics.counter('udp.oversized_images').add()
+                return None, None
+            partial = _PartialImage(image_size, (flags & FLAG_FEC_GROUP_MASK) >> FLAG_FEC_GROUP_SHIFT)
+            self._partial_images[key] = partial
+            self._partial_bytes += image_size
+            self._expire_partial_images()
         else:
-            image_parts[index] = data
+            partial.updated = time.monotonic()
+            self._partial_images.move_to_end(key)
 
-        # If has_next is 0, then the client has no more parts to send.
-        if has_next == 0:
-            break
+        group_index = None
+        if (flags & FLAG_PARITY) != 0:
+            if partial.fec_group_size > 0 and 0 <= index * partial.fec_group_size < partial.part_count:
+                group_index = index
+                partial.parities[group_index] = bytes(data[IMAGE_HEADER.size:])
+        elif 0 <= index < partial.part_count and index not in partial.received:
+            partial.add_part(index, memoryview(data)[IMAGE_HEADER.size:])
+            if partial.fec_group_size > 0:
+                group_index = index // partial.fec_group_size
+        else:
+            metrics.counter('udp.duplicate_parts').add()
+
+        # A part lost of a group is rebuilt once we have the parity and the rest of the group.
+        if group_index is not None and partial.recover_part(group_index):
+            metrics.counter('udp.fec_recovered_parts').add()
+
+        if len(partial.received) < partial.part_count:
+            reply = None
+            if reliable and (flags & FLAG_ACK_REQUEST) != 0:
+                reply = self._create_status(sender_id, image_id, partial)
+            return None, reply
+
+        del self._partial_images[key]
+        self._partial_bytes -= len(partial.data)
+        reply = pack_status(sender_id, image_id, index, True, []) if reliable else None
+
+        image_data = partial.data
+        codec = (flags & FLAG_CODEC_MASK) >> FLAG_CODEC_SHIFT
+        if codec != Codec.NONE:
+            try:
+                image_data = decompress(Codec(codec), image_data)
+            except DECOMPRESSION_ERRORS:
+                # The image is dropped, and not remembered, so it may be sent again (it isn't
+                # acknowledged to the sender, see Master). The transfer itself is done.
+                metrics.counter('udp.corrupt_images').add()
+                return None, reply
+
+        self._remember_completed(key)
+        metrics.counter('udp.images_received').add()
+        return (sender_id, Image(image_id, image_data, timestamp)), reply
+
+    def missing_parts(self, sender_id: int) -> Dict[int, List[int]]:
+        """
+        Returns the parts missing of the images of the sender which are not complete,
+        by image id. The parts received so far are kept, so a transfer which was
+        cut off may be resumed by sending only those.
+        """
+        return {image_id: [i for i in range(partial.part_count) if i not in partial.received]
+                for (partial_sender_id, image_id), partial in self._partial_images.items()
+                if partial_sender_id == sender_id}
+
+    def _expire_partial_images(self):
+        # The newest image (just started) is kept, even if with it the others take too many bytes.
+        now = time.monotonic()
+        metrics = get_metrics()
+        while len(self._partial_images) > 1:
+            key, partial = next(iter(self._partial_images.items()))
+            if now - partial.updated < self._max_partial_age and self._partial_bytes <= self._max_partial_bytes:
+                break
+            del self._partial_images[key]
+            self._partial_bytes -= len(partial.data)
+            metrics.counter('udp.expired_partial_images').add()
+
+    def _create_status(self, sender_id: int, image_id: int, partial: _PartialImage) -> bytes:
+        # The report covers everything up to the highest part we got.
+        covered_index = partial.highest_index
+        missing = [i for i in range(covered_index + 1) if i not in partial.received]
+        if len(missing) > MAX_MISSING_IN_STATUS:
+            # Only report up to the part before the first missing part we can't list.
+            covered_index = missing[MAX_MISSING_IN_STATUS] - 1
+            missing = missing[:MAX_MISSING_IN_STATUS]
+
+        return pack_status(sender_id, image_id, covered_index, False, missing)
+
+    def _handle_digest_offer(self, sender_id: int, image_id: int, image_size: int, timestamp: float,
+                             digest: bytes) \
+            -> Tuple[Optional[Tuple[int, Optional[Image]]], Optional[bytes]]:
+        if self._digest_lookup is None or not self._digest_lookup(digest):
+            return None, self._pack_digest_reply(sender_id, image_id, True)
+
+        get_metrics().counter('udp.digest_hits').add()
+        self._remember_completed((sender_id, image_id))
+        image = ReferenceImage(image_id, digest, image_size, timestamp)
+        return (sender_id, image), self._pack_digest_reply(sender_id, image_id, False)
+
+    def _pack_digest_reply(self, sender_id: int, image_id: int, wanted: bool) -> bytes:
+        return DIGEST_REPLY_MARKER + DIGEST_REPLY.pack(sender_id, image_id, 1 if wanted else 0)
+
+    def _is_completed(self, key: Tuple[int, int]) -> bool:
+        # Forget images completed long ago.
+        now = time.monotonic()
+        while len(self._completed_history) > 0 and now - self._completed_history[0][1] > _COMPLETED_MEMORY_SEC:
+            old_key, completed_time = self._completed_history.popleft()
+            if self._completed_keys.get(old_key) == completed_time:
+                del self._completed_keys[old_key]
+
+        return key in self._completed_keys
+
+    def _remember_completed(self, key: Tuple[int, int]):
+        now = time.monotonic()
+        self._completed_keys[key] = now
+        self._completed_history.append((key, now))
+
+
+class ImageReceiver(object):
+    """
+    Receives images from several senders sharing a single socket.
+    Completed images are kept per sender until they are asked for.
+    """
 
-    # Combine all the parts of the image and return the it.
-    image = io.BytesIO()
-    for part in image_parts:
-        image.write(part)
+    def __init__(self, socket: socket.socket, digest_lookup: Optional[Callable[[bytes], bool]] = None,
+                 end_filter: Optional[Callable[[int, int], bool]] = None):
+        self._socket = socket
+        self._assembler = ImageAssembler(digest_lookup, end_filter)
+        self._completed: Dict[int, deque] = {}
+        # Datagrams are received into this buffer, instead of a new one each time.
+        self._buffer = bytearray(MAX_UDP_SIZE)
+        self._buffer_view = memoryview(self._buffer)
+        # Told the id of the sender of each part or end marker (e.g. to know who is still there).
+        self._activity_listener: Optional[Callable[[int], None]] = None
+        # Given the datagrams too short to be parts (e.g. replies to commands) with their address.
+        self._reply_handler: Optional[Callable[[bytes, Tuple], None]] = None
 
-    return Image(image_id, image.getvalue())
+    def set_digest_lookup(self, digest_lookup: Optional[Callable[[bytes], bool]]):
+        self._assembler.set_digest_lookup(digest_lookup)
+
+    def set_end_filter(self, end_filter: Optional[Callable[[int, int], bool]]):
+        self._assembler.set_end_filter(end_filter)
+
+    def set_activity_listener(self, listener: Optional[Callable[[int], None]]):
+        self._activity_listener = listener
+
+    def set_reply_handler(self, handler: Optional[Callable[[bytes, Tuple], None]]):
+        self._reply_handler = handler
+
+    def missing_parts(self, sender_id: int) -> Dict[int, List[int]]:
+        return self._assembler.missing_parts(sender_id)
+
+    def poll(self):
+        """
+        Handles a single datagram, waiting for it as long as the socket does.
+        Anything completed is kept until asked for.
+        """
+        result = self._receive_datagram()
+        if result is not None:
+            sender_id, image = result
+            self._completed.setdefault(sender_id, deque()).append(image)
+
+    def receive(self) -> Tuple[int, Optional[Image]]:
+        # Return images which were completed while waiting for another sender first.
+        for sender_id, completed in self._completed.items():
+            if len(completed) > 0:
+                return sender_id, completed.popleft()
+
+        return self._receive_from_socket()
+
+    def receive_from(self, sender_id: int) -> Optional[Image]:
+        completed = self._completed.get(sender_id)
+        if completed:
+            return completed.popleft()
+
+        # Run until the wanted sender completes an image. Anything completed by
+        # other senders in the meanwhile is saved for later.
+        while True:
+            result_sender_id, image = self._receive_from_socket()
+            if result_sender_id == sender_id:
+                return image
+
+            self._completed.setdefault(result_sender_id, deque()).append(image)
+
+    def _receive_from_socket(self) -> Tuple[int, Optional[Image]]:
+        while True:
+            result = self._receive_datagram()
+            if result is not None:
+                return result
+
+    def _receive_datagram(self) -> Optional[Tuple[int, Optional[Image]]]:
+        size, addr = self._socket.recvfrom_into(self._buffer)
+        data = self._buffer_view[:size]
+        if size < IMAGE_HEADER.size:
+            if self._reply_handler is not None:
+                self._reply_handler(bytes(data), addr)
+                return None
+        elif self._activity_listener is not None:
+            self._activity_listener(sender_of(data))
+
+        result, reply = self._assembler.feed(data)
+        if reply is not None:
+            self._socket.sendto(reply, addr)
+        return result
+
+
+def receive_image(socket: socket.socket) -> Optional[Image]:
+    # Because of size limitations of UDP, we will expect the image in parts.
+    # We assume only one sender is talking on the socket.
+    sender_id, image = ImageReceiver(socket).receive()
+    return image
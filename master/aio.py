@@ -0,0 +1,497 @@
+"""
+asyncio versions of the master's connection and of the Master, so a single thread
+can discover, synchronize and collect from many clients at once, with timers and
+cancellation, instead of blocking on the socket.
+
+The protocol is the same as with master.client.UdpConnection, and images are rebuilt
+by the same ImageAssembler, so clients can't tell the difference.
+"""
+from concurrent.futures import Executor
+from typing import Optional, List, Tuple, Dict, Callable, Set
+
+import asyncio
+import time
+
+from common.clock import ClockSample, best_sample
+from common.command import CommandType, CommandParams, SyncClockParams, ClockOffsetParams, TakePictureParams, \
+    AcknowledgeParams, pack_command
+from common.compression import CompressionSettings
+from common.data import CLOCK_RESPONSE, CLOCK_TIMES
+from common.image import Image
+from common.metrics import get_metrics
+from common import udp
+from master.client import UdpConnection, PROBING_COMMANDS, expected_clients, discovery_wait, handle_discovery_reply, \
+    handle_heartbeat_reply, request_missing_parts
+from master.discovery import WorkerRegistry
+from master.inflight import InFlightRequests
+from master.liveness import Liveness, LivenessTracker
+from master.master import DEFAULT_CLOCK_SYNC_ROUNDS, DEFAULT_PIPELINE_DEPTH, DEFAULT_HEARTBEAT_WAIT, MAX_RESUMES, \
+    MAX_STALLS, CollectedImages, capture_skew
+from master.storage import Storage
+
+# How long to wait for the next image of a client, and for replies to discovery.
+DEFAULT_TIMEOUT = 1.0
+
+
+class AsyncClient(object):
+
+    def __init__(self, id: int, address: Tuple, connection: 'AsyncConnection'):
+        self._id = id
+        self._address = address
+        self._connection = connection
+
+    @property
+    def id(self) -> int:
+        return self._id
+
+    @property
+    def address(self) -> Tuple:
+        return self._address
+
+    def send_command(self, command: CommandType, params: Optional[CommandParams] = None):
+        request_id = self._connection.requests.start(self._id, command)
+        self._connection.send(pack_command(command, params, request_id), self._address)
+        liveness = self._connection.liveness
+        if liveness is not None and command in PROBING_COMMANDS:
+            liveness.asked(self._id)
+
+    async def receive_image(self) -> Optional[Image]:
+        # Raises asyncio.TimeoutError if no image arrived in time.
+        image = await self._connection.receive_from(self._id)
+        liveness = self._connection.liveness
+        if liveness is not None:
+            liveness.heard_from(self._id)
+        if image is not None:
+            self._connection.requests.image_received(self._id)
+        return image
+
+    def acknowledge_image(self, image: Image):
+        self.send_command(CommandType.ACKNOWLEDGE_PICTURE, AcknowledgeParams(image.id))
+
+    def resume_transfers(self) -> bool:
+        return request_missing_parts(self, self._connection.missing_parts(self._id))
+
+    def has_partial_images(self) -> bool:
+        return len(self._connection.missing_parts(self._id)) > 0
+
+    def forget_requests(self):
+        self._connection.requests.forget(self._id)
+
+
+class AsyncConnection(asyncio.DatagramProtocol):
+    """
+    The master's UDP socket, as an asyncio protocol. Datagrams are handled as they arrive:
+    image parts are assembled (and reported on, for reliable transfers), and completed
+    images wait in a queue for each client until asked for. Replies to discovery and
+    clock syncs go to whoever waits for them, and anything heard from a client (a part
+    of an image or a reply) is told to the liveness tracker, if set.
+    """
+    _BROADCAST_ADDRESS = '<broadcast>'
+    DEFAULT_QUIET_PERIOD = UdpConnection.DEFAULT_QUIET_PERIOD
+    # How long to wait for the reply to a clock sync.
+    _CLOCK_SYNC_TIMEOUT = 0.1
+
+    def __init__(self, clients_port: int, timeout: Optional[float] = DEFAULT_TIMEOUT,
+                 client_addresses: Optional[List[Tuple]] = None, compression: Optional[CompressionSettings] = None,
+                 registry: Optional[WorkerRegistry] = None, quiet_period: float = DEFAULT_QUIET_PERIOD):
+        self._transport: Optional[asyncio.DatagramTransport] = None
+        self._clients_port = clients_port
+        self._timeout = timeout
+        # If known, commands to all the clients are sent to each of these addresses instead of being broadcast.
+        self._client_addresses = client_addresses
+        self._compression = compression if compression is not None else CompressionSettings()
+        self._registry = registry if registry is not None else WorkerRegistry()
+        self._quiet_period = quiet_period
+
+        self._requests = InFlightRequests()
+        self._assembler = udp.ImageAssembler(end_filter=self._requests.end_received)
+        # Client id -> images completed and not yet asked for.
+        self._completed: Dict[int, asyncio.Queue] = {}
+        # While discovering, the replies to it.
+        self._discovery_replies: Optional[asyncio.Queue] = None
+        # Server time of each clock sync in progress -> the future of its sample.
+        self._clock_syncs: Dict[float, asyncio.Future] = {}
+        self._liveness: Optional[LivenessTracker] = None
+        # While pinging clients, done whenever we hear from any client.
+        self._heard_waiters: Set[asyncio.Future] = set()
+
+    @property
+    def requests(self) -> InFlightRequests:
+        return self._requests
+
+    @property
+    def liveness(self) -> Optional[LivenessTracker]:
+        return self._liveness
+
+    def set_liveness(self, liveness: Optional[LivenessTracker]):
+        # Should be set before clients are created, like with master.client.Connection.
+        self._liveness = liveness
+
+    def connection_made(self, transport: asyncio.DatagramTransport):
+        self._transport = transport
+
+    def datagram_received(self, data: bytes, address: Tuple):
+        # Replies to commands are all shorter than an image part header.
+        if len(data) >= udp.IMAGE_HEADER.size:
+            self._heard_from(udp.sender_of(data))
+            self._handle_part(data, address)
+        elif data[:len(CLOCK_RESPONSE)] == CLOCK_RESPONSE:
+            self._handle_clock_reply(data)
+        elif self._discovery_replies is not None:
+            self._discovery_replies.put_nowait((data, address))
+        else:
+            # Answers to heartbeats, and clients we know of registering again.
+            # Anything else is left-overs from an earlier discovery.
+            client_id = handle_heartbeat_reply(data, address, self._registry, self._compression, self.send)
+            if client_id is not None:
+                self._heard_from(client_id)
+
+    def error_received(self, exc: Exception):
+        # E.g. a client which is gone, the transfers from it will time out.
+        get_metrics().counter('master.socket_errors').add()
+
+    async def do_discovery(self) -> List[AsyncClient]:
+        # Clients we know of reply to the ping with their id, new clients register. Once all
+        # the clients we know of replied (or any, when we know of none), we only wait until
+        # the replies die down.
+        self._discovery_replies = asyncio.Queue()
+        request_id = self.broadcast(CommandType.PING)
+        expected = expected_clients(self._registry, self._client_addresses)
+
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        deadline = started + (self._timeout if self._timeout is not None else DEFAULT_TIMEOUT)
+        last_reply = started
+        clients = {}
+        try:
+            while True:
+                wait = discovery_wait(loop.time(), deadline, last_reply, self._quiet_period, expected,
+                                      set(clients.keys()))
+                if wait <= 0:
+                    break
+
+                try:
+                    data, address = await asyncio.wait_for(self._discovery_replies.get(), wait)
+                except asyncio.TimeoutError:
+                    continue
+
+                client_id = handle_discovery_reply(data, address, self._registry, self._compression, self.send,
+                                                   request_id)
+                if client_id is not None:
+                    clients[(address[0], address[1])] = AsyncClient(client_id, address, self)
+                    last_reply = loop.time()
+        finally:
+            self._discovery_replies = None
+
+        self._registry.save()
+        missing = expected - clients.keys()
+        if len(missing) > 0:
+            print('Clients not responding:', sorted(missing))
+
+        get_metrics().counter('master.discovery.missing_clients').add(len(missing))
+        return sorted(clients.values(), key=lambda c: c.id)
+
+    def broadcast(self, command: CommandType, params: Optional[CommandParams] = None) -> int:
+        request_id = self._requests.new_id()
+        command_data = pack_command(command, params, request_id)
+        if self._client_addresses is None:
+            self.send(command_data, (self._BROADCAST_ADDRESS, self._clients_port))
+        else:
+            for address in self._client_addresses:
+                self.send(command_data, address)
+        return request_id
+
+    def send(self, data: bytes, address: Tuple):
+        self._transport.sendto(data, address)
+
+    async def receive_from(self, client_id: int) -> Optional[Image]:
+        return await asyncio.wait_for(self._queue_of(client_id).get(), self._timeout)
+
+    async def ping_clients(self, clients: List[AsyncClient], wait: float):
+        """
+        Sends the clients a heartbeat, and waits up to wait seconds, or until all of them
+        answered. Pings of several clients may be in progress at once.
+        """
+        for client in clients:
+            client.send_command(CommandType.PING)
+        if self._liveness is None:
+            return
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + wait
+        while any(self._liveness.is_waiting(client.id) for client in clients):
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            heard = loop.create_future()
+            self._heard_waiters.add(heard)
+            try:
+                await asyncio.wait_for(heard, remaining)
+            except asyncio.TimeoutError:
+                break
+            finally:
+                self._heard_waiters.discard(heard)
+
+    async def measure_clock(self, client: AsyncClient) -> Optional[ClockSample]:
+        # Syncs with several clients may be in progress at once, each waits for the reply
+        # to its own time (replies to earlier syncs are left-overs).
+        server_time = time.time()
+        future = asyncio.get_running_loop().create_future()
+        self._clock_syncs[server_time] = future
+        client.send_command(CommandType.SYNC_CLOCK, SyncClockParams(server_time))
+        try:
+            return await asyncio.wait_for(future, self._CLOCK_SYNC_TIMEOUT)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self._clock_syncs.pop(server_time, None)
+
+    def create_client(self, id: int, address: Tuple) -> AsyncClient:
+        return AsyncClient(id, address, self)
+
+    def missing_parts(self, client_id: int) -> Dict[int, List[int]]:
+        return self._assembler.missing_parts(client_id)
+
+    def set_digest_lookup(self, digest_lookup: Optional[Callable[[bytes], bool]]):
+        self._assembler.set_digest_lookup(digest_lookup)
+
+    def close(self):
+        if self._transport is not None:
+            self._transport.close()
+
+    def _handle_part(self, data: bytes, address: Tuple):
+        result, reply = self._assembler.feed(data)
+        if reply is not None:
+            self.send(reply, address)
+        if result is not None:
+            sender_id, image = result
+            self._queue_of(sender_id).put_nowait(image)
+
+    def _handle_clock_reply(self, data: bytes):
+        reply_time = time.time()
+        sent_time, received_time, replied_time = CLOCK_TIMES.unpack_from(data, len(CLOCK_RESPONSE))
+        future = self._clock_syncs.get(sent_time)
+        # Replies to syncs we gave up on are left-overs.
+        if future is not None and not future.done():
+            future.set_result(ClockSample(sent_time, received_time, replied_time, reply_time))
+
+    def _heard_from(self, client_id: int):
+        if self._liveness is None:
+            return
+        self._liveness.heard_from(client_id)
+        for heard in self._heard_waiters:
+            if not heard.done():
+                heard.set_result(client_id)
+
+    def _queue_of(self, client_id: int) -> asyncio.Queue:
+        completed = self._completed.get(client_id)
+        if completed is None:
+            completed = asyncio.Queue()
+            self._completed[client_id] = completed
+        return completed
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @staticmethod
+    async def create(local_port: int, clients_port: int, timeout: Optional[float] = DEFAULT_TIMEOUT,
+                     client_addresses: Optional[List[Tuple]] = None,
+                     compression: Optional[CompressionSettings] = None,
+                     registry: Optional[WorkerRegistry] = None,
+                     quiet_period: float = DEFAULT_QUIET_PERIOD,
+                     receive_buffer_size: Optional[int] = None,
+                     send_buffer_size: Optional[int] = None) -> 'AsyncConnection':
+        skt = UdpConnection._create_socket(local_port, None, receive_buffer_size, send_buffer_size)
+        connection = AsyncConnection(clients_port, timeout, client_addresses, compression, registry, quiet_period)
+        await asyncio.get_running_loop().create_datagram_endpoint(lambda: connection, sock=skt)
+        return connection
+
+
+class AsyncMaster(object):
+    """
+    Like master.master.Master, over an AsyncConnection. Each client is collected from
+    by its own task, so all the clients are collected from at once, and a client which
+    is too slow may be given up on without holding up the others.
+    Clients which stop answering (see master.liveness) are given up on once dead, and
+    those already dead when a collection starts are left out of it, so their images
+    wait for the next collection instead of holding up this one until client_timeout.
+    The storage is used on the executor (the loop's default if not given), so writing
+    images doesn't hold up the event loop. It must be safe to use from several threads.
+    """
+
+    def __init__(self, connection: AsyncConnection, storage: Storage, executor: Optional[Executor] = None,
+                 liveness: Optional[LivenessTracker] = None, heartbeat_wait: float = DEFAULT_HEARTBEAT_WAIT):
+        self._connection = connection
+        self._storage = storage
+        self._executor = executor
+        self._clients: List[AsyncClient] = []
+        self._liveness = liveness if liveness is not None else LivenessTracker()
+        self._heartbeat_wait = heartbeat_wait
+        self._collected = CollectedImages()
+
+        self._connection.set_digest_lookup(self._storage.contains_digest)
+        self._connection.set_liveness(self._liveness)
+
+    @property
+    def clients(self) -> List[AsyncClient]:
+        return list(self._clients)
+
+    @property
+    def capture_times(self) -> Dict[int, Dict[int, float]]:
+        return self._collected.capture_times
+
+    @property
+    def collected_pictures(self) -> set:
+        return set(self._collected.pictures)
+
+    @property
+    def liveness(self) -> LivenessTracker:
+        return self._liveness
+
+    async def discover_clients(self):
+        started = time.perf_counter()
+        self._clients = await self._connection.do_discovery()
+
+        metrics = get_metrics()
+        metrics.histogram('master.discovery_sec').record(time.perf_counter() - started)
+        metrics.gauge('master.clients').set(len(self._clients))
+
+    async def check_clients(self) -> Dict[int, Liveness]:
+        """
+        Sends all the clients a heartbeat, and waits a little for them to answer.
+        Returns the state of each client by id.
+        """
+        await self._connection.ping_clients(self._clients, self._heartbeat_wait)
+        return self._liveness.record_states(client.id for client in self._clients)
+
+    async def synchronize_clocks(self, rounds: int = DEFAULT_CLOCK_SYNC_ROUNDS) -> Dict[int, ClockSample]:
+        # Like master.master.synchronize_clocks, but the clients are synchronized all at once.
+        samples = await asyncio.gather(*[self._synchronize_clock(client, rounds) for client in self._clients])
+        return {client.id: sample for client, sample in zip(self._clients, samples) if sample is not None}
+
+    def take_picture(self, picture_id: int, delay: float = 0.0):
+        # delay seconds from now by our clock, like Master.take_picture.
+        capture_time = time.time() + delay if delay > 0 else 0.0
+        self._collected.capture_targets[picture_id] = capture_time
+        self._connection.broadcast(CommandType.TAKE_PICTURE, TakePictureParams(picture_id, capture_time))
+
+    def capture_skew(self) -> Dict[int, float]:
+        return capture_skew(self._collected.capture_times)
+
+    async def collect_pictures(self, stream: bool = False, client_timeout: Optional[float] = None,
+                               pipeline_depth: int = DEFAULT_PIPELINE_DEPTH) -> List[int]:
+        """
+        Collects the images stored by all the clients at once. With stream, each client
+        is asked once for all its images instead of for each separately, otherwise
+        pipeline_depth requests for the next image are kept in flight to each.
+        Clients not done after client_timeout seconds (if given), or which stopped
+        answering, are given up on, the images they didn't send are sent in the next collection.
+        Returns the ids of the clients whose collection failed or was given up on.
+        """
+        self._collected.start()
+        states = await self.check_clients()
+        clients = []
+        for client in self._clients:
+            if states[client.id] == Liveness.DEAD:
+                print('Client', client.id, 'is not answering, leaving it for the next collection')
+                get_metrics().counter('master.deferred_clients').add()
+            else:
+                clients.append(client)
+
+        tasks = [self._collect_from_client(client, stream, client_timeout, pipeline_depth) for client in clients]
+        results = await asyncio.gather(*tasks)
+        done = {client.id for client, client_done in zip(clients, results) if client_done}
+        failed = [client.id for client in self._clients if client.id not in done]
+
+        self._liveness.record_states(client.id for client in self._clients)
+        # The storage may still be writing in the background.
+        await self._run_storage(self._storage.flush)
+        self._collected.record_skew()
+        return failed
+
+    async def _synchronize_clock(self, client: AsyncClient, rounds: int) -> Optional[ClockSample]:
+        samples = [await self._connection.measure_clock(client) for _ in range(rounds)]
+        samples = [sample for sample in samples if sample is not None]
+        if len(samples) == 0:
+            print('No clock sync reply from client', client.id)
+            return None
+
+        sample = best_sample(samples)
+        client.send_command(CommandType.SET_CLOCK_OFFSET, ClockOffsetParams(sample.offset))
+        metrics = get_metrics()
+        metrics.gauge('master.client.{}.clock_offset_sec'.format(client.id)).set(sample.offset)
+        metrics.gauge('master.client.{}.clock_error_sec'.format(client.id)).set(sample.delay / 2)
+        return sample
+
+    async def _collect_from_client(self, client: AsyncClient, stream: bool, timeout: Optional[float],
+                                   pipeline_depth: int) -> bool:
+        # Returns whether all the images of the client were collected.
+        try:
+            await asyncio.wait_for(self._receive_all_images(client, stream, pipeline_depth), timeout)
+            return True
+        except asyncio.TimeoutError:
+            print('Giving up on client', client.id)
+            get_metrics().counter('master.abandoned_clients').add()
+            return False
+        finally:
+            client.forget_requests()
+
+    async def _receive_all_images(self, client: AsyncClient, stream: bool, pipeline_depth: int):
+        request = CommandType.SEND_ALL_PICTURES if stream else CommandType.SEND_NEXT_PICTURE
+        for _ in range(1 if stream else max(1, pipeline_depth)):
+            client.send_command(request)
+        # Whether the client sent all its images, but some of them are missing parts.
+        finishing = False
+        while True:
+            started = time.perf_counter()
+            image = await self._receive_image(client, request)
+            if image is None:
+                if client.resume_transfers():
+                    finishing = True
+                    continue
+                return
+
+            # The acknowledgement goes first, so the client doesn't send the image again
+            # when asked for the next one.
+            client.acknowledge_image(image)
+            if not stream:
+                client.send_command(CommandType.SEND_NEXT_PICTURE)
+            await self._handle_image(client, image, started)
+            if finishing and not client.has_partial_images():
+                return
+
+    async def _receive_image(self, client: AsyncClient, request: CommandType) -> Optional[Image]:
+        # If the transfer of an image is cut off, we ask the client to resume it (a few times).
+        # Otherwise we send it a heartbeat: if it answers, our request (or its answer) was lost,
+        # so we ask again. Raises asyncio.TimeoutError once the client stopped answering.
+        timeouts = 0
+        while True:
+            try:
+                return await client.receive_image()
+            except asyncio.TimeoutError:
+                timeouts += 1
+                if timeouts <= MAX_RESUMES and client.resume_transfers():
+                    continue
+                if timeouts > MAX_STALLS:
+                    raise
+
+                await self._connection.ping_clients([client], self._heartbeat_wait)
+                if self._liveness.state(client.id) == Liveness.DEAD:
+                    raise
+                if not self._liveness.is_waiting(client.id):
+                    client.send_command(request)
+
+    async def _handle_image(self, client: AsyncClient, image: Image, started: float):
+        # started is when we started waiting for the image.
+        received = time.perf_counter()
+        if not self._collected.add(client.id, image, received - started):
+            return
+
+        await self._run_storage(self._storage.store_image, client, image)
+        get_metrics().histogram('master.storage.store_sec').record(time.perf_counter() - received)
+
+    async def _run_storage(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
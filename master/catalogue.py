@@ -0,0 +1,252 @@
+"""
+An index of the collected images, kept in an SQLite database next to the images.
+Each image stored is recorded with its client, size, digest, when it was taken and
+received and where it was stored, so questions about the collected images (and
+summaries of whole runs) are answered without walking the directories.
+"""
+from pathlib import Path
+from typing import Optional, List, Dict, Tuple
+
+import datetime
+import sqlite3
+import threading
+import time
+
+from common.image import Image, ReferenceImage, compute_digest
+from common.metrics import get_metrics
+from master.client import Client
+from master.storage import Storage
+
+# Images are written to the database in batches of this many, instead of one by one.
+DEFAULT_BATCH_SIZE = 64
+# How long to wait for other processes writing the database (e.g. shards).
+_BUSY_TIMEOUT_SEC = 30
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    run TEXT PRIMARY KEY,
+    started REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS images (
+    run TEXT NOT NULL,
+    client_id INTEGER NOT NULL,
+    image_id INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    digest BLOB,
+    capture_time REAL,
+    receive_time REAL NOT NULL,
+    location TEXT,
+    PRIMARY KEY (run, client_id, image_id)
+);
+CREATE INDEX IF NOT EXISTS images_by_client ON images (client_id, run);
+CREATE INDEX IF NOT EXISTS images_by_digest ON images (digest);
+'''
+_ENTRY_COLUMNS = 'run, client_id, image_id, size, digest, capture_time, receive_time, location'
+
+
+class CatalogueEntry(object):
+    __slots__ = ('run', 'client_id', 'image_id', 'size', 'digest', 'capture_time', 'receive_time', 'location')
+
+    def __init__(self, run: str, client_id: int, image_id: int, size: int, digest: Optional[bytes],
+                 capture_time: Optional[float], receive_time: float, location: Optional[str]):
+        self.run = run
+        self.client_id = client_id
+        self.image_id = image_id
+        self.size = size
+        self.digest = digest
+        # When the client took the picture by our clock, if it told us.
+        self.capture_time = capture_time
+        self.receive_time = receive_time
+        # Where the storage put the image, if it can tell.
+        self.location = location
+
+    def to_row(self) -> Tuple:
+        return (self.run, self.client_id, self.image_id, self.size, self.digest, self.capture_time,
+                self.receive_time, self.location)
+
+
+class RunSummary(object):
+    """
+    The images collected in a run: how many, how big, from how many clients and
+    over what time, in total and by client (client id -> (images, bytes)).
+    """
+    __slots__ = ('run', 'started', 'image_count', 'total_bytes', 'first_capture', 'last_capture',
+                 'first_receive', 'last_receive', 'clients')
+
+    def __init__(self, run: str, started: Optional[float]):
+        self.run = run
+        self.started = started
+        self.image_count = 0
+        self.total_bytes = 0
+        self.first_capture = None
+        self.last_capture = None
+        self.first_receive = None
+        self.last_receive = None
+        self.clients: Dict[int, Tuple[int, int]] = {}
+
+    @property
+    def client_count(self) -> int:
+        return len(self.clients)
+
+
+class Catalogue(object):
+    """
+    The database of the images collected. Entries are added in batches, and are
+    all written by flush (and by any query, so queries see everything added).
+    May be used from several threads, and by several processes (each with its own
+    Catalogue of the same path).
+    """
+
+    def __init__(self, path: Path, batch_size: int = DEFAULT_BATCH_SIZE):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._database = sqlite3.connect(str(path), timeout=_BUSY_TIMEOUT_SEC, check_same_thread=False)
+        # With write-ahead logging readers don't wait for writers, and batches are
+        # written without syncing the whole database each time.
+        self._database.execute('PRAGMA journal_mode=WAL')
+        self._database.execute('PRAGMA synchronous=NORMAL')
+        self._database.executescript(_SCHEMA)
+        self._batch_size = batch_size
+        self._pending: List[Tuple] = []
+        self._lock = threading.Lock()
+
+    def start_run(self, run: Optional[str] = None) -> str:
+        # Runs are named after when they started, unless given a name.
+        started = time.time()
+        if run is None:
+            run = datetime.datetime.fromtimestamp(started).strftime('%Y-%m-%d-%H:%M:%S')
+        with self._lock, self._database:
+            self._database.execute('INSERT OR IGNORE INTO runs (run, started) VALUES (?, ?)', (run, started))
+        return run
+
+    def add(self, entry: CatalogueEntry):
+        with self._lock:
+            self._pending.append(entry.to_row())
+            if len(self._pending) >= self._batch_size:
+                self._write_pending()
+
+    def flush(self):
+        with self._lock:
+            self._write_pending()
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            self._database.close()
+
+    def runs(self) -> List[str]:
+        # From the first to the last.
+        return [row[0] for row in self._query('SELECT run FROM runs ORDER BY started, run')]
+
+    def images(self, run: Optional[str] = None, client_id: Optional[int] = None,
+               image_id: Optional[int] = None) -> List[CatalogueEntry]:
+        """
+        The images of a run, a client and with an id, where given (e.g. all the
+        images of client 17 in a run). Ordered by run, client and image id.
+        """
+        conditions = []
+        params = []
+        for column, value in (('run', run), ('client_id', client_id), ('image_id', image_id)):
+            if value is not None:
+                conditions.append('{} = ?'.format(column))
+                params.append(value)
+
+        sql = 'SELECT {} FROM images'.format(_ENTRY_COLUMNS)
+        if len(conditions) > 0:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY run, client_id, image_id'
+        return [CatalogueEntry(*row) for row in self._query(sql, params)]
+
+    def find_digest(self, digest: bytes) -> List[CatalogueEntry]:
+        # All the images with this data, from all the runs.
+        sql = 'SELECT {} FROM images WHERE digest = ? ORDER BY run, client_id, image_id'.format(_ENTRY_COLUMNS)
+        return [CatalogueEntry(*row) for row in self._query(sql, (digest,))]
+
+    def summarize_run(self, run: str) -> RunSummary:
+        started_rows = self._query('SELECT started FROM runs WHERE run = ?', (run,))
+        summary = RunSummary(run, started_rows[0][0] if len(started_rows) > 0 else None)
+
+        totals = self._query('SELECT COUNT(*), COALESCE(SUM(size), 0), MIN(capture_time), MAX(capture_time), '
+                             'MIN(receive_time), MAX(receive_time) FROM images WHERE run = ?', (run,))[0]
+        (summary.image_count, summary.total_bytes, summary.first_capture, summary.last_capture,
+         summary.first_receive, summary.last_receive) = totals
+
+        rows = self._query('SELECT client_id, COUNT(*), SUM(size) FROM images WHERE run = ? '
+                           'GROUP BY client_id ORDER BY client_id', (run,))
+        summary.clients = {client_id: (count, size) for client_id, count, size in rows}
+        return summary
+
+    def _query(self, sql: str, params=()) -> List[Tuple]:
+        with self._lock:
+            self._write_pending()
+            return self._database.execute(sql, params).fetchall()
+
+    def _write_pending(self):
+        # Called with the lock held.
+        if len(self._pending) == 0:
+            return
+
+        started = time.perf_counter()
+        with self._database:
+            # An image sent again (e.g. not acknowledged in time) replaces the first.
+            self._database.executemany('INSERT OR REPLACE INTO images ({}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)'
+                                       .format(_ENTRY_COLUMNS), self._pending)
+
+        metrics = get_metrics()
+        metrics.histogram('master.catalogue.batch_sec').record(time.perf_counter() - started)
+        metrics.counter('master.catalogue.entries').add(len(self._pending))
+        self._pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return self
+
+
+class CataloguedStorage(Storage):
+    """
+    Stores images with another storage, and records each in a catalogue once stored.
+    The receive time is when the image is given to this storage, so it should
+    wrap a WriteBehindStorage rather than be wrapped by one. The digests are then
+    computed by the threads writing the images, not by the one receiving them.
+    If compute_digests is False, only the digests of images given by reference are recorded.
+    Closing the storage closes the catalogue as well.
+    """
+
+    def __init__(self, storage: Storage, catalogue: Catalogue, run: Optional[str] = None,
+                 compute_digests: bool = True):
+        self._storage = storage
+        self._catalogue = catalogue
+        self._run = catalogue.start_run(run)
+        self._compute_digests = compute_digests
+
+    @property
+    def run(self) -> str:
+        return self._run
+
+    def contains_digest(self, digest: bytes) -> bool:
+        return self._storage.contains_digest(digest)
+
+    def store_image(self, client: Client, image: Image):
+        receive_time = time.time()
+        self._storage.store_image_then(client, image, lambda: self._record(client, image, receive_time))
+
+    def _record(self, client: Client, image: Image, receive_time: float):
+        digest = compute_digest(image) if self._compute_digests or isinstance(image, ReferenceImage) else None
+        capture_time = image.timestamp if image.timestamp > 0 else None
+        self._catalogue.add(CatalogueEntry(self._run, client.id, image.id, len(image), digest, capture_time,
+                                           receive_time, self._storage.location_of(client, image)))
+
+    def location_of(self, client: Client, image: Image) -> Optional[str]:
+        return self._storage.location_of(client, image)
+
+    def flush(self):
+        self._storage.flush()
+        self._catalogue.flush()
+
+    def close(self):
+        try:
+            self._storage.close()
+        finally:
+            self._catalogue.close()
@@ -1,13 +1,24 @@
 from abc import ABC, abstractmethod
-from typing import Optional, Tuple, List
+from typing import Optional, Tuple, List, Set, Callable, Dict
 
 import socket
-import struct
-
-from common.command import CommandType, CommandParams, pack_command
-from common.data import REGISTER_RESPONSE
+import time
+
+from common.clock import ClockSample
+from common.command import CommandType, CommandParams, SyncClockParams, AcknowledgeParams, ResumeParams, \
+    AssignShardParams, NO_REQUEST_ID, pack_command
+from common.compression import CompressionSettings
+from common.data import REGISTER_RESPONSE, REGISTER_CODECS, REGISTER_ID, PING_RESPONSE, CLOCK_RESPONSE, \
+    CLOCK_TIMES, SHARD_RESPONSE, SHARD_PORT, unpack_reply_request_id
 from common.image import Image
-from common import udp
+from common.metrics import get_metrics
+from common import tcp, udp
+from master.discovery import WorkerRegistry
+from master.inflight import InFlightRequests, ANSWERED_COMMANDS
+from master.liveness import LivenessTracker
+
+# Commands the client answers, so we are waiting for it until it does (see master.liveness).
+PROBING_COMMANDS = ANSWERED_COMMANDS | frozenset([CommandType.PING])
 
 
 class Client(ABC):
@@ -27,6 +38,28 @@ class Client(ABC):
     def receive_image(self) -> Optional[Image]:
         pass
 
+    def acknowledge_image(self, image: Image):
+        # Tells the client we received the image, so it may forget it.
+        self.send_command(CommandType.ACKNOWLEDGE_PICTURE, AcknowledgeParams(image.id))
+
+    def resume_transfers(self) -> bool:
+        """
+        Asks the client to send again the parts we are missing of images whose transfer
+        was cut off. Returns whether there were any.
+        """
+        return False
+
+    def has_partial_images(self) -> bool:
+        # Whether we have parts of images of the client, and are missing others.
+        return False
+
+    def forget_requests(self):
+        """
+        Forgets the requests in flight to the client, once we are done with it, so
+        whatever else it answers them with is taken as left-overs.
+        """
+        pass
+
 
 class Connection(ABC):
 
@@ -35,9 +68,65 @@ class Connection(ABC):
         pass
 
     @abstractmethod
-    def broadcast(self, command: CommandType, params: Optional[CommandParams] = None):
+    def broadcast(self, command: CommandType, params: Optional[CommandParams] = None) -> int:
+        # Returns the id of the request, which the clients echo in their replies.
+        pass
+
+    @abstractmethod
+    def receive_image(self) -> Tuple[int, Optional[Image]]:
+        """
+        Receives the next image sent by any of the clients.
+        Returns the id of the sending client and the image, or None if the client
+        has no more images.
+        """
+        pass
+
+    @abstractmethod
+    def measure_clock(self, client: Client) -> Optional[ClockSample]:
+        """
+        Does a clock sync with the client, see common.clock.
+        Returns None if the client did not reply in time.
+        """
         pass
 
+    @abstractmethod
+    def assign_shard(self, client: Client, port: int) -> bool:
+        """
+        Tells the client to send its images to another port (see master.sharded).
+        Returns whether the client confirmed it.
+        """
+        pass
+
+    @abstractmethod
+    def create_client(self, id: int, address: Tuple) -> Client:
+        """
+        Creates a client we already know of (e.g. discovered by another connection)
+        without discovering it.
+        """
+        pass
+
+    def set_digest_lookup(self, digest_lookup: Optional[Callable[[bytes], bool]]):
+        """
+        Sets what tells whether we already have an image with a digest, so clients
+        offering the digest of such an image will not send it.
+        """
+        pass
+
+    def set_liveness(self, liveness: Optional[LivenessTracker]):
+        """
+        Sets what is told whenever we ask clients something and hear from them.
+        Should be set before clients are created.
+        """
+        pass
+
+    def ping_clients(self, clients: List[Client], wait: float):
+        """
+        Sends the clients a heartbeat, and handles whatever arrives for up to wait seconds,
+        or until all of them answered. Images completed meanwhile are kept for receive_image.
+        """
+        for client in clients:
+            client.send_command(CommandType.PING)
+
     @abstractmethod
     def close(self):
         pass
@@ -45,68 +134,360 @@ class Connection(ABC):
 
 class UdpClient(Client):
 
-    def __init__(self, id: int, socket: socket.socket, address: Tuple):
+    def __init__(self, id: int, socket: socket.socket, address: Tuple, receiver: udp.ImageReceiver,
+                 requests: InFlightRequests, liveness: Optional[LivenessTracker] = None):
         super().__init__(id)
         self._socket = socket
         self._address = address
+        self._receiver = receiver
+        # Shared by all the clients of the connection.
+        self._requests = requests
+        self._liveness = liveness
+
+    @property
+    def address(self) -> Tuple:
+        return self._address
 
     def send_command(self, command: CommandType, params: Optional[CommandParams] = None):
-        command_data = pack_command(command, params)
+        command_data = pack_command(command, params, self._requests.start(self._id, command))
         self._socket.sendto(command_data, self._address)
+        if self._liveness is not None and command in PROBING_COMMANDS:
+            self._liveness.asked(self._id)
 
     def receive_image(self) -> Optional[Image]:
-        return udp.receive_image(self._socket)
+        image = self._receiver.receive_from(self._id)
+        if self._liveness is not None:
+            self._liveness.heard_from(self._id)
+        if image is not None:
+            self._requests.image_received(self._id)
+        return image
+
+    def resume_transfers(self) -> bool:
+        return request_missing_parts(self, self._receiver.missing_parts(self._id))
+
+    def has_partial_images(self) -> bool:
+        return len(self._receiver.missing_parts(self._id)) > 0
+
+    def forget_requests(self):
+        self._requests.forget(self._id)
+
+
+def request_missing_parts(client, missing_parts: Dict[int, List[int]]) -> bool:
+    # Asks the client (sync or async) for the parts it should send again, by image id.
+    # Returns whether there were any.
+    for image_id, missing in missing_parts.items():
+        # If more parts are missing than fit in the command, we ask again for the rest.
+        client.send_command(CommandType.RESUME_PICTURE, ResumeParams(image_id, missing))
+        get_metrics().counter('master.resumed_transfers').add()
+    return len(missing_parts) > 0
+
+
+def expected_clients(registry: WorkerRegistry, client_addresses: Optional[List[Tuple]]) -> Set[Tuple[str, int]]:
+    # The addresses of the clients we know of, which should reply to discovery.
+    expected = set(registry.addresses())
+    if client_addresses is not None:
+        expected.update((address[0], address[1]) for address in client_addresses)
+    return expected
+
+
+def discovery_wait(now: float, deadline: float, last_reply: float, quiet_period: float,
+                   expected: Set[Tuple[str, int]], replied: Set[Tuple[str, int]]) -> float:
+    """
+    How much longer discovery should wait for replies (nothing left if not positive).
+    Once all the clients we know of replied, or when we know of none, once any client
+    replied, we only wait until no new client replied for the quiet period.
+    """
+    wait = deadline - now
+    if (len(expected) > 0 and expected.issubset(replied)) or (len(expected) == 0 and len(replied) > 0):
+        wait = min(wait, last_reply + quiet_period - now)
+    return wait
+
+
+def handle_discovery_reply(data: bytes, address: Tuple, registry: WorkerRegistry, compression: CompressionSettings,
+                           send: Callable[[bytes, Tuple], None], request_id: int = NO_REQUEST_ID) -> Optional[int]:
+    """
+    Handles a reply to a discovery ping (whose request id is given), sending whatever
+    the client should get back. Returns the id of the client which replied, if it is ready.
+    """
+    metrics = get_metrics()
+    if data[:len(PING_RESPONSE)] == PING_RESPONSE:
+        if not _is_reply_to(data, len(PING_RESPONSE) + REGISTER_ID.size, request_id):
+            return None
+        client_id, = REGISTER_ID.unpack_from(data, len(PING_RESPONSE))
+        if client_id == registry.id_of(address):
+            metrics.counter('master.discovery.confirmed').add()
+            return client_id
+
+        # It was given an id by someone else (or we forgot it), so it registers again.
+        print('Client', address, 'has unknown ID:', client_id)
+        send(pack_command(CommandType.REGISTER, None), address)
+        return None
+
+    if data[:len(REGISTER_RESPONSE)] != REGISTER_RESPONSE:
+        # Anything else is left-overs from previous transfers.
+        return None
+    if not _is_reply_to(data, len(REGISTER_RESPONSE) + REGISTER_CODECS.size, request_id):
+        return None
+
+    # Clients which don't tell us what codecs they support, don't support any.
+    codecs_data = data[len(REGISTER_RESPONSE):]
+    supported_codecs = 0
+    if len(codecs_data) >= REGISTER_CODECS.size:
+        supported_codecs, = REGISTER_CODECS.unpack_from(codecs_data)
+    compression = compression.negotiate(supported_codecs)
+
+    # Clients we know of get back their id.
+    id = registry.register(address)
+    print('New client:', address, 'ID:', id, 'Compression:', compression.codec.name)
+    metrics.counter('master.discovery.registered').add()
+
+    # Send the client a response with their id and how to compress
+    send(REGISTER_ID.pack(id) + compression.pack(), address)
+    return id
+
+
+def handle_heartbeat_reply(data: bytes, address: Tuple, registry: WorkerRegistry, compression: CompressionSettings,
+                           send: Callable[[bytes, Tuple], None]) -> Optional[int]:
+    """
+    Handles a reply arriving outside of discovery (e.g. while receiving images). Returns
+    the id of the client which replied, if it is one of ours: an answer to a heartbeat,
+    or a client we know of which lost its id (e.g. restarted) registering again.
+    """
+    if data[:len(PING_RESPONSE)] == PING_RESPONSE:
+        if len(data) < len(PING_RESPONSE) + REGISTER_ID.size:
+            return None
+        client_id, = REGISTER_ID.unpack_from(data, len(PING_RESPONSE))
+        return client_id
+
+    # New clients wait for discovery, as some other master might have them.
+    if data[:len(REGISTER_RESPONSE)] != REGISTER_RESPONSE or registry.id_of(address) is None:
+        return None
+    return handle_discovery_reply(data, address, registry, compression, send)
+
+
+def _is_reply_to(data: bytes, reply_size: int, request_id: int) -> bool:
+    # Replies to an earlier discovery are left-overs. Replies without a request id are
+    # from older clients, or to commands without one (e.g. a register request).
+    reply_request_id = unpack_reply_request_id(data, reply_size)
+    if reply_request_id == NO_REQUEST_ID or reply_request_id == request_id:
+        return True
+
+    get_metrics().counter('master.discovery.stale_replies').add()
+    return False
 
 
 class UdpConnection(Connection):
     _BROADCAST_ADDRESS = '<broadcast>'
-    _DISCOVERY_COMMAND = CommandType.REGISTER
-    _DISCOVERY_RESPONSE = REGISTER_RESPONSE
-
-    def __init__(self, skt: socket.socket, clients_port: int):
+    _DISCOVERY_COMMAND = CommandType.PING
+    # How long discovery waits for replies, if the socket has no timeout.
+    _DEFAULT_DISCOVERY_TIMEOUT = 1.0
+    # Once all the clients we know of replied, how long to wait for new clients.
+    DEFAULT_QUIET_PERIOD = 0.05
+    # How long to wait for the reply to a clock sync.
+    _CLOCK_SYNC_TIMEOUT = 0.1
+    # How long to wait for a client to confirm its shard, and how many times to tell it.
+    _ASSIGN_SHARD_TIMEOUT = 0.1
+    _ASSIGN_SHARD_ATTEMPTS = 3
+
+    def __init__(self, skt: socket.socket, clients_port: int, client_addresses: Optional[List[Tuple]] = None,
+                 compression: Optional[CompressionSettings] = None, registry: Optional[WorkerRegistry] = None,
+                 quiet_period: float = DEFAULT_QUIET_PERIOD):
         self._socket = skt
         self._clients_port = clients_port
-        self._client_id_generator = 0
+        # How we want clients to compress images, if they support it.
+        self._compression = compression if compression is not None else CompressionSettings()
+        # If known, commands to all the clients are sent to each of these addresses
+        # instead of being broadcast (e.g. when all the clients are on one machine).
+        self._client_addresses = client_addresses
+        # Gives the clients the same id each time they are discovered.
+        self._registry = registry if registry is not None else WorkerRegistry()
+        self._quiet_period = quiet_period
+        # All the clients share our socket, so they share the receiver as well,
+        # and the requests in flight to them.
+        self._requests = InFlightRequests()
+        self._liveness: Optional[LivenessTracker] = None
+        self._receiver = udp.ImageReceiver(skt, end_filter=self._requests.end_received)
+        self._receiver.set_activity_listener(self._heard_from)
+        self._receiver.set_reply_handler(self._handle_reply)
+        # While waiting for a reply (see _wait_for_reply), tells it, and where it goes when it arrives.
+        self._awaited_reply: Optional[Tuple[Callable[[bytes, Tuple], bool], List]] = None
 
     def do_discovery(self) -> List[Client]:
-        # Send to all the clients that they should report their existence.
-        self.broadcast(CommandType.REGISTER)
-
-        clients = []
-        # Collect responses from clients
-        while True:
-            try:
-                client = self._discovery_once()
-                clients.append(client)
-            except socket.timeout as e:
-                # If we receive a timeout it's because there are no more
-                # clients and so we're finished with this.
-                print('No more clients')
-                break
-
-        return clients
-
-    def broadcast(self, command: CommandType, params: Optional[CommandParams] = None):
-        command_data = pack_command(command, params)
-        self._socket.sendto(command_data, (self._BROADCAST_ADDRESS, self._clients_port))
+        """
+        Finds all the clients. Clients we already know reply to a ping with their id,
+        and only new clients go through registration.
+        Replies are handled in the order they arrive, and we stop waiting once all
+        the clients we know of replied (or any, when we know of none) and no new
+        client showed up for the quiet period.
+        """
+        request_id = self.broadcast(self._DISCOVERY_COMMAND)
+        expected = expected_clients(self._registry, self._client_addresses)
+
+        socket_timeout = self._socket.gettimeout()
+        started = time.monotonic()
+        deadline = started + (socket_timeout if socket_timeout is not None else self._DEFAULT_DISCOVERY_TIMEOUT)
+        last_reply = started
+        clients = {}
+        try:
+            while True:
+                wait = discovery_wait(time.monotonic(), deadline, last_reply, self._quiet_period, expected,
+                                      set(clients.keys()))
+                if wait <= 0:
+                    break
+
+                self._socket.settimeout(wait)
+                try:
+                    data, address = self._socket.recvfrom(udp.MAX_UDP_SIZE)
+                except socket.timeout:
+                    continue
+
+                client = self._handle_discovery_reply(data, address, request_id)
+                if client is not None:
+                    clients[(address[0], address[1])] = client
+                    last_reply = time.monotonic()
+        finally:
+            self._socket.settimeout(socket_timeout)
+
+        self._registry.save()
+        missing = expected - clients.keys()
+        if len(missing) > 0:
+            print('Clients not responding:', sorted(missing))
+        print('No more clients')
+
+        get_metrics().counter('master.discovery.missing_clients').add(len(missing))
+        return sorted(clients.values(), key=lambda c: c.id)
+
+    def broadcast(self, command: CommandType, params: Optional[CommandParams] = None) -> int:
+        request_id = self._requests.new_id()
+        command_data = pack_command(command, params, request_id)
+        if self._client_addresses is None:
+            self._socket.sendto(command_data, (self._BROADCAST_ADDRESS, self._clients_port))
+        else:
+            for address in self._client_addresses:
+                self._socket.sendto(command_data, address)
+        return request_id
+
+    def receive_image(self) -> Tuple[int, Optional[Image]]:
+        client_id, image = self._receiver.receive()
+        self._heard_from(client_id)
+        if image is not None:
+            self._requests.image_received(client_id)
+        return client_id, image
+
+    def ping_clients(self, clients: List[Client], wait: float):
+        super().ping_clients(clients, wait)
+        if self._liveness is None:
+            return
+
+        socket_timeout = self._socket.gettimeout()
+        deadline = time.monotonic() + wait
+        try:
+            while any(self._liveness.is_waiting(client.id) for client in clients):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._socket.settimeout(remaining)
+                try:
+                    self._poll()
+                except socket.timeout:
+                    break
+        finally:
+            self._socket.settimeout(socket_timeout)
+
+    def measure_clock(self, client: Client) -> Optional[ClockSample]:
+        server_time = time.time()
+        client.send_command(CommandType.SYNC_CLOCK, SyncClockParams(server_time))
+
+        # Replies to earlier syncs are left-overs.
+        def is_reply(data: bytes, address: Tuple) -> bool:
+            return data[:len(CLOCK_RESPONSE)] == CLOCK_RESPONSE and \
+                CLOCK_TIMES.unpack_from(data, len(CLOCK_RESPONSE))[0] == server_time
+
+        reply = self._wait_for_reply(is_reply, self._CLOCK_SYNC_TIMEOUT)
+        if reply is None:
+            return None
+        data, address, reply_time = reply
+        sent_time, received_time, replied_time = CLOCK_TIMES.unpack_from(data, len(CLOCK_RESPONSE))
+        return ClockSample(server_time, received_time, replied_time, reply_time)
+
+    def assign_shard(self, client: Client, port: int) -> bool:
+        # Confirmations of earlier assignments are left-overs.
+        def is_reply(data: bytes, address: Tuple) -> bool:
+            return data[:len(SHARD_RESPONSE)] == SHARD_RESPONSE and address == client.address and \
+                SHARD_PORT.unpack_from(data, len(SHARD_RESPONSE))[0] == port
+
+        for _ in range(self._ASSIGN_SHARD_ATTEMPTS):
+            client.send_command(CommandType.ASSIGN_SHARD, AssignShardParams(port))
+            if self._wait_for_reply(is_reply, self._ASSIGN_SHARD_TIMEOUT) is not None:
+                self._heard_from(client.id)
+                return True
+        return False
+
+    def create_client(self, id: int, address: Tuple) -> Client:
+        return UdpClient(id, self._socket, address, self._receiver, self._requests, self._liveness)
+
+    def set_digest_lookup(self, digest_lookup: Optional[Callable[[bytes], bool]]):
+        self._receiver.set_digest_lookup(digest_lookup)
+
+    def set_liveness(self, liveness: Optional[LivenessTracker]):
+        self._liveness = liveness
 
     def close(self):
         self._socket.close()
 
-    def _discovery_once(self) -> Client:
-        # Wait to receive info from a client.
-        data, client = self._socket.recvfrom(len(self._DISCOVERY_RESPONSE))
-
-        # Make and ID for the client
-        self._client_id_generator += 1
-        id = self._client_id_generator
-        print('New client:', client, 'ID:', id)
-
-        # Send the client a response with their id
-        data = struct.pack('i', id)
-        self._socket.sendto(data, client)
-        # Return the client
-        return UdpClient(id, self._socket, client)
+    def _handle_discovery_reply(self, data: bytes, address: Tuple, request_id: int) -> Optional[Client]:
+        # Returns the client which replied, if it is ready.
+        client_id = handle_discovery_reply(data, address, self._registry, self._compression, self._socket.sendto,
+                                           request_id)
+        if client_id is None:
+            return None
+        self._heard_from(client_id)
+        return self.create_client(client_id, address)
+
+    def _poll(self):
+        # Handles whatever arrives next on the socket, while waiting for heartbeats.
+        self._receiver.poll()
+
+    def _wait_for_reply(self, is_reply: Callable[[bytes, Tuple], bool], timeout: float) \
+            -> Optional[Tuple[bytes, Tuple, float]]:
+        """
+        Waits up to timeout for a reply for which is_reply is true, and returns it with where it
+        came from and when it arrived. Whatever else arrives meanwhile (e.g. parts of images
+        of clients in the middle of a transfer) is handled as usual.
+        """
+        replies = []
+        self._awaited_reply = (is_reply, replies)
+        socket_timeout = self._socket.gettimeout()
+        deadline = time.monotonic() + timeout
+        try:
+            while len(replies) == 0:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._socket.settimeout(remaining)
+                try:
+                    self._poll()
+                except socket.timeout:
+                    return None
+        finally:
+            self._awaited_reply = None
+            self._socket.settimeout(socket_timeout)
+        return replies[0]
+
+    def _handle_reply(self, data: bytes, address: Tuple):
+        if self._awaited_reply is not None:
+            is_reply, replies = self._awaited_reply
+            if len(replies) == 0 and is_reply(data, address):
+                replies.append((data, address, time.time()))
+                return
+
+        client_id = handle_heartbeat_reply(data, address, self._registry, self._compression, self._socket.sendto)
+        if client_id is not None:
+            self._heard_from(client_id)
+
+    def _heard_from(self, client_id: int):
+        if self._liveness is not None:
+            self._liveness.heard_from(client_id)
 
     def __enter__(self):
         return self
@@ -116,15 +497,74 @@ class UdpConnection(Connection):
         return self
 
     @staticmethod
-    def create(local_port: int, clients_port: int, timeout: float = None):
+    def create(local_port: int, clients_port: int, timeout: float = None,
+               client_addresses: Optional[List[Tuple]] = None,
+               compression: Optional[CompressionSettings] = None,
+               registry: Optional[WorkerRegistry] = None,
+               quiet_period: float = DEFAULT_QUIET_PERIOD,
+               receive_buffer_size: Optional[int] = None,
+               send_buffer_size: Optional[int] = None):
+        # All the clients send their images to our one socket, so a receive buffer bigger
+        # than the kernel's default keeps their bursts from being dropped.
+        skt = UdpConnection._create_socket(local_port, timeout, receive_buffer_size, send_buffer_size)
+        return UdpConnection(skt, clients_port, client_addresses, compression, registry, quiet_period)
+
+    @staticmethod
+    def _create_socket(local_port: int, timeout: Optional[float], receive_buffer_size: Optional[int] = None,
+                       send_buffer_size: Optional[int] = None) -> socket.socket:
         skt = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         # Enable broadcasting mode
         skt.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        udp.set_buffer_sizes(skt, send_buffer_size, receive_buffer_size)
         if timeout is not None:
             # Set the timeout for reading info, so that we get timeout exception.
             skt.settimeout(timeout)
         # Bind the socket to the address and port.
         skt.bind(('', local_port))
+        return skt
+
+
+class TcpConnection(UdpConnection):
+    """
+    Commands are sent over UDP, like in UdpConnection, but clients send their
+    images over TCP connections to the same port, which are kept open between images.
+    """
+
+    def __init__(self, skt: socket.socket, listen_socket: socket.socket, clients_port: int,
+                 client_addresses: Optional[List[Tuple]] = None,
+                 compression: Optional[CompressionSettings] = None, registry: Optional[WorkerRegistry] = None,
+                 quiet_period: float = UdpConnection.DEFAULT_QUIET_PERIOD):
+        super().__init__(skt, clients_port, client_addresses, compression, registry, quiet_period)
+        # Images come in over the connections accepted on the listening socket.
+        self._receiver = tcp.ImageReceiver(listen_socket, skt.gettimeout())
 
-        return UdpConnection(skt, clients_port)
+    def close(self):
+        self._receiver.close()
+        super().close()
+
+    def _poll(self):
+        # Images come in over TCP, so only replies arrive on the socket.
+        data, address = self._socket.recvfrom(udp.MAX_UDP_SIZE)
+        self._handle_reply(data, address)
+
+    @staticmethod
+    def create(local_port: int, clients_port: int, timeout: float = None,
+               client_addresses: Optional[List[Tuple]] = None,
+               compression: Optional[CompressionSettings] = None,
+               registry: Optional[WorkerRegistry] = None,
+               quiet_period: float = UdpConnection.DEFAULT_QUIET_PERIOD,
+               receive_buffer_size: Optional[int] = None,
+               send_buffer_size: Optional[int] = None):
+        skt = UdpConnection._create_socket(local_port, timeout, send_buffer_size=send_buffer_size)
+
+        listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # Accepted connections get the buffer size of the listening socket, which must be
+        # set before listening for the window to be scaled to it.
+        udp.set_buffer_sizes(listen_socket, receive_buffer_size=receive_buffer_size)
+        listen_socket.bind(('', local_port))
+        listen_socket.listen(tcp.LISTEN_BACKLOG)
+
+        return TcpConnection(skt, listen_socket, clients_port, client_addresses, compression, registry,
+                             quiet_period)
 
@@ -0,0 +1,77 @@
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import json
+import os
+
+
+class WorkerRegistry(object):
+    """
+    The ids given to the workers, by their address, so a worker keeps its id
+    when it is discovered again. If given a path, the registry is kept there
+    as JSON, so the ids also survive restarts of the master.
+    """
+
+    def __init__(self, path: Optional[Path] = None):
+        self._path = path
+        self._ids: Dict[Tuple[str, int], int] = {}
+        self._last_id = 0
+        self._changed = False
+
+        if path is not None and path.exists():
+            self._load()
+
+    def id_of(self, address: Tuple[str, int]) -> Optional[int]:
+        return self._ids.get(self._key(address))
+
+    def register(self, address: Tuple[str, int]) -> int:
+        # Returns the id of the worker, giving it a new one if it doesn't have any.
+        key = self._key(address)
+        id = self._ids.get(key)
+        if id is None:
+            self._last_id += 1
+            id = self._last_id
+            self._ids[key] = id
+            self._changed = True
+
+        return id
+
+    def forget(self, address: Tuple[str, int]):
+        if self._ids.pop(self._key(address), None) is not None:
+            self._changed = True
+
+    def addresses(self) -> List[Tuple[str, int]]:
+        return list(self._ids.keys())
+
+    def save(self):
+        if self._path is None or not self._changed:
+            return
+
+        data = {
+            'last_id': self._last_id,
+            'workers': [{'host': host, 'port': port, 'id': id} for (host, port), id in self._ids.items()],
+        }
+        # Write to the side and replace, so a crash doesn't leave a broken registry.
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = self._path.with_name(self._path.name + '.tmp')
+        with temp_path.open(mode='w') as f:
+            json.dump(data, f, indent=2)
+        os.replace(str(temp_path), str(self._path))
+        self._changed = False
+
+    def __len__(self):
+        return len(self._ids)
+
+    def _load(self):
+        with self._path.open() as f:
+            data = json.load(f)
+
+        for worker in data['workers']:
+            self._ids[(worker['host'], worker['port'])] = worker['id']
+        # Ids of forgotten workers are not given again.
+        self._last_id = max([data.get('last_id', 0)] + list(self._ids.values()))
+
+    @staticmethod
+    def _key(address: Tuple) -> Tuple[str, int]:
+        # Addresses from the socket may be lists (e.g. after JSON) or have more fields (IPv6).
+        return address[0], address[1]
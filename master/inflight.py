@@ -0,0 +1,99 @@
+"""
+Tracking of the requests sent to clients, by the ids they carry (see common.command),
+so several requests may be in flight to a client at once, and replies which are
+left-overs of earlier requests (e.g. a late end marker) are told apart.
+"""
+from typing import Dict, List, Tuple
+
+import random
+import threading
+import time
+
+from common.command import CommandType, NO_REQUEST_ID, MAX_REQUEST_ID
+from common.metrics import get_metrics
+
+# Requests answered by an image or by the client's end marker, which are tracked
+# until answered. Others get an id only so the client can echo it.
+ANSWERED_COMMANDS = frozenset([CommandType.SEND_NEXT_PICTURE, CommandType.SEND_ALL_PICTURES,
+                               CommandType.STOP_STREAM])
+# Requests kept in flight for each client, beyond which the oldest are forgotten
+# (their answers were probably lost).
+DEFAULT_MAX_IN_FLIGHT = 64
+
+
+class InFlightRequests(object):
+    """
+    The requests sent to each client and not answered yet, by request id.
+    Images don't carry the id of the request they answer, so an image answers the
+    oldest image request of its client. End markers carry the id of their request.
+    May be used from several threads.
+    """
+
+    def __init__(self, max_in_flight: int = DEFAULT_MAX_IN_FLIGHT):
+        self._max_in_flight = max_in_flight
+        # Ids start anywhere, so a restarted server is unlikely to take answers to its old requests.
+        self._next_id = random.randint(1, MAX_REQUEST_ID)
+        # Client id -> request id -> (command, when sent), oldest first.
+        self._requests: Dict[int, Dict[int, Tuple[CommandType, float]]] = {}
+        self._lock = threading.Lock()
+
+    def new_id(self) -> int:
+        # An id for a request which isn't tracked (e.g. broadcasts).
+        with self._lock:
+            return self._allocate_id()
+
+    def start(self, client_id: int, command: CommandType) -> int:
+        # Returns the id for the request, which is tracked if answered.
+        with self._lock:
+            request_id = self._allocate_id()
+            if command not in ANSWERED_COMMANDS:
+                return request_id
+
+            requests = self._requests.setdefault(client_id, {})
+            requests[request_id] = (command, time.monotonic())
+            if len(requests) > self._max_in_flight:
+                del requests[next(iter(requests))]
+                get_metrics().counter('master.requests.forgotten').add()
+            return request_id
+
+    def end_received(self, client_id: int, request_id: int) -> bool:
+        """
+        Finishes the request answered by an end marker of the client. Returns whether
+        the request was in flight, if not the marker is a left-over.
+        Markers without request id (from older clients) are always taken.
+        """
+        if request_id == NO_REQUEST_ID:
+            return True
+        with self._lock:
+            request = self._requests.get(client_id, {}).pop(request_id, None)
+        if request is None:
+            return False
+
+        get_metrics().histogram('master.requests.answer_sec').record(time.monotonic() - request[1])
+        return True
+
+    def image_received(self, client_id: int):
+        # Finishes the oldest request for a single image of the client, if any.
+        with self._lock:
+            requests = self._requests.get(client_id, {})
+            for request_id, (command, sent_time) in requests.items():
+                if command == CommandType.SEND_NEXT_PICTURE:
+                    del requests[request_id]
+                    break
+
+    def pending(self, client_id: int) -> List[Tuple[int, CommandType]]:
+        # The requests in flight to the client, oldest first.
+        with self._lock:
+            return [(request_id, command) for request_id, (command, sent_time)
+                    in self._requests.get(client_id, {}).items()]
+
+    def forget(self, client_id: int):
+        # Once we are done with the client, whatever else it answers is a left-over.
+        with self._lock:
+            self._requests.pop(client_id, None)
+
+    def _allocate_id(self) -> int:
+        # Called with the lock held.
+        request_id = self._next_id
+        self._next_id = self._next_id + 1 if self._next_id < MAX_REQUEST_ID else 1
+        return request_id
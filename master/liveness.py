@@ -0,0 +1,88 @@
+"""
+Tracking of which clients are still there, by whether they answer us. Whenever we
+ask a client something (a request for images or a heartbeat ping) and it stays
+silent, it becomes suspect and then dead. Anything heard from it (a part of an
+image, an end marker, a reply) makes it alive again.
+Clients we didn't ask anything are taken as alive, so clients which were left
+alone for a while aren't taken as dead.
+"""
+from typing import Dict, Iterable, Optional
+
+import enum
+import threading
+import time
+
+from common.metrics import get_metrics
+
+# How long a client may leave us waiting before it is suspect, and before it is dead.
+DEFAULT_SUSPECT_AFTER_SEC = 1.0
+DEFAULT_DEAD_AFTER_SEC = 3.0
+
+
+class Liveness(enum.Enum):
+    ALIVE = 'alive'
+    # Slow to answer, but we still wait for it.
+    SUSPECT = 'suspect'
+    # We stopped waiting for it, until we hear from it again.
+    DEAD = 'dead'
+
+
+class LivenessTracker(object):
+    """
+    When each client was last heard from, and since when we have been waiting for it
+    to answer. May be used from several threads.
+    """
+
+    def __init__(self, suspect_after: float = DEFAULT_SUSPECT_AFTER_SEC, dead_after: float = DEFAULT_DEAD_AFTER_SEC):
+        self._suspect_after = suspect_after
+        self._dead_after = dead_after
+        # Client id -> when it was last heard from.
+        self._last_heard: Dict[int, float] = {}
+        # Client id -> when we first asked it something it didn't answer yet.
+        self._waiting_since: Dict[int, float] = {}
+        self._lock = threading.Lock()
+
+    def heard_from(self, client_id: int):
+        with self._lock:
+            self._last_heard[client_id] = time.monotonic()
+            self._waiting_since.pop(client_id, None)
+
+    def asked(self, client_id: int):
+        # We sent the client something it should answer. Only the first unanswered one counts.
+        with self._lock:
+            self._waiting_since.setdefault(client_id, time.monotonic())
+
+    def is_waiting(self, client_id: int) -> bool:
+        # Whether the client didn't answer yet what we last asked it.
+        with self._lock:
+            return client_id in self._waiting_since
+
+    def last_heard(self, client_id: int) -> Optional[float]:
+        # When we last heard from the client (by time.monotonic), if ever.
+        with self._lock:
+            return self._last_heard.get(client_id)
+
+    def state(self, client_id: int) -> Liveness:
+        with self._lock:
+            waiting_since = self._waiting_since.get(client_id)
+        if waiting_since is None:
+            return Liveness.ALIVE
+
+        waiting = time.monotonic() - waiting_since
+        if waiting >= self._dead_after:
+            return Liveness.DEAD
+        if waiting >= self._suspect_after:
+            return Liveness.SUSPECT
+        return Liveness.ALIVE
+
+    def states(self, client_ids: Iterable[int]) -> Dict[int, Liveness]:
+        return {client_id: self.state(client_id) for client_id in client_ids}
+
+    def record_states(self, client_ids: Iterable[int]) -> Dict[int, Liveness]:
+        # Like states, and sets the gauges of how many clients are in each state.
+        states = self.states(client_ids)
+        metrics = get_metrics()
+        for liveness in Liveness:
+            metrics.gauge('master.clients.' + liveness.value).set(
+                sum(1 for state in states.values() if state == liveness))
+        return states
@@ -1,46 +1,540 @@
-from typing import Optional
+from typing import Optional, List, Dict
 
-from common.command import CommandType
-from common.image import Image
+import socket
+import time
+
+from common.clock import ClockSample, best_sample
+from common.command import CommandType, TakePictureParams, ClockOffsetParams, StreamParams, CreditParams
+from common.image import Image, ReferenceImage
+from common.metrics import get_metrics
 from master.client import Connection, Client
+from master.liveness import Liveness, LivenessTracker
 from master.storage import Storage
 
+# Clock syncs done with each client, of which the best is used.
+DEFAULT_CLOCK_SYNC_ROUNDS = 8
+# How many frames each client may stream ahead of what we stored.
+DEFAULT_STREAM_CREDITS = 8
+# Frames are numbered from here, away from the ids of pictures we ask for.
+FIRST_FRAME_ID = 1 << 20
+# Times we tell clients to stop streaming before giving up on them.
+_MAX_STOP_RETRIES = 3
+# Times in a row we ask clients to resume transfers which were cut off before giving up on them.
+MAX_RESUMES = 3
+# Requests for the next image kept in flight to each client, when collecting concurrently.
+DEFAULT_PIPELINE_DEPTH = 1
+# How long to wait for clients to answer a heartbeat.
+DEFAULT_HEARTBEAT_WAIT = 0.2
+# Timeouts in a row after which we give up on clients, even if they answer heartbeats.
+MAX_STALLS = 5
+
+
+def synchronize_clocks(connection: Connection, clients: List[Client],
+                       rounds: int = DEFAULT_CLOCK_SYNC_ROUNDS) -> Dict[int, ClockSample]:
+    """
+    Estimates the offset of the clock of each client from ours, and tells the client.
+    Returns the sample each estimate is based on, by client id.
+    """
+    metrics = get_metrics()
+    estimates = {}
+    for client in clients:
+        samples = [connection.measure_clock(client) for _ in range(rounds)]
+        samples = [sample for sample in samples if sample is not None]
+        if len(samples) == 0:
+            print('No clock sync reply from client', client.id)
+            continue
+
+        sample = best_sample(samples)
+        client.send_command(CommandType.SET_CLOCK_OFFSET, ClockOffsetParams(sample.offset))
+        estimates[client.id] = sample
+        metrics.gauge('master.client.{}.clock_offset_sec'.format(client.id)).set(sample.offset)
+        # The estimate may be off by up to half the round trip.
+        metrics.gauge('master.client.{}.clock_error_sec'.format(client.id)).set(sample.delay / 2)
+
+    return estimates
+
+
+def capture_skew(capture_times: Dict[int, Dict[int, float]]) -> Dict[int, float]:
+    """
+    Given when each client took each picture (picture id -> client id -> time), returns
+    how far apart the first and the last client took each picture.
+    """
+    return {picture_id: max(times.values()) - min(times.values())
+            for picture_id, times in capture_times.items() if len(times) > 1}
+
+
+class CollectedImages(object):
+    """
+    What was collected from the clients: which pictures we asked to be taken and when,
+    when each client took each of them, and which images arrived in the current collection.
+    Used by Master and master.aio.AsyncMaster alike, which only differ in how images reach them.
+    """
+
+    def __init__(self):
+        # When we asked for each picture to be taken, and when each client took it.
+        self.capture_targets: Dict[int, float] = {}
+        self.capture_times: Dict[int, Dict[int, float]] = {}
+        # Pictures received in the current collection, and from which clients.
+        self.pictures = set()
+        self._images = set()
+
+    def start(self):
+        # A new collection.
+        self.pictures = set()
+        self._images = set()
+
+    def add(self, client_id: int, image: Image, transfer_time: float) -> bool:
+        """
+        Records an image received from a client, transfer_time seconds after we started
+        waiting for it. Returns False if we already have it, so it shouldn't be stored again.
+        """
+        metrics = get_metrics()
+        if (client_id, image.id) in self._images:
+            # Sent again while the acknowledgement was on its way (e.g. with several
+            # requests in flight), we already have it.
+            metrics.counter('master.duplicate_images').add()
+            return False
+        self._images.add((client_id, image.id))
+        metrics.trace('master.image_received', client_id=client_id, image_id=image.id, size=len(image))
+        metrics.histogram('master.transfer_sec').record(transfer_time)
+        metrics.histogram('master.client.{}.transfer_sec'.format(client_id)).record(transfer_time)
+        metrics.counter('master.images').add()
+        metrics.counter('master.bytes').add(len(image))
+        if isinstance(image, ReferenceImage):
+            metrics.counter('master.deduplicated_images').add()
+        self.pictures.add(image.id)
+        if image.timestamp > 0:
+            self.capture_times.setdefault(image.id, {})[client_id] = image.timestamp
+            capture_target = self.capture_targets.get(image.id, 0.0)
+            if capture_target > 0:
+                metrics.histogram('master.capture_lateness_sec').record(image.timestamp - capture_target)
+        return True
+
+    def record_skew(self):
+        # Once the collection is done, for the pictures taken by several of the clients.
+        skew_histogram = get_metrics().histogram('master.capture_skew_sec')
+        for picture_id, skew in capture_skew(self.capture_times).items():
+            if picture_id in self.pictures:
+                skew_histogram.record(skew)
+
 
 class Master(object):
 
-    def __init__(self, connection: Connection, storage: Storage):
+    def __init__(self, connection: Connection, storage: Storage, liveness: Optional[LivenessTracker] = None,
+                 heartbeat_wait: float = DEFAULT_HEARTBEAT_WAIT):
         self._connection = connection
         self._storage = storage
         self._clients = []
+        self._liveness = liveness if liveness is not None else LivenessTracker()
+        self._heartbeat_wait = heartbeat_wait
+        # Clients which stopped answering, left out of the current collection unless they answer
+        # again, and those of them already taken back.
+        self._deferred_clients: Dict[int, Client] = {}
+        self._readmitted_clients = set()
+        self._collected = CollectedImages()
+        self._next_frame_id = FIRST_FRAME_ID
+
+        # Clients offering images the storage already has don't need to send them.
+        self._connection.set_digest_lookup(self._storage.contains_digest)
+        self._connection.set_liveness(self._liveness)
+
+    @property
+    def clients(self) -> List[Client]:
+        return list(self._clients)
 
     def discover_clients(self):
+        # May be called again to find clients which joined later (or left).
+        started = time.perf_counter()
         self._clients = self._connection.do_discovery()
 
-    def take_picture(self):
-        self._connection.broadcast(CommandType.TAKE_PICTURE)
+        metrics = get_metrics()
+        metrics.histogram('master.discovery_sec').record(time.perf_counter() - started)
+        metrics.gauge('master.clients').set(len(self._clients))
+
+    def set_clients(self, clients: List[Client]):
+        # For clients discovered elsewhere (see master.sharded).
+        self._clients = list(clients)
 
-    def collect_pictures(self):
+    @property
+    def capture_times(self) -> Dict[int, Dict[int, float]]:
+        # Picture id -> client id -> when the client took the picture, by our clock.
+        return self._collected.capture_times
+
+    @property
+    def collected_pictures(self) -> set:
+        # Ids of the pictures received in the last collection.
+        return set(self._collected.pictures)
+
+    @property
+    def liveness(self) -> LivenessTracker:
+        return self._liveness
+
+    @property
+    def deferred_clients(self) -> List[int]:
+        # Ids of the clients left out of the last collection, as they stopped answering.
+        return sorted(self._deferred_clients.keys())
+
+    def check_clients(self) -> Dict[int, Liveness]:
+        """
+        Sends all the clients a heartbeat, and waits a little for them to answer.
+        Returns the state of each client by id.
+        """
+        self._connection.ping_clients(self._clients, self._heartbeat_wait)
+        return self._liveness.record_states(client.id for client in self._clients)
+
+    def synchronize_clocks(self, rounds: int = DEFAULT_CLOCK_SYNC_ROUNDS) -> Dict[int, ClockSample]:
+        return synchronize_clocks(self._connection, self._clients, rounds)
+
+    def take_picture(self, picture_id: int, delay: float = 0.0):
+        """
+        Has all the clients take a picture, delay seconds from now by our clock.
+        With clocks synchronized, the delay should cover the time the command takes
+        to reach all the clients, so they all take the picture at the same time.
+        """
+        capture_time = time.time() + delay if delay > 0 else 0.0
+        self._collected.capture_targets[picture_id] = capture_time
+        self._connection.broadcast(CommandType.TAKE_PICTURE, TakePictureParams(picture_id, capture_time))
+
+    def capture_skew(self) -> Dict[int, float]:
+        return capture_skew(self._collected.capture_times)
+
+    def collect_pictures(self, concurrent: bool = False, stream: bool = False,
+                         pipeline_depth: int = DEFAULT_PIPELINE_DEPTH):
+        """
+        Collects all the images stored by the clients.
+        With concurrent, all the clients are asked to send at once instead of one after the other,
+        with pipeline_depth requests for the next image in flight to each (so a client
+        doesn't wait for our request after sending each image).
+        With stream, each client is asked once to send all its images instead of asking for
+        each image separately.
+        Clients which don't answer (see master.liveness) don't hold up the others: they are
+        left for the end, and once dead for the next collection (their images wait for them).
+        """
+        self._collected.start()
+        self._deferred_clients = {}
+        self._readmitted_clients = set()
+
+        # Clients which were already not answering are only tried once the others are done.
+        # Those only slow to answer the heartbeat (e.g. still taking pictures) aren't left out.
+        states = self.check_clients()
+        clients = []
         for client in self._clients:
-            self._collect_pictures_from_client(client)
+            if states[client.id] in (Liveness.SUSPECT, Liveness.DEAD):
+                self._defer_client(client)
+            else:
+                clients.append(client)
 
-    def _collect_pictures_from_client(self, client: Client):
-        print('Results from client:', client)
+        if concurrent:
+            self._collect_pictures_concurrently(clients, stream, pipeline_depth)
+        else:
+            # The deferred clients are waited for even if all the clients were deferred.
+            while True:
+                for client in clients:
+                    self._collect_pictures_sequentially(client, stream)
+                clients = self._wait_for_deferred_clients()
+                if len(clients) == 0:
+                    break
+
+        if len(self._deferred_clients) > 0:
+            print('Clients left for the next collection:', self.deferred_clients)
+        self._liveness.record_states(client.id for client in self._clients)
+        # The storage may still be writing in the background.
+        self._storage.flush()
+        self._collected.record_skew()
+
+    def stream_pictures(self, fps: float, duration: float, credits: int = DEFAULT_STREAM_CREDITS):
+        """
+        Has all the clients take pictures at fps frames per second for duration seconds,
+        each sending its pictures as they are taken.
+        Clients may only send up to credits frames more than we stored, and get more
+        credit as their frames are stored. So if we (or the storage) fall behind,
+        clients take fewer frames instead of piling them up.
+        """
+        if StreamParams(fps).frame_interval is None:
+            raise ValueError('Cannot stream at {} frames per second'.format(fps))
+
+        first_id = self._next_frame_id
+        streaming = {client.id: client for client in self._clients}
+        # The id of the first frame each client may not send yet.
+        limits = {}
+        for client in streaming.values():
+            limits[client.id] = first_id + credits
+            client.send_command(CommandType.START_STREAM, StreamParams(fps, first_id, limits[client.id]))
+
+        metrics = get_metrics()
+        stop_time = time.monotonic() + duration
+        stop_retries = None
+        wait_started = {client_id: time.perf_counter() for client_id in streaming}
+        while len(streaming) > 0:
+            if stop_retries is None and time.monotonic() >= stop_time:
+                stop_retries = 0
+                for client in streaming.values():
+                    client.send_command(CommandType.STOP_STREAM)
+
+            try:
+                client_id, image = self._connection.receive_image()
+            except socket.timeout:
+                if stop_retries is None:
+                    # Maybe credit was lost, so clients are waiting for it.
+                    for client in streaming.values():
+                        client.send_command(CommandType.CREDIT, CreditParams(limits[client.id]))
+                    continue
+
+                stop_retries += 1
+                if stop_retries > _MAX_STOP_RETRIES:
+                    print('Timed out waiting for clients to stop streaming:', list(streaming.keys()))
+                    break
+                for client in streaming.values():
+                    client.send_command(CommandType.STOP_STREAM)
+                continue
+
+            client = streaming.get(client_id)
+            if client is None:
+                continue
+
+            if image is None:
+                print('Client', client_id, 'stopped streaming')
+                del streaming[client_id]
+                continue
+
+            started = wait_started[client_id]
+            wait_started[client_id] = time.perf_counter()
+            self._handle_image(client, image, started)
+            if image.timestamp > 0:
+                # From when it was taken until it was stored.
+                metrics.histogram('master.stream.latency_sec').record(time.time() - image.timestamp)
+
+            # The frame is stored, so the client may send another one.
+            limit = image.id + 1 + credits
+            if limit > limits[client_id]:
+                limits[client_id] = limit
+                client.send_command(CommandType.CREDIT, CreditParams(limit))
+
+        # No client could have sent frames from the highest limit on.
+        self._next_frame_id = max(limits.values(), default=first_id)
+        for client in self._clients:
+            client.forget_requests()
+        self._storage.flush()
+
+    def _collect_pictures_concurrently(self, clients: List[Client], stream: bool, pipeline_depth: int):
+        # Request images from all the clients at once, and handle the images
+        # by the order they are completed. If not streaming, each time a client
+        # finishes sending an image, we request the next one from it.
+        pending_clients = {}
+        # When we started waiting for the next image of each client.
+        wait_started = {}
+        request = CommandType.SEND_ALL_PICTURES if stream else CommandType.SEND_NEXT_PICTURE
+        requests = 1 if stream else max(1, pipeline_depth)
+        # Clients which sent all their images, but some of them are missing parts.
+        finishing = set()
+
+        def start_client(client: Client):
+            pending_clients[client.id] = client
+            finishing.discard(client.id)
+            for _ in range(requests):
+                client.send_command(request)
+            wait_started[client.id] = time.perf_counter()
+
+        for client in clients:
+            start_client(client)
+
+        timeouts = 0
         while True:
-            image = self._collect_one_picture(client)
+            if len(pending_clients) == 0:
+                readmitted = self._wait_for_deferred_clients()
+                if len(readmitted) == 0:
+                    break
+                for client in readmitted:
+                    start_client(client)
+
+            try:
+                client_id, image = self._connection.receive_image()
+            except socket.timeout:
+                timeouts += 1
+                if timeouts <= MAX_RESUMES and self._resume_transfers(pending_clients.values()):
+                    continue
+                if timeouts > MAX_STALLS:
+                    print('Timed out waiting for clients:', list(pending_clients.keys()))
+                    for client in pending_clients.values():
+                        self._defer_client(client)
+                    pending_clients.clear()
+                    continue
+
+                # Nothing to resume, so we find out which of the clients are still there.
+                for client in self._readmit_clients(list(pending_clients.values())):
+                    start_client(client)
+                for client in list(pending_clients.values()):
+                    if self._liveness.state(client.id) == Liveness.DEAD:
+                        self._defer_client(client)
+                        del pending_clients[client.id]
+                    elif not self._liveness.is_waiting(client.id):
+                        # It answered, so our request (or its answer) was lost.
+                        client.send_command(request)
+                continue
+
+            client = pending_clients.get(client_id)
+            if client is None:
+                # Not a client we are waiting for, might be some left-over.
+                continue
+
             if image is None:
-                break
+                if client.resume_transfers():
+                    finishing.add(client_id)
+                    continue
+                print('No more images from client', client_id)
+                # The end markers answering the other requests in flight are left-overs.
+                client.forget_requests()
+                del pending_clients[client_id]
+                continue
+
+            timeouts = 0
+            started = wait_started[client_id]
+            wait_started[client_id] = time.perf_counter()
+            # The acknowledgement goes first, so the client doesn't send the image again
+            # when asked for the next one.
+            client.acknowledge_image(image)
+            if not stream:
+                client.send_command(CommandType.SEND_NEXT_PICTURE)
+            self._handle_image(client, image, started)
+            if client_id in finishing and not client.has_partial_images():
+                print('No more images from client', client_id)
+                client.forget_requests()
+                del pending_clients[client_id]
 
-            # Save the image so we can review later
-            self._storage.store_image(client, image)
+    def _collect_pictures_sequentially(self, client: Client, stream: bool):
+        try:
+            if stream:
+                self._stream_pictures_from_client(client)
+            else:
+                self._collect_pictures_from_client(client)
+        except socket.timeout:
+            self._defer_client(client)
+
+    def _defer_client(self, client: Client):
+        # Leaves the client out of this collection, unless it answers again.
+        print('Client', client.id, 'is not answering, leaving it for later')
+        client.forget_requests()
+        self._deferred_clients[client.id] = client
+        get_metrics().counter('master.deferred_clients').add()
+
+    def _readmit_clients(self, pinged: List[Client] = ()) -> List[Client]:
+        """
+        Sends a heartbeat to the deferred clients (and to the pinged ones), and returns
+        the deferred clients which answered, taking them back. Each client is taken back
+        once in a collection, so one which keeps stalling doesn't hold us up forever.
+        """
+        deferred = [client for client_id, client in self._deferred_clients.items()
+                    if client_id not in self._readmitted_clients]
+        if len(deferred) + len(pinged) == 0:
+            return []
+
+        self._connection.ping_clients(deferred + list(pinged), self._heartbeat_wait)
+        readmitted = [client for client in deferred if not self._liveness.is_waiting(client.id)]
+        for client in readmitted:
+            print('Client', client.id, 'is answering again')
+            del self._deferred_clients[client.id]
+            self._readmitted_clients.add(client.id)
+            get_metrics().counter('master.readmitted_clients').add()
+        return readmitted
+
+    def _wait_for_deferred_clients(self) -> List[Client]:
+        # Once the others are done, the deferred clients which may only be slow are
+        # waited for, until they answer or are taken as dead.
+        while True:
+            readmitted = self._readmit_clients()
+            if len(readmitted) > 0:
+                return readmitted
+            if all(client_id in self._readmitted_clients or self._liveness.state(client_id) == Liveness.DEAD
+                   for client_id in self._deferred_clients):
+                return []
+
+    def _collect_pictures_from_client(self, client: Client):
+        print('Results from client:', client.id)
+        try:
+            while True:
+                started = time.perf_counter()
+                image = self._collect_one_picture(client)
+                if image is None:
+                    break
+
+                client.acknowledge_image(image)
+                self._handle_image(client, image, started)
+        finally:
+            client.forget_requests()
+
+    def _stream_pictures_from_client(self, client: Client):
+        print('Streaming results from client:', client.id)
+        # Request all the images at once, and read them until the client
+        # tells us there are no more.
+        client.send_command(CommandType.SEND_ALL_PICTURES)
+        finishing = False
+        try:
+            while True:
+                started = time.perf_counter()
+                image = self._receive_image(client, CommandType.SEND_ALL_PICTURES)
+                if image is None:
+                    if client.resume_transfers():
+                        # Some of the images sent are missing parts, so we wait for those.
+                        finishing = True
+                        continue
+                    print('No more images from client')
+                    break
+
+                client.acknowledge_image(image)
+                self._handle_image(client, image, started)
+                if finishing and not client.has_partial_images():
+                    break
+        finally:
+            client.forget_requests()
 
     def _collect_one_picture(self, client: Client) -> Optional[Image]:
         # Request the next image from the user.
         client.send_command(CommandType.SEND_NEXT_PICTURE)
         # Read the data from the client
-        image = client.receive_image()
+        image = self._receive_image(client, CommandType.SEND_NEXT_PICTURE)
         if image is None:
             print('No more images from client')
             return None
 
-        print('New result:', client.id, image.id)
         return image
+
+    def _receive_image(self, client: Client, request: CommandType) -> Optional[Image]:
+        # If the transfer of an image is cut off, we ask the client to resume it (a few times).
+        # Otherwise we send it a heartbeat: if it answers, our request (or its answer) was lost,
+        # so we ask again. Raises socket.timeout once the client stopped answering.
+        timeouts = 0
+        while True:
+            try:
+                return client.receive_image()
+            except socket.timeout:
+                timeouts += 1
+                if timeouts <= MAX_RESUMES and self._resume_transfers([client]):
+                    continue
+                if timeouts > MAX_STALLS:
+                    raise
+
+                self._connection.ping_clients([client], self._heartbeat_wait)
+                if self._liveness.state(client.id) == Liveness.DEAD:
+                    raise
+                if not self._liveness.is_waiting(client.id):
+                    client.send_command(request)
+
+    def _resume_transfers(self, clients) -> bool:
+        # Returns whether any of the clients has transfers to resume. Images lost whole
+        # were not acknowledged, so the clients send them again in the next collection.
+        resumed = False
+        for client in clients:
+            if client.resume_transfers():
+                print('Resuming transfers of client', client.id)
+                resumed = True
+        return resumed
+
+    def _handle_image(self, client: Client, image: Image, started: float):
+        # started is when we started waiting for the image.
+        received = time.perf_counter()
+        if not self._collected.add(client.id, image, received - started):
+            return
+
+        # Save the image so we can review later
+        self._storage.store_image(client, image)
+        get_metrics().histogram('master.storage.store_sec').record(time.perf_counter() - received)
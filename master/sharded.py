@@ -0,0 +1,183 @@
+"""
+A master which spreads the collection of images over several processes.
+
+The coordinating ShardedMaster discovers the clients and broadcasts commands as usual,
+and splits the clients between the shards. Each shard is a process with its own
+connection (on its own port) and its own storage, which collects the images of its
+clients. Clients are told to send their images to the port of their shard.
+"""
+from multiprocessing.connection import Connection as Pipe
+from typing import Callable, Dict, List, Optional
+
+import multiprocessing
+import time
+
+from common.clock import ClockSample
+from common.command import CommandType, CommandParams, TakePictureParams
+from common.metrics import Metrics, get_metrics, set_metrics
+from master.client import Connection, Client
+from master.master import Master, DEFAULT_CLOCK_SYNC_ROUNDS, DEFAULT_PIPELINE_DEPTH, synchronize_clocks, capture_skew
+from master.storage import Storage
+
+# Messages from the coordinator to the shards.
+_CLIENTS_MESSAGE = 'clients'
+_COLLECT_MESSAGE = 'collect'
+_CLOSE_MESSAGE = 'close'
+
+
+def _run_shard(index: int, port: int, connection_factory: Callable[[int], Connection],
+               storage_factory: Callable[[int], Storage], pipe: Pipe):
+    with storage_factory(index) as storage, connection_factory(port) as connection:
+        master = Master(connection, storage)
+        while True:
+            message = pipe.recv()
+            kind = message[0]
+            if kind == _CLIENTS_MESSAGE:
+                master.set_clients([connection.create_client(id, address) for id, address in message[1]])
+            elif kind == _COLLECT_MESSAGE:
+                concurrent, stream, pipeline_depth = message[1:]
+                # Each collection is reported to new metrics, which are sent back with the results.
+                metrics = Metrics()
+                set_metrics(metrics)
+                started = time.perf_counter()
+                error = None
+                try:
+                    master.collect_pictures(concurrent=concurrent, stream=stream, pipeline_depth=pipeline_depth)
+                except Exception as e:
+                    error = repr(e)
+
+                snapshot = metrics.snapshot()
+                pipe.send({
+                    'shard': index,
+                    'port': port,
+                    'clients': len(master.clients),
+                    'collect_sec': time.perf_counter() - started,
+                    'images': snapshot.get('master.images', 0),
+                    'bytes': snapshot.get('master.bytes', 0),
+                    'error': error,
+                    'capture_times': {picture_id: master.capture_times.get(picture_id, {})
+                                      for picture_id in master.collected_pictures},
+                    'metrics': snapshot,
+                })
+            elif kind == _CLOSE_MESSAGE:
+                break
+
+
+class ShardedMaster(object):
+    """
+    Collects images with a pool of shard processes.
+    connection_factory creates the connection of a shard given its port, and
+    storage_factory creates the storage of a shard given its index. Both are
+    called in the shard processes, so must be picklable (e.g. functools.partial
+    of a class or a static method).
+    Shards use the ports starting at shard_base_port.
+    """
+
+    def __init__(self, connection: Connection, connection_factory: Callable[[int], Connection],
+                 storage_factory: Callable[[int], Storage], shard_count: int, shard_base_port: int):
+        self._connection = connection
+        self._clients: List[Client] = []
+        # Picture id -> client id -> when the client took the picture, from all the shards.
+        self._capture_times: Dict[int, Dict[int, float]] = {}
+        self._shard_ports = [shard_base_port + i for i in range(shard_count)]
+        self._pipes = []
+        self._processes = []
+        for index, port in enumerate(self._shard_ports):
+            pipe, shard_pipe = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_run_shard,
+                                              args=(index, port, connection_factory, storage_factory, shard_pipe),
+                                              name='master-shard-{}'.format(index), daemon=True)
+            process.start()
+            self._pipes.append(pipe)
+            self._processes.append(process)
+
+    @property
+    def clients(self) -> List[Client]:
+        return list(self._clients)
+
+    def discover_clients(self):
+        started = time.perf_counter()
+        self._clients = self._connection.do_discovery()
+
+        # Spread the clients between the shards, and tell each where to send its images.
+        metrics = get_metrics()
+        shard_clients = [[] for _ in self._shard_ports]
+        for i, client in enumerate(self._clients):
+            shard = i % len(self._shard_ports)
+            shard_clients[shard].append((client.id, client.address))
+            if not self._connection.assign_shard(client, self._shard_ports[shard]):
+                # It may still have got it, or be an older client which doesn't confirm.
+                print('Client', client.id, 'did not confirm its shard')
+                metrics.counter('master.shard.unconfirmed_clients').add()
+
+        for pipe, clients in zip(self._pipes, shard_clients):
+            pipe.send((_CLIENTS_MESSAGE, clients))
+
+        metrics.histogram('master.discovery_sec').record(time.perf_counter() - started)
+        metrics.gauge('master.clients').set(len(self._clients))
+
+    def broadcast(self, command: CommandType, params: Optional[CommandParams] = None) -> int:
+        return self._connection.broadcast(command, params)
+
+    @property
+    def capture_times(self) -> Dict[int, Dict[int, float]]:
+        return self._capture_times
+
+    def synchronize_clocks(self, rounds: int = DEFAULT_CLOCK_SYNC_ROUNDS) -> Dict[int, ClockSample]:
+        # Clock syncs go over our connection, like discovery.
+        return synchronize_clocks(self._connection, self._clients, rounds)
+
+    def take_picture(self, picture_id: int, delay: float = 0.0):
+        # See Master.take_picture.
+        capture_time = time.time() + delay if delay > 0 else 0.0
+        self.broadcast(CommandType.TAKE_PICTURE, TakePictureParams(picture_id, capture_time))
+
+    def capture_skew(self) -> Dict[int, float]:
+        return capture_skew(self._capture_times)
+
+    def collect_pictures(self, concurrent: bool = False, stream: bool = False,
+                         pipeline_depth: int = DEFAULT_PIPELINE_DEPTH) -> List[Dict]:
+        """
+        Has all the shards collect the images of their clients at once.
+        Returns the results of each shard: its clients, images, bytes, time, error
+        (if any), capture times and metrics.
+        """
+        for pipe in self._pipes:
+            pipe.send((_COLLECT_MESSAGE, concurrent, stream, pipeline_depth))
+
+        results = [pipe.recv() for pipe in self._pipes]
+
+        metrics = get_metrics()
+        collected_pictures = set()
+        for result in results:
+            if result['error'] is not None:
+                print('Shard', result['shard'], 'failed:', result['error'])
+            metrics.counter('master.images').add(result['images'])
+            metrics.counter('master.bytes').add(result['bytes'])
+            metrics.gauge('master.shard.{}.images'.format(result['shard'])).set(result['images'])
+            metrics.gauge('master.shard.{}.collect_sec'.format(result['shard'])).set(result['collect_sec'])
+            for picture_id, times in result['capture_times'].items():
+                self._capture_times.setdefault(picture_id, {}).update(times)
+                collected_pictures.add(picture_id)
+
+        skew_histogram = metrics.histogram('master.capture_skew_sec')
+        for picture_id, skew in self.capture_skew().items():
+            if picture_id in collected_pictures:
+                skew_histogram.record(skew)
+
+        return results
+
+    def close(self):
+        for pipe in self._pipes:
+            pipe.send((_CLOSE_MESSAGE,))
+        for process in self._processes:
+            process.join()
+        self._pipes = []
+        self._processes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return self
@@ -1,8 +1,16 @@
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Optional, Callable
 
+import os
+import threading
+import time
+
+from common.pack import PackFile, DEFAULT_MAX_SEGMENT_SIZE
 from common.times import create_datetime_path
-from common.image import Image
+from common.image import Image, ReferenceImage, compute_digest
+from common.metrics import get_metrics
 from master.client import Client
 
 
@@ -12,10 +20,51 @@ class Storage(ABC):
     def store_image(self, client: Client, image: Image):
         pass
 
+    def store_image_then(self, client: Client, image: Image, on_stored: Callable[[], None]):
+        """
+        Stores the image, and calls on_stored once it is written. Storages writing
+        in the background call it from the thread writing the image.
+        """
+        self.store_image(client, image)
+        on_stored()
+
+    def flush(self):
+        """
+        Waits until all the images stored so far are written.
+        """
+        pass
+
+    def location_of(self, client: Client, image: Image) -> Optional[str]:
+        """
+        Where the image of the client is (or will be) stored, if the storage can tell.
+        """
+        return None
+
+    def contains_digest(self, digest: bytes) -> bool:
+        """
+        Whether an image with this digest was stored. If so, the storage
+        accepts a ReferenceImage with the digest instead of the image.
+        """
+        return False
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return self
+
 
 class BasicFileSystemStorage(Storage):
 
-    def __init__(self, parent_path: Path, use_datetime: bool = False):
+    def __init__(self, parent_path: Path, use_datetime: bool = False, fsync_batch_size: int = 0):
+        """
+        If fsync_batch_size is more than 0, written images are synced to the disk
+        every time that many images were written, and on flush.
+        """
         if use_datetime:
             self._parent = create_datetime_path(parent_path)
         else:
@@ -24,11 +73,232 @@ class BasicFileSystemStorage(Storage):
         if not self._parent.exists():
             self._parent.mkdir(parents=True)
 
+        # Directories we already created, so we don't ask the file system each time.
+        self._created_dirs = set()
+        self._fsync_batch_size = fsync_batch_size
+        self._unsynced_paths = []
+        # Images may be stored from several threads.
+        self._lock = threading.Lock()
+
     def store_image(self, client: Client, image: Image):
         client_dir = self._parent / str(client.id)
-        if not client_dir.exists():
-            client_dir.mkdir()
+        if client.id not in self._created_dirs:
+            client_dir.mkdir(exist_ok=True)
+            with self._lock:
+                self._created_dirs.add(client.id)
 
-        image_path = client_dir / ('{}.{}'.format(str(image.id), image.extension))
+        image_path = self._image_path(client, image)
         with image_path.open(mode='wb') as f:
             f.write(image.data)
+
+        if self._fsync_batch_size > 0:
+            with self._lock:
+                self._unsynced_paths.append(image_path)
+                if len(self._unsynced_paths) < self._fsync_batch_size:
+                    return
+                paths = self._unsynced_paths
+                self._unsynced_paths = []
+
+            self._sync(paths)
+
+    def flush(self):
+        with self._lock:
+            paths = self._unsynced_paths
+            self._unsynced_paths = []
+
+        self._sync(paths)
+
+    def location_of(self, client: Client, image: Image) -> Optional[str]:
+        return str(self._image_path(client, image))
+
+    def _image_path(self, client: Client, image: Image) -> Path:
+        return self._parent / str(client.id) / '{}.{}'.format(str(image.id), image.extension)
+
+    def _sync(self, paths):
+        for path in paths:
+            fd = os.open(str(path), os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+
+class ContentAddressedStorage(Storage):
+    """
+    Stores the data of each image once by its digest, under objects/. Each image of a
+    client is a hard link to the data, in the same layout as BasicFileSystemStorage.
+    The objects are kept outside of the datetime directory, so they are shared by runs.
+    """
+
+    def __init__(self, parent_path: Path, use_datetime: bool = False):
+        self._objects = parent_path / 'objects'
+        if use_datetime:
+            self._parent = create_datetime_path(parent_path)
+        else:
+            self._parent = parent_path
+
+        self._objects.mkdir(parents=True, exist_ok=True)
+        self._parent.mkdir(parents=True, exist_ok=True)
+
+        # Load the digests we have once, instead of asking the file system for each.
+        self._digests = {bytes.fromhex(path.name) for path in self._objects.glob('*/*')
+                         if not path.name.endswith('.tmp')}
+        self._created_dirs = set()
+        self._lock = threading.Lock()
+
+    def contains_digest(self, digest: bytes) -> bool:
+        with self._lock:
+            return digest in self._digests
+
+    def store_image(self, client: Client, image: Image):
+        digest = compute_digest(image)
+        object_path = self._object_path(digest)
+        if not self.contains_digest(digest):
+            if isinstance(image, ReferenceImage):
+                raise ValueError('no image with digest ' + digest.hex())
+
+            # Write to a temporary file first, so an object is never partially written.
+            object_path.parent.mkdir(exist_ok=True)
+            temp_path = object_path.with_name(object_path.name + '.{}.tmp'.format(threading.get_ident()))
+            with temp_path.open(mode='wb') as f:
+                f.write(image.data)
+            os.replace(str(temp_path), str(object_path))
+
+            # Only known once written, so references are made only to complete objects.
+            with self._lock:
+                self._digests.add(digest)
+
+        client_dir = self._parent / str(client.id)
+        if client.id not in self._created_dirs:
+            client_dir.mkdir(exist_ok=True)
+            with self._lock:
+                self._created_dirs.add(client.id)
+
+        image_path = self._image_path(client, image)
+        if image_path.exists():
+            image_path.unlink()
+        os.link(str(object_path), str(image_path))
+
+    def location_of(self, client: Client, image: Image) -> Optional[str]:
+        return str(self._image_path(client, image))
+
+    def _image_path(self, client: Client, image: Image) -> Path:
+        return self._parent / str(client.id) / '{}.{}'.format(str(image.id), image.extension)
+
+    def _object_path(self, digest: bytes) -> Path:
+        digest_hex = digest.hex()
+        return self._objects / digest_hex[:2] / digest_hex
+
+
+class PackFileStorage(Storage):
+    """
+    Stores the images of all the clients appended to a few large segment files.
+    See PackFile.
+    """
+
+    def __init__(self, parent_path: Path, use_datetime: bool = False,
+                 max_segment_size: int = DEFAULT_MAX_SEGMENT_SIZE):
+        if use_datetime:
+            parent_path = create_datetime_path(parent_path)
+
+        self._pack = PackFile(parent_path, max_segment_size)
+
+    @property
+    def pack(self) -> PackFile:
+        return self._pack
+
+    def store_image(self, client: Client, image: Image):
+        self._pack.append(client.id, image.id, image.data, image.timestamp)
+
+    def location_of(self, client: Client, image: Image) -> Optional[str]:
+        # Known once the image was appended.
+        return self._pack.location_of(client.id, image.id)
+
+    def flush(self):
+        self._pack.flush()
+
+    def close(self):
+        self._pack.close()
+
+
+class WriteBehindStorage(Storage):
+    """
+    Stores images in the background on a pool of threads, using another storage.
+    store_image returns right away, unless the images waiting to be written
+    are more than max_pending_bytes. In that case it waits for some to be written.
+    """
+
+    def __init__(self, storage: Storage, workers: int = 4, max_pending_bytes: int = 256 * 1024 * 1024):
+        self._storage = storage
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='storage')
+        self._max_pending_bytes = max_pending_bytes
+
+        self._condition = threading.Condition()
+        self._pending_bytes = 0
+        self._pending_count = 0
+        self._error = None
+
+    @property
+    def pending_bytes(self) -> int:
+        with self._condition:
+            return self._pending_bytes
+
+    def contains_digest(self, digest: bytes) -> bool:
+        return self._storage.contains_digest(digest)
+
+    def location_of(self, client: Client, image: Image) -> Optional[str]:
+        return self._storage.location_of(client, image)
+
+    def store_image(self, client: Client, image: Image):
+        self.store_image_then(client, image, None)
+
+    def store_image_then(self, client: Client, image: Image, on_stored: Optional[Callable[[], None]]):
+        size = len(image)
+        with self._condition:
+            # Wait for room, but always let a single image through, even if it is
+            # bigger than the limit.
+            while self._pending_count > 0 and self._pending_bytes + size > self._max_pending_bytes:
+                self._condition.wait()
+
+            self._pending_bytes += size
+            self._pending_count += 1
+            get_metrics().gauge('master.storage.pending_bytes').set(self._pending_bytes)
+
+        self._executor.submit(self._store, client, image, size, on_stored)
+
+    def flush(self):
+        with self._condition:
+            while self._pending_count > 0:
+                self._condition.wait()
+
+            error = self._error
+            self._error = None
+
+        self._storage.flush()
+        if error is not None:
+            raise error
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._executor.shutdown()
+            self._storage.close()
+
+    def _store(self, client: Client, image: Image, size: int, on_stored: Optional[Callable[[], None]]):
+        started = time.perf_counter()
+        try:
+            self._storage.store_image(client, image)
+            get_metrics().histogram('master.storage.write_sec').record(time.perf_counter() - started)
+            if on_stored is not None:
+                on_stored()
+        except Exception as e:
+            print('Failed storing image', client.id, image.id, e)
+            with self._condition:
+                if self._error is None:
+                    self._error = e
+        finally:
+            with self._condition:
+                self._pending_bytes -= size
+                self._pending_count -= 1
+                self._condition.notify_all()
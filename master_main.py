@@ -1,11 +1,17 @@
 from pathlib import Path
+from typing import Optional
 
+import functools
 import time
 
-from common.command import CommandType, TakePictureParams
-from master.client import UdpConnection
+from common.compression import Codec, CompressionSettings
+from common.metrics import Metrics, PrintExporter, set_metrics, print_tracer
+from master.catalogue import Catalogue, CataloguedStorage
+from master.client import UdpConnection, TcpConnection
+from master.discovery import WorkerRegistry
 from master.master import Master
-from master.storage import BasicFileSystemStorage
+from master.sharded import ShardedMaster
+from master.storage import BasicFileSystemStorage, WriteBehindStorage
 
 from settings import *
 
@@ -14,31 +20,90 @@ RUN_EXPERIMENT_TIMES = 2  # 5 = 50 seconds, 5 images
 
 SERVER_TIMEOUT = 1  # seconds
 STORAGE_PARENT = Path('results')
+# Keeps the ids of the clients between runs.
+WORKER_REGISTRY_PATH = Path('workers.json')
+STORAGE_WRITERS = 4
+STORAGE_MAX_PENDING_BYTES = 256 * 1024 * 1024
+# How clients should compress images, if they can.
+COMPRESSION = CompressionSettings(Codec.NONE)
+# Pictures are taken this long after they are asked for, so all the clients take them
+# at the same time. Should cover the time the command takes to reach all the clients.
+CAPTURE_DELAY_SEC = 0.05
+# If not 0, instead of taking pictures and collecting them at the end, clients stream
+# pictures at this frame rate (not supported with shards).
+STREAM_FPS = 0
+STREAM_DURATION_SEC = 60
+# If not 0, images are collected by this many processes, on the ports following SERVER_PORT.
+MASTER_SHARDS = 0
+# The size of the receive buffer of the sockets images arrive on. The kernel may cap it
+# (net.core.rmem_max on Linux), in which case that limit should be raised.
+RECEIVE_BUFFER_SIZE = 4 * 1024 * 1024
+# Indexes the images collected in all the runs, see master.catalogue.
+CATALOGUE_PATH = STORAGE_PARENT / 'catalogue.sqlite'
+
+
+def create_storage(shard: int = 0, run: Optional[str] = None) -> CataloguedStorage:
+    storage = WriteBehindStorage(BasicFileSystemStorage(STORAGE_PARENT, use_datetime=True),
+                                 STORAGE_WRITERS, STORAGE_MAX_PENDING_BYTES)
+    # All the shards record their images under the same run.
+    return CataloguedStorage(storage, Catalogue(CATALOGUE_PATH), run)
 
 
 def main():
-    storage = BasicFileSystemStorage(STORAGE_PARENT, use_datetime=True)
-    with UdpConnection.create(SERVER_PORT, CLIENT_PORT, timeout=SERVER_TIMEOUT) as connection:
-        master = Master(connection, storage)
+    metrics = Metrics(exporters=[PrintExporter()], tracers=[print_tracer])
+    set_metrics(metrics)
+
+    connection_class = TcpConnection if TCP_TRANSFER else UdpConnection
+    create_connection = functools.partial(connection_class.create, clients_port=CLIENT_PORT,
+                                          timeout=SERVER_TIMEOUT, compression=COMPRESSION,
+                                          receive_buffer_size=RECEIVE_BUFFER_SIZE)
+    with create_storage() as storage, \
+            create_connection(SERVER_PORT, registry=WorkerRegistry(WORKER_REGISTRY_PATH)) as connection:
+        if MASTER_SHARDS > 0:
+            master = ShardedMaster(connection, create_connection,
+                                   functools.partial(create_storage, run=storage.run), MASTER_SHARDS,
+                                   SERVER_PORT + 1)
+        else:
+            master = Master(connection, storage)
 
         # Let's familiarize ourselves with all the clients:
         print('Registering clients')
         master.discover_clients()
+        # So that clients take pictures at the time we ask for.
+        master.synchronize_clocks()
+
+        if STREAM_FPS > 0 and MASTER_SHARDS == 0:
+            # Clients send the pictures as they take them.
+            print('Streaming')
+            master.stream_pictures(STREAM_FPS, STREAM_DURATION_SEC)
+        else:
+            # Run several times (how many times we want to take pictures).
+            for i in range(RUN_EXPERIMENT_TIMES):
+                print('Taking picture', i)
+                # Notify all clients to take a picture.
+                # The id we will use to identify the image is from i
+                master.take_picture(i, CAPTURE_DELAY_SEC)
+                # Wait until next time to take a picture
+                time.sleep(WAIT_BETWEEN_PICS_SEC)
+
+            # Collect results:
+            print('Collecting results')
+            master.collect_pictures()
+
+        if MASTER_SHARDS > 0:
+            master.close()
 
-        # Run several times (how many times we want to take pictures).
-        for i in range(RUN_EXPERIMENT_TIMES):
-            print('Taking picture', i)
-            # Notify all clients to take a picture.
-            # The id we will use to identify the image is from i
-            connection.broadcast(CommandType.TAKE_PICTURE, TakePictureParams(i))
-            # Wait until next time to take a picture
-            time.sleep(WAIT_BETWEEN_PICS_SEC)
+        for picture_id, skew in sorted(master.capture_skew().items()):
+            print('Picture', picture_id, 'skew between clients:', skew)
 
-        # Collect results:
-        print('Collecting results')
-        master.collect_pictures()
+        storage.flush()
+        with Catalogue(CATALOGUE_PATH) as catalogue:
+            summary = catalogue.summarize_run(storage.run)
+        print('Run', summary.run, 'collected', summary.image_count, 'images,', summary.total_bytes, 'bytes,',
+              'from', summary.client_count, 'clients')
 
         print('Done')
+        metrics.export()
 
 
 if __name__ == '__main__':
@@ -1,3 +1,7 @@
 
 CLIENT_PORT = 10000
 SERVER_PORT = 10001
+# Whether clients wait for the server to acknowledge image parts and resend lost ones.
+RELIABLE_TRANSFER = False
+# Whether clients send images over TCP connections instead of UDP (commands are always UDP).
+TCP_TRANSFER = False
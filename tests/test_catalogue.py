@@ -0,0 +1,65 @@
+from pathlib import Path
+
+from unittest import mock
+
+import tempfile
+import threading
+import unittest
+
+from common.image import Image, compute_digest
+from master import catalogue
+from master.catalogue import Catalogue, CataloguedStorage
+from master.client import Client
+from master.storage import Storage, WriteBehindStorage
+
+
+class _Client(Client):
+
+    def send_command(self, command, params=None):
+        pass
+
+    def receive_image(self):
+        return None
+
+
+class _NullStorage(Storage):
+
+    def store_image(self, client: Client, image: Image):
+        pass
+
+
+class CataloguedStorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self._path = Path(self._temp_dir.name) / 'catalogue.sqlite'
+
+    def tearDown(self):
+        self._temp_dir.cleanup()
+
+    def test_digests_are_computed_by_the_writers(self):
+        digest_threads = []
+
+        def record_thread(image):
+            digest_threads.append(threading.current_thread())
+            return compute_digest(image)
+
+        image = Image(3, b'data')
+        storage = CataloguedStorage(WriteBehindStorage(_NullStorage()), Catalogue(self._path), 'run')
+        try:
+            with mock.patch.object(catalogue, 'compute_digest', record_thread):
+                storage.store_image(_Client(17), image)
+                storage.flush()
+        finally:
+            storage.close()
+
+        with Catalogue(self._path) as database:
+            entries = database.images('run')
+
+        self.assertEqual([(entry.client_id, entry.image_id, entry.digest) for entry in entries],
+                         [(17, 3, compute_digest(image))])
+        self.assertNotIn(threading.current_thread(), digest_threads)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,253 @@
+from pathlib import Path
+
+import asyncio
+import socket
+import tempfile
+import time
+import unittest
+
+from client.aio import AsyncConnection, AsyncClient
+from client.camera import Camera
+from client.client import Client, FrameSchedule
+from client.connection import UdpConnection
+from client.storage import BasicFileSystemStorage
+from common.command import CommandType, AssignShardParams, StreamParams, CreditParams, SyncClockParams, pack_command
+from common.data import SHARD_RESPONSE, SHARD_PORT, CLOCK_RESPONSE
+from common.image import Image
+from common.metrics import Metrics, get_metrics, set_metrics
+from common import udp
+
+_LOOPBACK = '127.0.0.1'
+
+
+def _bind() -> socket.socket:
+    skt = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    skt.bind((_LOOPBACK, 0))
+    skt.settimeout(1.0)
+    return skt
+
+
+class ShardRedirectTest(unittest.TestCase):
+
+    def setUp(self):
+        self._server = _bind()
+        self._shard = _bind()
+        self._worker_socket = _bind()
+        self._connection = UdpConnection(self._worker_socket, self._server.getsockname())
+        self._worker_address = self._worker_socket.getsockname()
+
+    def tearDown(self):
+        self._connection.close()
+        self._server.close()
+        self._shard.close()
+
+    def _command(self, sender: socket.socket, command: CommandType, params=None):
+        sender.sendto(pack_command(command, params, request_id=7), self._worker_address)
+        command, params, request_id = self._connection.wait_for_command(1.0)
+        return params, request_id
+
+    def _assign_shard(self):
+        params, request_id = self._command(self._server, CommandType.ASSIGN_SHARD,
+                                           AssignShardParams(self._shard.getsockname()[1]))
+        self._connection.redirect_images(params.port, request_id)
+
+    def _ping(self, sender: socket.socket):
+        params, request_id = self._command(sender, CommandType.PING)
+        self._connection.send_ping_response(1, request_id)
+        sender.recvfrom(udp.MAX_UDP_SIZE)
+
+    def _images_go_to(self, receiver: socket.socket):
+        self._connection.send_no_image(1)
+        data, address = receiver.recvfrom(udp.MAX_UDP_SIZE)
+        self.assertEqual(address, self._worker_address)
+
+    def test_assignment_is_confirmed(self):
+        self._assign_shard()
+        data, address = self._server.recvfrom(udp.MAX_UDP_SIZE)
+        self.assertEqual(data[:len(SHARD_RESPONSE)], SHARD_RESPONSE)
+        self.assertEqual(SHARD_PORT.unpack_from(data, len(SHARD_RESPONSE))[0], self._shard.getsockname()[1])
+
+    def test_shard_heartbeats_keep_the_redirect(self):
+        self._assign_shard()
+        self._server.recvfrom(udp.MAX_UDP_SIZE)
+        self._ping(self._shard)
+        self._images_go_to(self._shard)
+
+    def test_server_discovery_undoes_the_redirect(self):
+        self._assign_shard()
+        self._server.recvfrom(udp.MAX_UDP_SIZE)
+        self._ping(self._server)
+        self._images_go_to(self._server)
+
+
+class _Camera(Camera):
+
+    def take_picture(self) -> bytes:
+        return b'frame'
+
+
+class StreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self._server = _bind()
+        self._worker_socket = _bind()
+        self._worker_address = self._worker_socket.getsockname()
+        self._client = Client(UdpConnection(self._worker_socket, self._server.getsockname()), None, _Camera())
+        self._receiver = udp.ImageReceiver(self._server)
+
+    def tearDown(self):
+        self._command(CommandType.STOP_STREAM)
+        self._worker_socket.close()
+        self._server.close()
+
+    def _command(self, command: CommandType, params=None, request_id: int = 1):
+        self._server.sendto(pack_command(command, params, request_id), self._worker_address)
+        started = time.perf_counter()
+        self._client.handle_next_command(timeout=1.0)
+        # Commands are handled right away, the stream runs on its own.
+        self.assertLess(time.perf_counter() - started, 0.5)
+
+    def test_invalid_frame_rates_are_rejected(self):
+        for fps in (0.0, -1.0, float('nan')):
+            self._command(CommandType.START_STREAM, StreamParams(fps, 0, 10), request_id=5)
+            sender_id, image = self._receiver.receive()
+            self.assertIsNone(image)
+
+    def test_frames_are_sent_until_stopped(self):
+        self._command(CommandType.START_STREAM, StreamParams(100.0, 10, 12))
+        images = [self._receiver.receive()[1] for _ in range(2)]
+        self.assertEqual([image.id for image in images], [10, 11])
+
+        # Out of credit, until given more.
+        self._server.settimeout(0.1)
+        self.assertRaises(socket.timeout, self._receiver.receive)
+        self._server.settimeout(1.0)
+        self._command(CommandType.CREDIT, CreditParams(13))
+        self.assertEqual(self._receiver.receive()[1].id, 12)
+
+        self._command(CommandType.STOP_STREAM, request_id=9)
+        sender_id, image = self._receiver.receive()
+        self.assertIsNone(image)
+
+
+class FrameScheduleTest(unittest.TestCase):
+
+    def setUp(self):
+        self._metrics = Metrics()
+        self._previous_metrics = get_metrics()
+        set_metrics(self._metrics)
+        self._schedule = FrameSchedule()
+
+    def tearDown(self):
+        set_metrics(self._previous_metrics)
+
+    def test_frames_are_taken_up_to_the_credit(self):
+        self.assertTrue(self._schedule.set_rate(StreamParams(10.0, 0, 2)))
+        self.assertEqual([self._schedule.may_take(frame_id) for frame_id in range(3)], [True, True, False])
+        self._schedule.add_credit(3)
+        self.assertTrue(self._schedule.may_take(2))
+        self.assertEqual(self._metrics.counter('worker.stream.throttled_frames').snapshot(), 1)
+
+    def test_late_credit_does_not_take_back_credit(self):
+        self._schedule.set_rate(StreamParams(10.0, 0, 2))
+        self._schedule.add_credit(5)
+        self._schedule.add_credit(4)
+        self.assertEqual(self._schedule.limit, 5)
+
+    def test_invalid_rates_leave_the_schedule(self):
+        self._schedule.set_rate(StreamParams(10.0, 0, 2))
+        self.assertFalse(self._schedule.set_rate(StreamParams(0.0, 0, 8)))
+        self.assertEqual((self._schedule.interval, self._schedule.limit), (0.1, 2))
+        self.assertEqual(self._metrics.counter('worker.stream.rejected').snapshot(), 1)
+
+    def test_frames_there_was_no_time_for_are_skipped(self):
+        self._schedule.set_rate(StreamParams(10.0, 0, 2))
+        now = time.time()
+        self.assertAlmostEqual(self._schedule.next_frame_time(now + 1.0), now + 1.1)
+        self.assertGreaterEqual(self._schedule.next_frame_time(now - 1.0), now)
+
+
+class _UnansweredConnection(UdpConnection):
+
+    def send_image(self, sender_id: int, image: Image):
+        # As if the server stopped answering the transfer.
+        raise socket.timeout()
+
+
+class SendTimeoutTest(unittest.TestCase):
+
+    def setUp(self):
+        self._server = _bind()
+        self._worker_socket = _bind()
+        self._worker_address = self._worker_socket.getsockname()
+        self._directory = tempfile.TemporaryDirectory()
+        self._storage = BasicFileSystemStorage(Path(self._directory.name))
+        for image_id in (1, 2):
+            self._storage.store_image(Image(image_id, bytes(100)))
+        self._client = Client(_UnansweredConnection(self._worker_socket, self._server.getsockname()),
+                              self._storage, _Camera())
+        self._receiver = udp.ImageReceiver(self._server)
+
+    def tearDown(self):
+        self._worker_socket.close()
+        self._server.close()
+        self._directory.cleanup()
+
+    def _request(self, command: CommandType):
+        self._server.sendto(pack_command(command, None, request_id=4), self._worker_address)
+        self._client.handle_next_command(timeout=1.0)
+        # The end marker answers the request right away.
+        sender_id, image = self._receiver.receive()
+        self.assertIsNone(image)
+
+    def test_next_picture_is_requeued(self):
+        self._request(CommandType.SEND_NEXT_PICTURE)
+        self.assertEqual(self._storage.retrieve_next_image().id, 2)
+
+    def test_all_pictures_stop_at_the_first_timeout(self):
+        self._request(CommandType.SEND_ALL_PICTURES)
+        self.assertEqual([self._storage.retrieve_next_image().id for _ in range(2)], [2, 1])
+
+
+class AsyncClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self._server = _bind()
+        self._worker_socket = _bind()
+        self._worker_address = self._worker_socket.getsockname()
+        self._directory = tempfile.TemporaryDirectory()
+        self._storage = BasicFileSystemStorage(Path(self._directory.name))
+        self._storage.store_image(Image(1, bytes(range(256)) * 20))
+
+    def tearDown(self):
+        self._worker_socket.close()
+        self._server.close()
+        self._directory.cleanup()
+
+    async def _handle(self, client: AsyncClient, command: CommandType, params=None):
+        self._server.sendto(pack_command(command, params, request_id=3), self._worker_address)
+        started = time.perf_counter()
+        await client.handle_next_command(timeout=1.0)
+        self.assertLess(time.perf_counter() - started, 0.5)
+
+    async def _answer_clock_sync_while_sending(self):
+        # The server doesn't answer the transfer, so the picture is sent until it gives up.
+        connection = AsyncConnection(self._server.getsockname(), reliable=True)
+        await asyncio.get_running_loop().create_datagram_endpoint(lambda: connection, sock=self._worker_socket)
+        client = AsyncClient(connection, self._storage, _Camera())
+        await self._handle(client, CommandType.SEND_NEXT_PICTURE)
+        await self._handle(client, CommandType.SYNC_CLOCK, SyncClockParams(time.time()))
+
+        deadline = time.perf_counter() + 0.5
+        while time.perf_counter() < deadline:
+            data = await asyncio.get_running_loop().run_in_executor(None, self._server.recv, udp.MAX_UDP_SIZE)
+            if data[:len(CLOCK_RESPONSE)] == CLOCK_RESPONSE:
+                return
+        self.fail('No clock sync reply while sending')
+
+    def test_commands_are_handled_while_sending(self):
+        asyncio.run(self._answer_clock_sync_while_sending())
+
+
+if __name__ == '__main__':
+    unittest.main()
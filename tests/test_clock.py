@@ -0,0 +1,78 @@
+import socket
+import threading
+import unittest
+
+from client.connection import UdpConnection as WorkerConnection
+from common import udp
+from common.clock import ClockSample, Clock, best_sample
+from common.image import Image
+from master.client import UdpConnection
+
+_LOOPBACK = '127.0.0.1'
+
+
+def _bind() -> socket.socket:
+    skt = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    skt.bind((_LOOPBACK, 0))
+    skt.settimeout(1.0)
+    return skt
+
+
+class ClockSampleTest(unittest.TestCase):
+
+    def test_offset_and_delay(self):
+        # The client's clock is 5 seconds ahead, the way there takes 0.1 and back 0.3 seconds,
+        # and the client takes 0.2 seconds to reply.
+        sample = ClockSample(100.0, 105.1, 105.3, 100.6)
+        self.assertAlmostEqual(sample.offset, 4.9)
+        self.assertAlmostEqual(sample.delay, 0.4)
+        # The error is at most half the delay.
+        self.assertLessEqual(abs(sample.offset - 5.0), sample.delay / 2)
+
+    def test_best_sample_has_the_least_delay(self):
+        samples = [ClockSample(0.0, 5.5, 5.5, 1.0), ClockSample(0.0, 5.05, 5.05, 0.1), ClockSample(0.0, 5.2, 5.2, 0.4)]
+        self.assertIs(best_sample(samples), samples[1])
+        self.assertAlmostEqual(best_sample(samples).offset, 5.0)
+
+    def test_clock_converts_times(self):
+        clock = Clock()
+        clock.set_offset(2.5)
+        self.assertEqual(clock.to_local(10.0), 12.5)
+        self.assertEqual(clock.to_server(12.5), 10.0)
+
+
+class MeasureClockTest(unittest.TestCase):
+
+    def setUp(self):
+        self._master_socket = _bind()
+        self._worker_socket = _bind()
+        self._worker_address = self._worker_socket.getsockname()
+        self._master = UdpConnection(self._master_socket, self._worker_address[1], [self._worker_address])
+        self._worker = WorkerConnection(self._worker_socket, self._master_socket.getsockname())
+
+    def tearDown(self):
+        self._master.close()
+        self._worker.close()
+
+    def test_images_arriving_during_a_sync_are_kept(self):
+        image = Image(3, bytes(range(256)) * 300, 1.5)
+
+        def answer_sync():
+            command, params, request_id = self._worker.wait_for_command(1.0)
+            # The image was on its way when the sync arrived.
+            self._worker.send_image(7, image)
+            self._worker.send_clock_reply(params.server_time, 10.0, request_id)
+
+        worker_thread = threading.Thread(target=answer_sync)
+        worker_thread.start()
+        sample = self._master.measure_clock(self._master.create_client(7, self._worker_address))
+        worker_thread.join()
+
+        self.assertIsNotNone(sample)
+        self.assertEqual(sample.t1, 10.0)
+        client_id, received = self._master.receive_image()
+        self.assertEqual((client_id, received.id, bytes(received.data)), (7, 3, bytes(image.data)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+
+from common.command import (CommandType, TakePictureParams, NO_REQUEST_ID, MAX_REQUEST_ID, ENVELOPE,
+                            ENVELOPE_MAGIC, pack_command, unpack_request, unpack_command)
+from master.inflight import InFlightRequests
+
+
+class EnvelopeTest(unittest.TestCase):
+
+    def test_request_id_is_carried(self):
+        data = pack_command(CommandType.TAKE_PICTURE, TakePictureParams(3, 1.5), request_id=42)
+        command, params, request_id = unpack_request(data)
+        self.assertEqual(command, CommandType.TAKE_PICTURE)
+        self.assertEqual((params.picture_id, params.capture_time), (3, 1.5))
+        self.assertEqual(request_id, 42)
+
+    def test_commands_without_envelope_have_no_request_id(self):
+        data = pack_command(CommandType.PING, None)
+        self.assertNotEqual(data[0], ENVELOPE_MAGIC)
+        self.assertEqual(unpack_request(data), (CommandType.PING, None, NO_REQUEST_ID))
+
+    def test_unknown_envelope_versions_are_rejected(self):
+        data = ENVELOPE.pack(ENVELOPE_MAGIC, 2, 42) + pack_command(CommandType.PING, None)
+        self.assertRaises(ValueError, unpack_request, data)
+
+    def test_envelope_is_dropped_by_unpack_command(self):
+        data = pack_command(CommandType.SEND_NEXT_PICTURE, None, request_id=MAX_REQUEST_ID)
+        self.assertEqual(unpack_command(data), (CommandType.SEND_NEXT_PICTURE, None))
+
+
+class InFlightRequestsTest(unittest.TestCase):
+
+    def test_end_markers_are_matched_by_request_id(self):
+        requests = InFlightRequests()
+        first_id = requests.start(1, CommandType.SEND_ALL_PICTURES)
+        second_id = requests.start(1, CommandType.SEND_ALL_PICTURES)
+        self.assertTrue(requests.end_received(1, second_id))
+        # Answered once only, and only for the client it was sent to.
+        self.assertFalse(requests.end_received(1, second_id))
+        self.assertFalse(requests.end_received(2, first_id))
+        self.assertEqual(requests.pending(1), [(first_id, CommandType.SEND_ALL_PICTURES)])
+
+    def test_end_markers_without_request_id_are_taken(self):
+        requests = InFlightRequests()
+        self.assertTrue(requests.end_received(1, NO_REQUEST_ID))
+
+    def test_images_answer_the_oldest_image_request(self):
+        requests = InFlightRequests()
+        all_id = requests.start(1, CommandType.SEND_ALL_PICTURES)
+        first_id = requests.start(1, CommandType.SEND_NEXT_PICTURE)
+        second_id = requests.start(1, CommandType.SEND_NEXT_PICTURE)
+        requests.image_received(1)
+        self.assertEqual(requests.pending(1), [(all_id, CommandType.SEND_ALL_PICTURES),
+                                               (second_id, CommandType.SEND_NEXT_PICTURE)])
+        self.assertFalse(requests.end_received(1, first_id))
+
+    def test_unanswered_commands_are_not_tracked(self):
+        requests = InFlightRequests()
+        request_id = requests.start(1, CommandType.PING)
+        self.assertNotEqual(request_id, NO_REQUEST_ID)
+        self.assertEqual(requests.pending(1), [])
+
+    def test_oldest_requests_are_forgotten(self):
+        requests = InFlightRequests(max_in_flight=2)
+        request_ids = [requests.start(1, CommandType.SEND_NEXT_PICTURE) for _ in range(3)]
+        self.assertEqual([request_id for request_id, command in requests.pending(1)], request_ids[1:])
+        self.assertFalse(requests.end_received(1, request_ids[0]))
+
+    def test_left_overs_of_forgotten_clients_are_not_taken(self):
+        requests = InFlightRequests()
+        request_id = requests.start(1, CommandType.STOP_STREAM)
+        requests.forget(1)
+        self.assertFalse(requests.end_received(1, request_id))
+
+
+if __name__ == '__main__':
+    unittest.main()
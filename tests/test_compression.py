@@ -0,0 +1,44 @@
+from pathlib import Path
+
+import tempfile
+import unittest
+
+from common.compression import Codec, CompressionSettings, Compressor, COMPRESS_CHUNK_SIZE, decompress
+from common.image import FileImage
+
+
+class _RecordingImage(FileImage):
+    # Records the sizes of the parts read, and fails if the data is asked for as a whole.
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.read_sizes = []
+
+    @property
+    def data(self):
+        raise AssertionError('read as a whole')
+
+    def read_part(self, offset: int, size: int):
+        part = super().read_part(offset, size)
+        self.read_sizes.append(len(part))
+        return part
+
+
+class CompressorTest(unittest.TestCase):
+
+    def test_file_images_are_compressed_without_reading_them_whole(self):
+        data = bytes(range(256)) * (3 * COMPRESS_CHUNK_SIZE // 256 + 1)
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / 'image.jpg'
+            path.write_bytes(data)
+            for codec in (Codec.ZLIB, Codec.LZMA):
+                image = _RecordingImage(1, path)
+                used_codec, compressed = Compressor(CompressionSettings(codec, 1)).compress_image(image)
+                self.assertEqual(used_codec, codec)
+                self.assertEqual(decompress(codec, compressed.data), data)
+                self.assertLessEqual(max(image.read_sizes), COMPRESS_CHUNK_SIZE)
+                image.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
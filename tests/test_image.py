@@ -0,0 +1,71 @@
+from pathlib import Path
+from unittest import mock
+
+import mmap
+import os
+import tempfile
+import unittest
+
+from common.image import FileImage, MappedFileImage, compute_digest, Image
+
+
+class FileImageTest(unittest.TestCase):
+
+    def setUp(self):
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self._path = Path(self._temp_dir.name) / 'images'
+        # An image in the middle of the file, not at a multiple of the allocation granularity.
+        self._offset = mmap.ALLOCATIONGRANULARITY + 3
+        self._data = bytes(range(256)) * 1000
+        self._path.write_bytes(b'x' * self._offset + self._data + b'y' * 10)
+
+    def tearDown(self):
+        self._temp_dir.cleanup()
+
+    def _check_parts(self, image: FileImage):
+        self.assertEqual(len(image), len(self._data))
+        parts = [bytes(image.read_part(offset, 1000)) for offset in range(0, len(image), 1000)]
+        self.assertEqual(b''.join(parts), self._data)
+        # Parts asked for past the end are cut short.
+        self.assertEqual(bytes(image.read_part(len(image) - 5, 1000)), self._data[-5:])
+        self.assertEqual(bytes(image.data), self._data)
+        self.assertEqual(compute_digest(image), compute_digest(Image(1, self._data)))
+
+    def test_parts_are_read_from_a_single_open_file(self):
+        image = FileImage(1, self._path, self._offset, len(self._data))
+        with mock.patch('os.open', wraps=os.open) as open_file:
+            self._check_parts(image)
+        self.assertEqual(open_file.call_count, 1)
+        image.close()
+
+    def test_data_is_not_kept(self):
+        image = FileImage(1, self._path, self._offset, len(self._data))
+        self.assertEqual(bytes(image.data), self._data)
+        self.assertIsNone(image._data)
+        image.close()
+
+    def test_parts_are_read_from_a_map(self):
+        image = MappedFileImage(1, self._path, self._offset, len(self._data))
+        self._check_parts(image)
+        self.assertIsInstance(image.read_part(0, 10), memoryview)
+        image.close()
+
+    def test_mapped_images_outlive_their_files(self):
+        image = MappedFileImage(1, self._path, self._offset, len(self._data))
+        part = image.read_part(0, 100)
+        self._path.unlink()
+        self.assertEqual(bytes(image.read_part(100, 100)), self._data[100:200])
+        # Closed once the parts are gone.
+        image.close()
+        self.assertEqual(bytes(part), self._data[:100])
+
+    def test_empty_images_are_mapped(self):
+        empty_path = self._path.with_name('empty')
+        empty_path.write_bytes(b'')
+        image = MappedFileImage(1, empty_path)
+        self.assertEqual(bytes(image.read_part(0, 10)), b'')
+        self.assertEqual(len(image), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
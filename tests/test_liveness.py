@@ -0,0 +1,62 @@
+import time
+import unittest
+
+from common.metrics import Metrics, get_metrics, set_metrics
+from master.liveness import Liveness, LivenessTracker
+
+
+class LivenessTrackerTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tracker = LivenessTracker(suspect_after=0.05, dead_after=0.1)
+
+    def test_clients_not_asked_anything_are_alive(self):
+        self.assertEqual(self._tracker.state(1), Liveness.ALIVE)
+        self.assertIsNone(self._tracker.last_heard(1))
+        self.assertFalse(self._tracker.is_waiting(1))
+
+    def test_silent_clients_become_suspect_then_dead(self):
+        self._tracker.asked(1)
+        self.assertTrue(self._tracker.is_waiting(1))
+        self.assertEqual(self._tracker.state(1), Liveness.ALIVE)
+        time.sleep(0.06)
+        self.assertEqual(self._tracker.state(1), Liveness.SUSPECT)
+        time.sleep(0.05)
+        self.assertEqual(self._tracker.state(1), Liveness.DEAD)
+
+    def test_only_the_first_unanswered_question_counts(self):
+        self._tracker.asked(1)
+        time.sleep(0.06)
+        self._tracker.asked(1)
+        self.assertEqual(self._tracker.state(1), Liveness.SUSPECT)
+
+    def test_dead_clients_heard_from_are_alive_again(self):
+        self._tracker.asked(1)
+        time.sleep(0.11)
+        self.assertEqual(self._tracker.state(1), Liveness.DEAD)
+        self._tracker.heard_from(1)
+        self.assertEqual(self._tracker.state(1), Liveness.ALIVE)
+        self.assertFalse(self._tracker.is_waiting(1))
+        self.assertIsNotNone(self._tracker.last_heard(1))
+
+    def test_states_are_counted_in_gauges(self):
+        self._tracker.asked(1)
+        self._tracker.asked(2)
+        time.sleep(0.11)
+        self._tracker.asked(3)
+        metrics = Metrics()
+        previous_metrics = get_metrics()
+        set_metrics(metrics)
+        try:
+            states = self._tracker.record_states([1, 2, 3, 4])
+        finally:
+            set_metrics(previous_metrics)
+
+        self.assertEqual(states, {1: Liveness.DEAD, 2: Liveness.DEAD, 3: Liveness.ALIVE, 4: Liveness.ALIVE})
+        self.assertEqual(metrics.gauge('master.clients.alive').snapshot(), 2)
+        self.assertEqual(metrics.gauge('master.clients.suspect').snapshot(), 0)
+        self.assertEqual(metrics.gauge('master.clients.dead').snapshot(), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+import unittest
+
+from benchmark import loopback
+
+
+# Each run takes its own ports, as the workers of earlier runs may still hold theirs.
+_FIRST_PORT = 31000
+_PORTS_PER_RUN = 10
+
+
+class CollectPicturesTest(unittest.TestCase):
+    _next_port = _FIRST_PORT
+
+    def _collect(self, *options) -> dict:
+        # Large images keep the workers busy taking pictures when the collection starts,
+        # so they are slow to answer its heartbeat.
+        port = CollectPicturesTest._next_port
+        CollectPicturesTest._next_port += _PORTS_PER_RUN
+        args = loopback._parse_args(['--workers', '3', '--images', '10', '--size', '2000000',
+                                     '--rcvbuf', '8388608', '--port', str(port)] + list(options))
+        return loopback.run(args)
+
+    def test_busy_workers_are_collected(self):
+        result = self._collect()
+        self.assertEqual(result['received_images'], 30)
+
+    def test_busy_workers_are_collected_reliably(self):
+        result = self._collect('--reliable')
+        self.assertEqual(result['received_images'], 30)
+
+    def test_busy_workers_are_collected_concurrently(self):
+        result = self._collect('--concurrent')
+        self.assertEqual(result['received_images'], 30)
+
+    def test_dead_workers_are_given_up_on_with_asyncio(self):
+        # The others are collected, without waiting for the dead worker beyond its heartbeats.
+        result = self._collect('--aio', '--reliable', '--dead-workers', '1')
+        self.assertEqual(result['received_images'], 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import socket
+import threading
+import time
+import unittest
+
+from client.connection import UdpConnection as WorkerConnection
+from common.image import Image
+from master.client import UdpConnection, discovery_wait
+
+_LOOPBACK = '127.0.0.1'
+
+
+def _bind() -> socket.socket:
+    skt = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    skt.bind((_LOOPBACK, 0))
+    skt.settimeout(1.0)
+    return skt
+
+
+class AssignShardTest(unittest.TestCase):
+
+    def setUp(self):
+        self._master_socket = _bind()
+        self._worker_socket = _bind()
+        self._worker_address = self._worker_socket.getsockname()
+        self._master = UdpConnection(self._master_socket, self._worker_address[1], [self._worker_address])
+        self._worker = WorkerConnection(self._worker_socket, self._master_socket.getsockname())
+        self._client = self._master.create_client(7, self._worker_address)
+
+    def tearDown(self):
+        self._master.close()
+        self._worker.close()
+
+    def _run_worker(self, answer):
+        worker_thread = threading.Thread(target=answer)
+        worker_thread.start()
+        return worker_thread
+
+    def test_images_arriving_during_an_assignment_are_kept(self):
+        image = Image(3, bytes(range(256)) * 300, 1.5)
+
+        def answer_assignment():
+            command, params, request_id = self._worker.wait_for_command(1.0)
+            # The image was on its way when the assignment arrived.
+            self._worker.send_image(7, image)
+            self._worker.redirect_images(params.port, request_id)
+
+        worker_thread = self._run_worker(answer_assignment)
+        confirmed = self._master.assign_shard(self._client, 40000)
+        worker_thread.join()
+
+        self.assertTrue(confirmed)
+        client_id, received = self._master.receive_image()
+        self.assertEqual((client_id, received.id, bytes(received.data)), (7, 3, bytes(image.data)))
+
+    def test_assignment_to_another_port_is_not_a_confirmation(self):
+        def confirm_other_port():
+            for _ in range(UdpConnection._ASSIGN_SHARD_ATTEMPTS):
+                command, params, request_id = self._worker.wait_for_command(1.0)
+                self._worker.redirect_images(params.port + 1, request_id)
+
+        worker_thread = self._run_worker(confirm_other_port)
+        confirmed = self._master.assign_shard(self._client, 40000)
+        worker_thread.join()
+        self.assertFalse(confirmed)
+
+
+class _LoopbackConnection(UdpConnection):
+    # Broadcasts reach the worker on the loopback.
+    _BROADCAST_ADDRESS = _LOOPBACK
+
+
+class DiscoveryTest(unittest.TestCase):
+
+    def test_waiting_ends_once_all_known_clients_replied(self):
+        known = {('10.0.0.1', 1), ('10.0.0.2', 1)}
+        self.assertEqual(discovery_wait(10.0, 11.0, 10.0, 0.05, known, {('10.0.0.1', 1)}), 1.0)
+        self.assertAlmostEqual(discovery_wait(10.0, 11.0, 10.0, 0.05, known, known), 0.05)
+
+    def test_waiting_ends_once_replies_die_down_when_none_are_known(self):
+        self.assertEqual(discovery_wait(10.0, 11.0, 9.0, 0.05, set(), set()), 1.0)
+        self.assertLess(discovery_wait(10.0, 11.0, 9.0, 0.05, set(), {('10.0.0.1', 1)}), 0)
+
+    def test_new_client_is_discovered_without_waiting_the_timeout(self):
+        master_socket = _bind()
+        worker_socket = _bind()
+        master = _LoopbackConnection(master_socket, worker_socket.getsockname()[1])
+        worker = WorkerConnection(worker_socket, master_socket.getsockname())
+
+        def register():
+            command, params, request_id = worker.wait_for_command(1.0)
+            worker.send_register(request_id)
+
+        worker_thread = threading.Thread(target=register)
+        worker_thread.start()
+        try:
+            started = time.monotonic()
+            clients = master.do_discovery()
+            discovery_time = time.monotonic() - started
+        finally:
+            worker_thread.join()
+            master.close()
+            worker.close()
+
+        self.assertEqual(len(clients), 1)
+        # Well before the timeout of the socket.
+        self.assertLess(discovery_time, 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+from pathlib import Path
+
+import tempfile
+import unittest
+
+from common import pack
+from common.pack import PackFile
+
+
+class PackFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self._path = Path(self._temp_dir.name)
+
+    def tearDown(self):
+        self._temp_dir.cleanup()
+
+    def _segments(self):
+        return sorted(path.name for path in self._path.glob(pack.SEGMENT_FILE_PATTERN))
+
+    def test_index_is_read_back(self):
+        with PackFile(self._path, max_segment_size=10) as pack_file:
+            for image_id in range(5):
+                pack_file.append(1, image_id, bytes([image_id]) * 6, timestamp=image_id / 2)
+            pack_file.append(2, 0, b'')
+            locations = {key: pack_file.location_of(*key) for key in pack_file.keys()}
+
+        # A record cut off while it was written is dropped.
+        with (self._path / pack.INDEX_FILE_NAME).open(mode='ab') as f:
+            f.write(b'\0' * (pack.INDEX_RECORD.size // 2))
+
+        with PackFile(self._path, max_segment_size=10) as pack_file:
+            self.assertEqual(sorted(pack_file.keys()), [(1, 0), (1, 1), (1, 2), (1, 3), (1, 4), (2, 0)])
+            for image_id in range(5):
+                self.assertEqual(bytes(pack_file.read(1, image_id)), bytes([image_id]) * 6)
+                self.assertEqual(pack_file.timestamp_of(1, image_id), image_id / 2)
+            self.assertEqual(bytes(pack_file.read(2, 0)), b'')
+            self.assertEqual({key: pack_file.location_of(*key) for key in pack_file.keys()}, locations)
+            pack_file.append(1, 5, b'after')
+        self.assertEqual((self._path / pack.INDEX_FILE_NAME).stat().st_size % pack.INDEX_RECORD.size, 0)
+
+    def test_images_appended_again_replace_the_first(self):
+        with PackFile(self._path) as pack_file:
+            pack_file.append(1, 1, b'first')
+            pack_file.append(1, 1, b'second')
+        with PackFile(self._path) as pack_file:
+            self.assertEqual(len(pack_file), 1)
+            self.assertEqual(bytes(pack_file.read(1, 1)), b'second')
+
+    def test_removed_images_retire_their_segments(self):
+        with PackFile(self._path, max_segment_size=10) as pack_file:
+            for image_id in range(4):
+                pack_file.append(1, image_id, b'x' * 8)
+            self.assertEqual(len(self._segments()), 4)
+            pack_file.remove(1, 0)
+            pack_file.remove(1, 2)
+            self.assertEqual(self._segments(), [pack.SEGMENT_FILE_FORMAT.format(i) for i in (1, 3)])
+            # The segment appended to is kept, even once empty.
+            pack_file.remove(1, 3)
+            self.assertEqual(self._segments(), [pack.SEGMENT_FILE_FORMAT.format(i) for i in (1, 3)])
+
+        with PackFile(self._path, max_segment_size=10) as pack_file:
+            self.assertEqual(list(pack_file.keys()), [(1, 1)])
+            pack_file.append(1, 4, b'y' * 8)
+            self.assertEqual(bytes(pack_file.read(1, 4)), b'y' * 8)
+
+    def test_index_is_compacted(self):
+        with PackFile(self._path) as pack_file:
+            for image_id in range(3 * pack._COMPACT_MIN_RECORDS):
+                pack_file.append(1, image_id, b'x')
+                pack_file.remove(1, image_id)
+            pack_file.append(1, 0, b'kept')
+        index_size = (self._path / pack.INDEX_FILE_NAME).stat().st_size
+        self.assertLessEqual(index_size, pack._COMPACT_MIN_RECORDS * pack.INDEX_RECORD.size)
+
+        with PackFile(self._path) as pack_file:
+            self.assertEqual(list(pack_file.keys()), [(1, 0)])
+            self.assertEqual(bytes(pack_file.read(1, 0)), b'kept')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+from pathlib import Path
+
+import tempfile
+import unittest
+
+from client.storage import JournaledStorage, PackFileStorage, JOURNAL_FILE_NAME, JOURNAL_RECORD
+from common import pack
+from common.image import Image
+
+
+class JournaledStorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self._path = Path(self._temp_dir.name)
+
+    def tearDown(self):
+        self._temp_dir.cleanup()
+
+    def test_images_survive_compaction_and_restart(self):
+        storage = JournaledStorage(self._path, max_bytes=100)
+        for i in range(3000):
+            storage.store_image(Image(i, b'x' * 40))
+            image = storage.retrieve_next_image()
+            if i % 3 == 0:
+                storage.store_image(Image(10000 + i, b'y' * 40))
+            storage.acknowledge(image.id)
+
+            pending = sorted(record[0] for record in storage._stored_images)
+            storage.close()
+            storage = JournaledStorage(self._path, max_bytes=100)
+            self.assertEqual(sorted(record[0] for record in storage._stored_images), pending)
+            self.assertEqual(storage.used_bytes, sum(path.stat().st_size for path in self._path.glob('*.jpg')))
+        storage.close()
+
+    def test_repeated_image_ids_are_acknowledged(self):
+        with JournaledStorage(self._path) as storage:
+            storage.store_image(Image(7, b'a'))
+            storage.store_image(Image(7, b'b'))
+            storage.retrieve_next_image()
+            storage.retrieve_next_image()
+            storage.acknowledge(7)
+            storage.acknowledge(7)
+            self.assertEqual(storage.backlog, 0)
+
+        with JournaledStorage(self._path) as storage:
+            self.assertEqual(storage.backlog, 0)
+
+    def test_truncated_record_is_dropped_on_replay(self):
+        with JournaledStorage(self._path) as storage:
+            for image_id in range(3):
+                storage.store_image(Image(image_id, bytes([image_id])))
+            storage.acknowledge(storage.retrieve_next_image().id)
+            storage.retrieve_next_image()
+        # As if the worker crashed while writing the record of the acknowledgement of image 1.
+        journal_path = self._path / JOURNAL_FILE_NAME
+        with journal_path.open(mode='ab') as f:
+            f.write(bytes(JOURNAL_RECORD.size // 2))
+
+        with JournaledStorage(self._path) as storage:
+            self.assertEqual(journal_path.stat().st_size % JOURNAL_RECORD.size, 0)
+            self.assertEqual(storage.backlog, 2)
+            storage.store_image(Image(3, b'3'))
+
+        # Records written after the replay are whole.
+        with JournaledStorage(self._path) as storage:
+            images = [storage.retrieve_next_image() for _ in range(4)]
+            self.assertIsNone(images[3])
+            self.assertEqual([(image.id, bytes(image.data)) for image in images[:3]],
+                             [(1, b'\1'), (2, b'\2'), (3, b'3')])
+
+
+class PackFileStorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self._path = Path(self._temp_dir.name)
+
+    def tearDown(self):
+        self._temp_dir.cleanup()
+
+    def test_repeated_image_ids_keep_their_data(self):
+        with PackFileStorage(self._path) as storage:
+            storage.store_image(Image(7, b'old', 1.0))
+            storage.store_image(Image(7, b'new', 2.0))
+            images = [storage.retrieve_next_image(), storage.retrieve_next_image()]
+            self.assertEqual(sorted((bytes(image.data), image.timestamp) for image in images),
+                             [(b'new', 2.0), (b'old', 1.0)])
+
+    def test_images_not_acknowledged_are_sent_after_restart(self):
+        with PackFileStorage(self._path) as storage:
+            for image_id in range(3):
+                storage.store_image(Image(image_id, bytes([image_id]), float(image_id)))
+            storage.acknowledge(storage.retrieve_next_image().id)
+            # Retrieved, but the server never acknowledged it.
+            storage.retrieve_next_image()
+
+        with PackFileStorage(self._path) as storage:
+            images = [storage.retrieve_next_image(), storage.retrieve_next_image(), storage.retrieve_next_image()]
+            self.assertIsNone(images[2])
+            self.assertEqual(sorted((image.id, bytes(image.data), image.timestamp) for image in images[:2]),
+                             [(0, b'\0', 0.0), (1, b'\1', 1.0)])
+            # New images don't take the numbers of the recovered ones.
+            storage.store_image(Image(0, b'again'))
+            self.assertEqual(bytes(storage.retrieve_next_image().data), b'again')
+
+    def test_acknowledged_images_are_reclaimed(self):
+        with PackFileStorage(self._path, max_segment_size=100) as storage:
+            for image_id in range(20):
+                storage.store_image(Image(image_id, b'x' * 100))
+                storage.acknowledge(storage.retrieve_next_image().id)
+            self.assertEqual(len(list(self._path.glob(pack.SEGMENT_FILE_PATTERN))), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+import socket
+import time
+import unittest
+
+from common import udp
+from common.compression import Codec
+from common.image import Image
+from common.metrics import Metrics, get_metrics, set_metrics
+
+
+def _first_part(sender_id: int, image_id: int, size: int) -> bytes:
+    datagram = next(udp.pack_parts(sender_id, Image(image_id, bytes(size))))
+    return b''.join(bytes(buffer) for buffer in datagram)
+
+
+class ImageAssemblerTest(unittest.TestCase):
+
+    _IMAGE_SIZE = 3 * udp.MAX_PART_SIZE
+
+    def test_stale_partial_images_are_expired(self):
+        assembler = udp.ImageAssembler(max_partial_age=0.05)
+        assembler.feed(_first_part(1, 1, self._IMAGE_SIZE))
+        time.sleep(0.1)
+        assembler.feed(_first_part(1, 2, self._IMAGE_SIZE))
+        self.assertEqual(list(assembler.missing_parts(1).keys()), [2])
+
+    def test_partial_images_are_bounded_by_bytes(self):
+        assembler = udp.ImageAssembler(max_partial_bytes=2 * self._IMAGE_SIZE)
+        for image_id in range(5):
+            assembler.feed(_first_part(1, image_id, self._IMAGE_SIZE))
+        self.assertEqual(sorted(assembler.missing_parts(1).keys()), [3, 4])
+
+    def test_oversized_images_are_dropped(self):
+        assembler = udp.ImageAssembler(max_partial_bytes=2 * self._IMAGE_SIZE)
+        for image_size in (2 * self._IMAGE_SIZE + 1, 0xFFFFFFFF):
+            header = udp.IMAGE_HEADER.pack(1, 1, 0, udp.FLAG_RELIABLE | udp.FLAG_ACK_REQUEST, image_size, 0.0)
+            result, reply = assembler.feed(header + bytes(udp.MAX_PART_SIZE))
+            self.assertIsNone(result)
+            self.assertIsNone(reply)
+        self.assertEqual(assembler.missing_parts(1), {})
+
+    def test_updated_partial_images_are_kept(self):
+        assembler = udp.ImageAssembler(max_partial_bytes=2 * self._IMAGE_SIZE)
+        image = Image(0, bytes(self._IMAGE_SIZE))
+        datagrams = [b''.join(bytes(buffer) for buffer in datagram) for datagram in udp.pack_parts(1, image)]
+        assembler.feed(datagrams[0])
+        assembler.feed(_first_part(1, 1, self._IMAGE_SIZE))
+        # More of image 0 arrives, so image 1 is now the least recently updated.
+        assembler.feed(datagrams[1])
+        assembler.feed(_first_part(1, 2, self._IMAGE_SIZE))
+        self.assertEqual(sorted(assembler.missing_parts(1).keys()), [0, 2])
+
+        result, reply = assembler.feed(datagrams[2])
+        self.assertEqual(bytes(result[1].data), bytes(self._IMAGE_SIZE))
+
+    def test_corrupt_compressed_images_are_dropped(self):
+        assembler = udp.ImageAssembler()
+        data = b'not zlib data'
+        flags = (Codec.ZLIB << udp.FLAG_CODEC_SHIFT) | udp.FLAG_RELIABLE
+        result, reply = assembler.feed(udp.IMAGE_HEADER.pack(1, 1, 0, flags, len(data), 0.0) + data)
+        self.assertIsNone(result)
+        self.assertTrue(udp.unpack_status(reply)[3])
+
+
+class ForwardErrorCorrectionTest(unittest.TestCase):
+
+    # Groups of 3, 3 and 1 parts, the last part is short.
+    _DATA = bytes(range(256)) * (6 * udp.MAX_PART_SIZE // 256 + 1)
+
+    def _feed(self, lost_indexes, fec_group_size: int = 3):
+        # Feeds the parts and parities of an image to an assembler, losing some of its parts.
+        metrics = Metrics()
+        previous_metrics = get_metrics()
+        set_metrics(metrics)
+        try:
+            assembler = udp.ImageAssembler()
+            result = None
+            part_index = 0
+            for datagram in udp.pack_parts(1, Image(5, self._DATA), fec_group_size=fec_group_size):
+                data = b''.join(bytes(buffer) for buffer in datagram)
+                if udp.IMAGE_HEADER.unpack_from(data)[3] & udp.FLAG_PARITY == 0:
+                    part_index += 1
+                    if part_index - 1 in lost_indexes:
+                        continue
+                result, reply = assembler.feed(data)
+        finally:
+            set_metrics(previous_metrics)
+        return assembler, result, metrics.counter('udp.fec_recovered_parts').snapshot()
+
+    def test_one_lost_part_per_group_is_recovered(self):
+        assembler, result, recovered = self._feed({1, 3, 6})
+        self.assertEqual(result[1].id, 5)
+        self.assertEqual(bytes(result[1].data), self._DATA)
+        self.assertEqual(recovered, 3)
+
+    def test_two_lost_parts_of_a_group_are_missing(self):
+        assembler, result, recovered = self._feed({0, 2, 4})
+        self.assertIsNone(result)
+        self.assertEqual(recovered, 1)
+        self.assertEqual(sorted(assembler.missing_parts(1)[5]), [0, 2])
+
+    def test_lost_parts_are_missing_without_fec(self):
+        assembler, result, recovered = self._feed({1}, fec_group_size=0)
+        self.assertIsNone(result)
+        self.assertEqual(recovered, 0)
+        self.assertEqual(list(assembler.missing_parts(1)[5]), [1])
+
+
+class BufferSizeTest(unittest.TestCase):
+
+    def test_capped_buffers_are_counted(self):
+        metrics = Metrics()
+        previous_metrics = get_metrics()
+        set_metrics(metrics)
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as skt:
+                # Far beyond what the kernel allows by default.
+                udp.set_buffer_sizes(skt, receive_buffer_size=1 << 30)
+                actual_size = skt.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        finally:
+            set_metrics(previous_metrics)
+
+        self.assertEqual(metrics.counter('udp.capped_receive_buffers').snapshot(), 1)
+        self.assertEqual(metrics.gauge('udp.receive_buffer_size').snapshot(), actual_size)
+
+
+if __name__ == '__main__':
+    unittest.main()